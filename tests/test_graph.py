@@ -1,11 +1,16 @@
 from wc_rules.schema.attributes import *
-from wc_rules.graph.canonical_labeling import canonical_label
+from wc_rules.graph.canonical_labeling import canonical_label, group_by_certificate, refine_partition, undo, initialize_partition, first_nontrivial_cell
+from wc_rules.graph.compact import CompactGraph
 from wc_rules.graph.graph_partitioning import partition_canonical_form, recompose
+from wc_rules.graph.canonical_cache import CanonicalLabelCache, canonical_label_many
+from wc_rules.schema.base import BaseClass
 import wc_rules.graph.examples as gex
 
 from dataclasses import dataclass
 from typing import Any
 from collections import deque
+from wc_rules.graph.collections import GraphContainer, CanonicalForm
+import math
 
 import unittest
 from parameterized import parameterized
@@ -74,3 +79,103 @@ class TestCanonicalLabel(unittest.TestCase):
 				if L1 not in examined:
 					to_be_examined.appendleft((L1,G1,))
 
+
+	def test_large_spoke(self):
+		x = gex.X('hub')
+		x.y = [gex.Y(f's{i}') for i in range(12)]
+		m,L,G = canonical_label(GraphContainer(x.get_connected()))
+		self.assertEqual(G.count_symmetries(),math.factorial(12))
+
+	@parameterized.expand(graphs)
+	def test_refinement_trail(self,name,g,nsyms):
+		# refining in place and undoing the trail restores the partition
+		g = CompactGraph(g)
+		partition = group_by_certificate(g.initial_certificate,range(len(g)))
+		cells = list(partition)
+		trail = []
+		refine_partition(partition,g,trail)
+		undo([partition],[trail],[0])
+		self.assertEqual(partition,cells)
+		self.assertTrue(all(x is y for x,y in zip(partition,cells)))
+
+	@parameterized.expand(graphs)
+	def test_splitter_queue(self,name,g,nsyms):
+		# refining from the elements of a split cell gives the same partition as recertifying every cell
+		g = CompactGraph(g)
+		partition = initialize_partition(g)
+		idx = first_nontrivial_cell([partition])
+		if idx is None:
+			return
+		cell = partition[idx]
+		partition[idx:idx+1] = [cell[-1:],cell[:-1]]
+		p1, p2 = list(partition), list(partition)
+		refine_partition(p1,g,changed=set(cell))
+		refine_partition(p2,g)
+		self.assertEqual(p1,p2)
+
+	@parameterized.expand(graphs)
+	def test_compact_graph(self,name,g,nsyms):
+		c = CompactGraph(g)
+		self.assertEqual(c.names,sorted(g.keys()))
+		self.assertEqual(len(c.targets),sum(g[x].degree() for x in c.names))
+		# the canonical form built from the compact graph is the one built from the nodes
+		m,L,G = canonical_label(g)
+		order = tuple(m.get(x) for x in L.names)
+		mapping = m.reverse()
+		self.assertEqual(c.canonical_form([c.names.index(x) for x in order],mapping),CanonicalForm.create(g,order,mapping))
+
+class Q(BaseClass):
+	v = IntegerAttribute()
+
+class TestCanonicalLabelCache(unittest.TestCase):
+	@parameterized.expand(graphs)
+	def test_graph(self,name,g,nsyms):
+		m0,L0,G0 = canonical_label(g)
+		cache = CanonicalLabelCache()
+		# g with variables renamed in a different order
+		keys = g.keys()
+		g1 = g.duplicate(varmap=dict(zip(keys,[f'{x}_1' for x in reversed(keys)])))
+		for x in [g,g,g1]:
+			m,L,G = cache.label(x)
+			# same canonical form, and a mapping that recapitulates x
+			self.assertEqual(L,L0)
+			self.assertEqual(G.expand(),G0.expand())
+			self.assertEqual(set(L.build_graph_container(m).iter_edges()),set(x.iter_edges()))
+		self.assertEqual((cache.hits,cache.misses),(2,1))
+
+	def test_eviction(self):
+		cache = CanonicalLabelCache(maxsize=2)
+		gs = [g for _,g,_ in graphs]
+		for g in gs[:3] + gs[:1]:
+			cache.label(g)
+		self.assertEqual(cache.stats,dict(hits=0,misses=4,collisions=0,evictions=2,size=2))
+		cache.label(gs[2])
+		self.assertEqual((cache.hits,cache.size),(1,2))
+
+	def test_hash_collision(self):
+		# hash(-1) == hash(-2), so these graphs have the same colors and WL hash
+		g1, g2 = GraphContainer([Q('a',v=-1)]), GraphContainer([Q('b',v=-2)])
+		cache = CanonicalLabelCache()
+		for g in [g1,g2,g2]:
+			self.assertEqual(cache.label(g)[1],canonical_label(g)[1])
+		self.assertEqual(cache.stats,dict(hits=1,misses=2,collisions=1,evictions=0,size=2))
+		self.assertEqual([L for _,L,_ in canonical_label_many([g1,g2,g1],max_workers=0)],[canonical_label(g)[1] for g in [g1,g2,g1]])
+
+	@parameterized.expand([(0,),(2,)])
+	def test_many(self,max_workers):
+		gs = [g for _,g,_ in graphs]
+		# each graph, and a copy with variables renamed
+		copies = [g.duplicate(varmap={x:f'{x}_1' for x in g.keys()}) for g in gs]
+		cache = CanonicalLabelCache()
+		results = canonical_label_many(gs + copies,max_workers=max_workers,cache=cache)
+		for x,(m,L,G) in zip(gs + copies,results):
+			m0,L0,G0 = canonical_label(x)
+			self.assertEqual(L,L0)
+			self.assertEqual(G.expand(),G0.expand())
+			self.assertEqual(set(L.build_graph_container(m).iter_edges()),set(x.iter_edges()))
+		# only the distinct forms were labeled
+		self.assertEqual(cache.size,len(set(L for _,L,_ in results)))
+		self.assertEqual(cache.size,len(gs))
+		# a second batch is resolved from the cache
+		canonical_label_many(copies,max_workers=max_workers,cache=cache)
+		self.assertEqual(cache.size,len(gs))
@@ -4,6 +4,8 @@ from wc_rules.schema.attributes import BooleanAttribute
 from wc_rules.modeling.pattern import GraphContainer, Pattern
 from wc_rules.modeling.rule import Rule, InstanceRateRule
 from wc_rules.modeling.model import RuleBasedModel, AggregateModel
+from wc_rules.modeling.subpatterns import find_common_subpatterns
+from wc_rules.graph.graph_partitioning import recompose
 from wc_rules.utils.validate import validate_list
 
 import unittest
@@ -124,3 +126,33 @@ class TestRuleBasedModel(unittest.TestCase):
 
 		data = dict(kcat=2.0,KM=2.0)
 		model.verify(data)
+
+class TestCommonSubpatterns(unittest.TestCase):
+
+	def test_aggregate_model(self):
+		model = AggregateModel('enzyme_models',models=[
+			ExplicitMichaelisMentenModel('explicit_MM',make_enzyme(),make_substrate()),
+			ImplicitMichaelisMentenModel('implicit_MM',make_enzyme(),make_substrate())
+			])
+		dag = find_common_subpatterns(model)
+		self.assertEqual(len(dag.reactants),5)
+		# the enzyme and substrate graphs, the complex, and the bond with and without the substrate
+		self.assertEqual(sorted(x.size for x in dag.nodes.values()),[1,1,1,2,3])
+
+		# the complex and both molecules are shared
+		complex_uses = {(('explicit_MM','unbinding_rule'),'enzyme_substrate_complex'),(('explicit_MM','catalytic_rule'),'enzyme_substrate_complex')}
+		maximal = dag.maximal_shared()
+		self.assertEqual(len(dag.shared()),5)
+		self.assertEqual([x.size for x in maximal],[3,1,1])
+		self.assertEqual(maximal[0].uses,complex_uses)
+		self.assertEqual(sorted(len(x.uses) for x in maximal[1:]),[3,4])
+		self.assertEqual(len(dag.shared(min_uses=4)),1)
+
+		# children precede parents and halves recompose into their parent
+		order = [x.form for x in dag.iter_topological()]
+		for node in dag.nodes.values():
+			for m,form in node.children:
+				self.assertLess(order.index(form),order.index(node.form))
+			if node.children:
+				(m1,L1),(m2,L2) = node.children
+				self.assertEqual(recompose(m1,L1,m2,L2)[1],node.form)
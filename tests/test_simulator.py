@@ -0,0 +1,1119 @@
+from wc_rules.schema.chem import Molecule, Site
+from wc_rules.schema.base import BaseClass
+from wc_rules.schema.attributes import BooleanAttribute
+from wc_rules.graph.collections import GraphContainer
+from wc_rules.modeling.pattern import Pattern
+from wc_rules.modeling.rule import Rule, InstanceRateRule
+from wc_rules.modeling.model import RuleBasedModel, AggregateModel
+from wc_rules.matcher.matcher import PatternMatcher, MatchSet, get_helper_matches
+from wc_rules.matcher.rete import ReteRule, ReteMatchSet, get_network
+from wc_rules.matcher.edges import EdgeIndex
+from wc_rules.simulator.simulator import SimulationState
+from wc_rules.schema.actions import SetAttr, AddEdge, RemoveEdge, AddNode, RemoveNode
+from wc_rules.simulator.ssa import DirectMethodSimulator, flatten_actions
+from wc_rules.simulator.scheduler import IndexedPriorityQueue, RuleDependencyGraph, NextReactionSimulator
+from wc_rules.simulator.rssa import RejectionSimulator, CandidatePool
+from wc_rules.simulator.tauleap import TauLeapingSimulator, is_leapable, take_disjoint
+from wc_rules.simulator.ensemble import Ensemble, P2Quantile
+from wc_rules.simulator.checkpoint import checkpoint, restore
+from wc_rules.simulator.recorder import Recorder, PatternCount, AttributeSum, ComplexSizeHistogram, load_recording
+from wc_rules.simulator.observables import ObservableRegistry, LivePatternCount, LiveAttributeSum
+from wc_rules.simulator.local import LocalRule
+from wc_rules.utils.random import generate_id
+from functools import partial
+import numpy as np
+import math, random, io, os, tempfile, gc, weakref
+import unittest
+
+class Lig(Molecule):
+	pass
+
+class Rec(Molecule):
+	pass
+
+class LigSite(Site):
+	pass
+
+class RecSite(Site):
+	active = BooleanAttribute()
+
+def build_patterns():
+	lig = Pattern(GraphContainer(Lig('lig',sites=[LigSite('s')]).get_connected()),constraints=['len(s.bond)==0'])
+	rec = Pattern(GraphContainer(Rec('rec',sites=[RecSite('s')]).get_connected()),constraints=['len(s.bond)==0'])
+	bound = Pattern(GraphContainer(LigSite('ls',bond=RecSite('rs')).get_connected()))
+	return lig,rec,bound
+
+def build_model(kf=1.0,kr=0.0):
+	lig,rec,bound = build_patterns()
+	binding = InstanceRateRule(
+		name = 'binding',
+		reactants = {'L':lig,'R':rec},
+		actions = ['L.s.add_bond(R.s)'],
+		rate_prefix = 'kf',
+		parameters = ['kf']
+		)
+	unbinding = InstanceRateRule(
+		name = 'unbinding',
+		reactants = {'B':bound},
+		actions = ['B.ls.remove_bond()'],
+		rate_prefix = 'kr',
+		parameters = ['kr']
+		)
+	model = RuleBasedModel('binding_model',rules=[binding,unbinding])
+	model.defaults = {'kf':kf,'kr':kr}
+	return model
+
+def build_release_model():
+	# release reads the partner of its only node, which activation changes
+	activation = Rule(
+		name = 'activation',
+		reactants = {'R':Pattern(GraphContainer([RecSite('s')]),constraints=['s.active == False'])},
+		actions = ['R.s.setTrue_active()'],
+		rate_prefix = 'ka',
+		parameters = ['ka']
+		)
+	release = Rule(
+		name = 'release',
+		reactants = {'L':Pattern(GraphContainer([LigSite('s')]),constraints=['len(s.bond)==1','s.bond.active == True'])},
+		actions = ['L.s.remove_bond()'],
+		rate_prefix = 'kr',
+		parameters = ['kr']
+		)
+	model = RuleBasedModel('release_model',rules=[activation,release])
+	model.defaults = {'ka':1.0,'kr':1.0}
+	return model
+
+def build_bonded_state(n):
+	sim = build_state(n,n)
+	for i in range(n):
+		sim.resolve(f'lig{i}_s').safely_add_edge('bond',sim.resolve(f'rec{i}_s'))
+		sim.resolve(f'rec{i}_s').active = False
+	return sim
+
+def build_state(nl,nr):
+	nodes = []
+	for i in range(nl):
+		nodes.extend(Lig(f'lig{i}',sites=[LigSite(f'lig{i}_s')]).get_connected())
+	for i in range(nr):
+		nodes.extend(Rec(f'rec{i}',sites=[RecSite(f'rec{i}_s')]).get_connected())
+	return SimulationState(nodes)
+
+def count_bonds(sim):
+	return sum(1 for x in sim.state.values() if isinstance(x,LigSite) and x.bond is not None)
+
+def equilibrium_bonds(nl,nr,kf,kr):
+	# mean number of bonds at equilibrium from detailed balance
+	weights = [1.0]
+	for n in range(min(nl,nr)):
+		weights.append(weights[-1]*(nl-n)*(nr-n)*kf/((n+1)*kr))
+	return sum(n*w for n,w in enumerate(weights))/sum(weights)
+
+def time_averaged_bonds(ssa,nevents):
+	total = 0.0
+	for i in range(nevents):
+		t, n = ssa.time, count_bonds(ssa.state)
+		ssa.run(max_events=1)
+		total += n*(ssa.time-t)
+	return total/ssa.time
+
+class TestMatcher(unittest.TestCase):
+
+	def test_match_counts(self):
+		lig,rec,bound = build_patterns()
+		sim = build_state(5,3)
+		self.assertEqual(PatternMatcher(lig).count(sim),5)
+		self.assertEqual(PatternMatcher(rec).count(sim),3)
+		self.assertEqual(PatternMatcher(bound).count(sim),0)
+
+		sim.resolve('lig0_s').safely_add_edge('bond',sim.resolve('rec0_s'))
+		self.assertEqual(PatternMatcher(lig).count(sim),4)
+		self.assertEqual(PatternMatcher(rec).count(sim),2)
+		matches = list(PatternMatcher(bound).iter_matches(sim))
+		self.assertEqual([(m['ls'].id,m['rs'].id) for m in matches],[('lig0_s','rec0_s')])
+
+	def test_symmetric_pattern(self):
+		# each embedding of a symmetric pattern is a separate match
+		g = GraphContainer(Lig('lig',sites=[LigSite('s1'),LigSite('s2')]).get_connected())
+		sim = SimulationState(Lig('x',sites=[LigSite('y1'),LigSite('y2')]).get_connected())
+		self.assertEqual(PatternMatcher(Pattern(g)).count(sim),2)
+
+	def test_literal_attributes_and_seeds(self):
+		p = Pattern(GraphContainer([RecSite('s',active=True)]))
+		sim = SimulationState([RecSite('a',active=True),RecSite('b',active=False),RecSite('c')])
+		m = PatternMatcher(p)
+		self.assertEqual([x['s'].id for x in m.iter_matches(sim)],['a'])
+		self.assertEqual(len(list(m.iter_matches(sim,seed={'s':sim.resolve('b')}))),0)
+
+	def test_helpers_and_params(self):
+		active = Pattern(GraphContainer([RecSite('s',active=True)]))
+		p = Pattern(
+			GraphContainer([RecSite('x')]),
+			helpers = {'h':active},
+			params = ['v'],
+			constraints = ['h.contains(s=x) == v']
+			)
+		sim = SimulationState([RecSite('a',active=True),RecSite('b',active=False)])
+		m = PatternMatcher(p)
+		self.assertEqual([x['x'].id for x in m.iter_matches(sim,{'v':True})],['a'])
+		self.assertEqual([x['x'].id for x in m.iter_matches(sim,{'v':False})],['b'])
+		self.assertEqual(MatchSet(m,sim,{'v':True}).count(),1)
+
+	def test_symmetry_breaking(self):
+		dimer = Pattern(GraphContainer(Lig('lig',sites=[LigSite('s1'),LigSite('s2')]).get_connected()))
+		chain = Pattern(GraphContainer(Rec('r',sites=[RecSite('b',bond=LigSite('a')),RecSite('c',bond=LigSite('d'))]).get_connected()))
+		nodes = []
+		for i in range(3):
+			nodes.extend(Lig(f'x{i}',sites=[LigSite(f'x{i}_{j}') for j in range(3)]).get_connected())
+		sim = SimulationState(nodes)
+		m, naive = PatternMatcher(dimer,symmetry_breaking=True), PatternMatcher(dimer)
+		self.assertEqual((m.symmetries,len(m.automorphisms),len(m.orderings)),(2,2,1))
+		self.assertEqual(set(m.orderings[0]),{'s1','s2'})
+		self.assertEqual(sum(1 for _ in m.iter_matches(sim)),9)
+		self.assertEqual(m.count(sim),naive.count(sim))
+		matches = MatchSet(m,sim)
+		key = lambda x: (x['lig'].id,x['s1'].id,x['s2'].id)
+		self.assertEqual(sorted(map(key,matches)),sorted(map(key,naive.iter_matches(sim))))
+		self.assertEqual(len(set(map(key,matches.sample(18,random.Random(0))))),18)
+		self.assertTrue(matches.contains(s1=sim.resolve('x0_2'),s2=sim.resolve('x0_0')))
+
+		# constrained variables are not permuted
+		constrained = Pattern(dimer.parent,constraints=['len(s1.bond)==0'])
+		self.assertEqual(PatternMatcher(constrained,symmetry_breaking=True).symmetries,1)
+		# a pattern with a symmetric complex
+		sim = SimulationState(Lig('y',sites=[LigSite('y1')]).get_connected())
+		for i in range(2):
+			for x in Rec(f'r{i}',sites=[RecSite(f'r{i}_a',bond=LigSite(f'l{i}_a')),RecSite(f'r{i}_b',bond=LigSite(f'l{i}_b'))]).get_connected():
+				sim.update(x)
+		self.assertEqual(PatternMatcher(chain,symmetry_breaking=True).symmetries,2)
+		self.assertEqual(PatternMatcher(chain,symmetry_breaking=True).count(sim),PatternMatcher(chain).count(sim))
+		self.assertEqual(PatternMatcher(chain).count(sim),4)
+
+	def test_counting_without_matches(self):
+		lig,rec,bound = build_patterns()
+		sim = build_state(8,5)
+		for i in range(3):
+			sim.resolve(f'lig{i}_s').safely_add_edge('bond',sim.resolve(f'rec{i}_s'))
+		m = PatternMatcher(lig)
+		self.assertEqual([len(c) for c in m.local_constraints.values()],[0,1])
+		self.assertEqual(m.remaining_constraints,[])
+		self.assertEqual([PatternMatcher(p).count(sim) for p in [lig,rec,bound]],[5,2,3])
+
+		matches = MatchSet(m,sim)
+		self.assertEqual(matches.count(),5)
+		self.assertIsNone(matches._matches)
+		# sampling draws the same matches as sampling from the list of matches
+		sample = [x['lig'].id for x in matches.sample(3,random.Random(1))]
+		self.assertIsNone(matches._matches)
+		self.assertEqual(sample,[x['lig'].id for x in random.Random(1).sample(MatchSet(m,sim).matches,3)])
+		listed = MatchSet(m,sim)
+		listed.matches
+		self.assertEqual(sample,[x['lig'].id for x in listed.sample(3,random.Random(1))])
+
+		# remaining constraints are checked on complete matches
+		p = Pattern(bound,constraints=['rs.active == ls.bond.active'])
+		self.assertEqual(len(PatternMatcher(p).remaining_constraints),1)
+		self.assertEqual(PatternMatcher(p).count(sim),3)
+
+	def test_search_plans(self):
+		g = GraphContainer(Rec('rec',sites=[RecSite('s',bond=LigSite('l',molecule=Lig('lig')))]).get_connected())
+		m = PatternMatcher(Pattern(g))
+		sim = build_state(20,3)
+		# rec and s are tied
+		order = [x.variable for x in m.get_plan(sim)]
+		self.assertEqual((set(order[:2]),order[2:]),({'rec','s'},['l','lig']))
+		plan = m.get_plan(sim)
+		for x in Rec('extra',sites=[RecSite('extra_s')]).get_connected():
+			sim.update(x)
+		self.assertIs(m.get_plan(sim),plan)
+
+		# estimates drift, the plan starts from the rarest node
+		sim = build_state(3,20)
+		for i in range(3):
+			sim.resolve(f'lig{i}_s').safely_add_edge('bond',sim.resolve(f'rec{i}_s'))
+		order = [x.variable for x in m.get_plan(sim)]
+		self.assertEqual((set(order[:2]),order[2:]),({'lig','l'},['s','rec']))
+		self.assertEqual(m.count(sim),3)
+		self.assertEqual(len(list(m.iter_matches(sim,seed={'rec':sim.resolve('rec0')}))),1)
+
+	def test_generated_code(self):
+		lig,rec,bound = build_patterns()
+		active = Pattern(GraphContainer([RecSite('s',active=True)]))
+		patterns = [
+			lig, rec, bound, active,
+			Pattern(GraphContainer(Lig('lig',sites=[LigSite('s1'),LigSite('s2')]).get_connected())),
+			Pattern(bound,helpers={'h':active},params=['v'],constraints=['h.contains(s=rs) == v','n = len(ls.molecule.sites)']),
+			]
+		sim = build_state(6,6)
+		for x in Lig('dimer',sites=[LigSite('d1'),LigSite('d2')]).get_connected():
+			sim.update(x)
+		for i in range(4):
+			sim.resolve(f'lig{i}_s').safely_add_edge('bond',sim.resolve(f'rec{i}_s'))
+			sim.resolve(f'rec{i}_s').active = i % 2 == 0
+		for p in patterns:
+			for symmetry_breaking in [False,True]:
+				m = PatternMatcher(p,symmetry_breaking)
+				m.compiled = False
+				expected = list(m.iter_matches(sim,{'v':True}))
+				m.compiled = True
+				self.assertEqual(list(m.iter_matches(sim,{'v':True})),expected)
+				self.assertEqual(m.count_representatives(sim,{'v':True}),len(expected))
+		m = PatternMatcher(patterns[-1])
+		self.assertEqual([(x['ls'].id,x['n']) for x in m.iter_matches(sim,{'v':True})],[('lig0_s',1),('lig2_s',1)])
+		self.assertIn('for s in lig.sites:',PatternMatcher(lig).get_compiled(PatternMatcher(lig).get_steps('lig')).source)
+
+	def test_helper_cache(self):
+		active1 = Pattern(GraphContainer([RecSite('s',active=True)]))
+		active2 = Pattern(GraphContainer([RecSite('x',active=True)]))
+		inactive = Pattern(GraphContainer([RecSite('s',active=False)]))
+		# canonically identical up to variable names and the order of symmetric variables
+		lig1 = Pattern(GraphContainer(Lig('lig',sites=[LigSite('s1'),LigSite('s2')]).get_connected()),constraints=['len(s1.bond)==0'])
+		lig2 = Pattern(GraphContainer(Lig('m',sites=[LigSite('a'),LigSite('b')]).get_connected()),constraints=['len(b.bond)==0'])
+		lig3 = Pattern(GraphContainer(Lig('m',sites=[LigSite('a'),LigSite('b')]).get_connected()),constraints=['len(m.sites)==0'])
+		keys = [PatternMatcher(p).key for p in [active1,active2,inactive,lig1,lig2,lig3]]
+		self.assertEqual((keys[0]==keys[1],keys[0]==keys[2]),(True,False))
+		self.assertEqual((keys[3]==keys[4],keys[3]==keys[5]),(True,False))
+
+		sim = build_state(3,3)
+		m1 = PatternMatcher(Pattern(GraphContainer([RecSite('x')]),helpers={'h':active1},constraints=['h.contains(s=x) == True']))
+		m2 = PatternMatcher(Pattern(GraphContainer([RecSite('y')]),helpers={'g':active2},constraints=['g.count() > 0']))
+		h1 = get_helper_matches(m1.helpers,sim,{})['h']
+		h2 = get_helper_matches(m2.helpers,sim,{})['g']
+		self.assertIs(h2.matchset,h1)
+		self.assertEqual((m1.count(sim),m2.count(sim),h1.count()),(0,0,0))
+		self.assertEqual((sim.helper_cache.hits,sim.helper_cache.misses),(3,1))
+		# touching a Lig leaves the entry valid, touching a RecSite rebuilds it
+		sim.push_to_stack(AddNode.make(Lig,'lig9')).simulate()
+		self.assertIs(get_helper_matches(m1.helpers,sim,{})['h'],h1)
+		sim.push_to_stack(SetAttr.make(sim.resolve('rec0_s'),'active',True)).simulate()
+		h3 = get_helper_matches(m1.helpers,sim,{})['h']
+		self.assertIsNot(h3,h1)
+		self.assertEqual((m1.count(sim),m2.count(sim),h3.count()),(1,3,1))
+
+	def test_helper_renaming(self):
+		# helpers that differ only in variable names share a match set, queried through their own variables
+		nodes = Rec('rec0',sites=[RecSite('rec0_s',active=True,bond=LigSite('lig0_s',molecule=Lig('lig0')))]).get_connected()
+		nodes += Rec('rec1',sites=[RecSite('rec1_s',active=False)]).get_connected()
+		active = [Pattern(GraphContainer([RecSite(v,active=True)])) for v in ['a','b']]
+		bound = [Pattern(GraphContainer(LigSite('ls',bond=RecSite('rs')).get_connected())),Pattern(GraphContainer(LigSite('rs',bond=RecSite('ls')).get_connected()))]
+		pairs = [
+			[Pattern(GraphContainer([RecSite('x')]),helpers={'h':active[0]},constraints=['h.contains(a=x) == True']),
+			Pattern(GraphContainer([RecSite('x')]),helpers={'h':active[1]},constraints=['h.contains(b=x) == True'])],
+			[Pattern(GraphContainer([RecSite('x')]),helpers={'h':bound[0]},constraints=['h.contains(rs=x) == True']),
+			Pattern(GraphContainer([RecSite('x')]),helpers={'h':bound[1]},constraints=['h.contains(ls=x) == True'])],
+			]
+		for pair in pairs:
+			for order in [pair,pair[::-1]]:
+				sim = SimulationState(nodes)
+				for p in order:
+					m = PatternMatcher(p)
+					self.assertEqual([x['x'].id for x in m.iter_matches(sim)],['rec0_s'])
+				self.assertEqual((sim.helper_cache.hits > 0,sim.helper_cache.misses),(True,1))
+		h = get_helper_matches(PatternMatcher(pairs[0][1]).helpers,sim,{})['h']
+		self.assertEqual([x['b'].id for x in h.matches],['rec0_s'])
+		with self.assertRaises(AssertionError):
+			h.contains(a=sim.resolve('rec0_s'))
+
+	def test_edge_index(self):
+		lig,rec,bound = build_patterns()
+		g = GraphContainer(Rec('rec',sites=[RecSite('s',bond=LigSite('l',molecule=Lig('lig')))]).get_connected())
+		active = Pattern(GraphContainer(LigSite('ls',bond=RecSite('rs',active=True)).get_connected()))
+		matchers = [PatternMatcher(p) for p in [lig,rec,bound,Pattern(g),active]]
+		index = EdgeIndex(matchers)
+		self.assertEqual([len(index.types[m]) for m in matchers],[1,1,1,3,1])
+		self.assertEqual(len(index.occurrences),3)
+
+		sim = build_state(3,3)
+		sim.resolve('rec0_s').active = True
+		for j,expected in [(0,[2,3,4]),(1,[2,3])]:
+			action = AddEdge.make(sim.resolve(f'lig{j}_s'),'bond',sim.resolve(f'rec{j}_s'))
+			sim.push_to_stack(action).simulate()
+			self.assertEqual(sorted(matchers.index(m) for m in index.get_patterns(sim,action)),[2,3,4])
+			found = sorted((matchers.index(m),x[m.variables[0]].id) for m,x in index.iter_new_matches(sim,action))
+			self.assertEqual([i for i,_ in found],expected)
+		# the edge index finds the same matches as a full search
+		self.assertEqual(sum(1 for m,_ in index.iter_new_matches(sim,action) if m is matchers[3]),1)
+		self.assertEqual(matchers[3].count(sim),2)
+
+class TestDirectMethod(unittest.TestCase):
+
+	def test_flatten_actions(self):
+		self.assertEqual(flatten_actions([1,[2,[3,4]],[],5]),[1,2,3,4,5])
+
+	def test_irreversible_binding(self):
+		sim = build_state(10,4)
+		ssa = DirectMethodSimulator(build_model(),sim)
+		self.assertEqual(ssa.propensities,[40.0,0.0])
+		ssa.run()
+		self.assertEqual(ssa.nevents,4)
+		self.assertEqual(count_bonds(sim),4)
+		self.assertEqual(ssa.total,0)
+		self.assertEqual(ssa.propensities,[0.0,0.0])
+
+	def test_reversible_binding(self):
+		sim = build_state(10,4)
+		ssa = DirectMethodSimulator(build_model(1.0,2.0),sim,seed=1).run(end_time=5.0)
+		self.assertEqual(ssa.time,5.0)
+		nbonds = count_bonds(sim)
+		self.assertEqual(ssa.propensities,[(10-nbonds)*(4-nbonds)*1.0,nbonds*2.0])
+		self.assertAlmostEqual(ssa.total,sum(ssa.propensities))
+
+		# same seed must give the same trajectory
+		sim2 = build_state(10,4)
+		ssa2 = DirectMethodSimulator(build_model(1.0,2.0),sim2,seed=1).run(end_time=5.0)
+		self.assertEqual(ssa.nevents,ssa2.nevents)
+		self.assertEqual(sim.get_contents(),sim2.get_contents())
+
+	def test_max_events(self):
+		ssa = DirectMethodSimulator(build_model(1.0,1.0),build_state(10,4)).run(max_events=7)
+		self.assertEqual(ssa.nevents,7)
+
+	def test_aggregate_model(self):
+		model = AggregateModel('top',models=[build_model()])
+		ssa = DirectMethodSimulator(model,build_state(3,3),parameters={'binding_model':{'kf':1.0,'kr':0.0}})
+		self.assertEqual([r.name for r in ssa.rules],['binding_model.binding','binding_model.unbinding'])
+		ssa.run()
+		self.assertEqual(count_bonds(ssa.state),3)
+
+	def test_rollback_and_terminate(self):
+		lig,rec,bound = build_patterns()
+		rollback_rule = Rule(
+			name = 'bind_then_rollback',
+			reactants = {'L':lig,'R':rec},
+			actions = ['L.s.add_bond(R.s)','rollback(True)'],
+			rate_prefix = 'k',
+			parameters = ['k']
+			)
+		model = RuleBasedModel('rollback_model',rules=[rollback_rule])
+		sim = build_state(2,2)
+		ssa = DirectMethodSimulator(model,sim,parameters={'k':1.0}).run(max_events=5)
+		self.assertEqual(ssa.nevents,5)
+		self.assertEqual(count_bonds(sim),0)
+
+		terminate_rule = Rule(
+			name = 'bind_then_terminate',
+			reactants = {'L':lig,'R':rec},
+			actions = ['L.s.add_bond(R.s)','terminate(True)'],
+			rate_prefix = 'k',
+			parameters = ['k']
+			)
+		model = RuleBasedModel('terminate_model',rules=[terminate_rule])
+		sim = build_state(2,2)
+		ssa = DirectMethodSimulator(model,sim,parameters={'k':1.0}).run()
+		self.assertEqual(ssa.nevents,1)
+		self.assertEqual(count_bonds(sim),1)
+
+	def test_chained_constraints(self):
+		sim = build_bonded_state(3)
+		ssa = DirectMethodSimulator(build_release_model(),sim,seed=1)
+		reference = DirectMethodSimulator(build_release_model(),sim)
+		while ssa.total > 0:
+			ssa.run(max_events=1)
+			self.assertEqual(ssa.propensities,[r.update(sim).propensity for r in reference.rules])
+		self.assertEqual(count_bonds(sim),0)
+
+class TestNextReactionMethod(unittest.TestCase):
+
+	def test_indexed_priority_queue(self):
+		rng = random.Random(0)
+		times = [rng.random() for i in range(20)]
+		q = IndexedPriorityQueue(times)
+		for k in range(200):
+			i, t = rng.randrange(20), rng.choice([rng.random(),math.inf])
+			q.update(i,t)
+			times[i] = t
+			self.assertEqual(q.top()[1],min(times))
+			self.assertEqual(q.times[q.top()[0]],min(times))
+			self.assertTrue(all(q.heap[q.pos[j]]==j for j in range(20)))
+
+	def test_dependency_graph(self):
+		lig,rec,bound = build_patterns()
+		activation = Rule(
+			name = 'activation',
+			reactants = {'R':Pattern(GraphContainer([RecSite('s')]),constraints=['s.active == False'])},
+			actions = ['R.s.setTrue_active()'],
+			rate_prefix = 'ka',
+			parameters = ['ka']
+			)
+		model = build_model()
+		model = RuleBasedModel('model',rules=model.rules + [activation])
+		ssa = NextReactionSimulator(model,build_state(2,2),parameters={'kf':1.0,'kr':1.0,'ka':1.0})
+		# binding and unbinding change bonds and affect each other, but not activation
+		# activation changes RecSite.active and affects only itself
+		self.assertEqual(ssa.graph.dependents,[[0,1],[0,1],[2]])
+
+		conservative = Rule(
+			name = 'conservative',
+			reactants = {'R':rec},
+			actions = ['R.s.unknown_action()'],
+			rate_prefix = 'k',
+			parameters = ['k']
+			)
+		graph = NextReactionSimulator(RuleBasedModel('model',rules=[activation,conservative]),build_state(1,1),parameters={'k':1.0,'ka':1.0}).graph
+		self.assertEqual(graph.dependents,[[0],[0,1]])
+
+	def test_irreversible_binding(self):
+		sim = build_state(10,4)
+		ssa = NextReactionSimulator(build_model(),sim).run()
+		self.assertEqual(ssa.nevents,4)
+		self.assertEqual(count_bonds(sim),4)
+		self.assertEqual(ssa.queue.top()[1],math.inf)
+
+	def test_reversible_binding(self):
+		sim = build_state(10,4)
+		ssa = NextReactionSimulator(build_model(1.0,2.0),sim,seed=2).run(end_time=5.0)
+		self.assertEqual(ssa.time,5.0)
+		self.assertGreater(ssa.nevents,10)
+		nbonds = count_bonds(sim)
+		self.assertEqual(ssa.propensities,[(10-nbonds)*(4-nbonds)*1.0,nbonds*2.0])
+		self.assertTrue(all(t > 5.0 for t in ssa.queue.times))
+
+	def test_chained_constraints(self):
+		sim = build_bonded_state(3)
+		ssa = NextReactionSimulator(build_release_model(),sim,seed=1)
+		# activation changes what release reads through s.bond
+		self.assertEqual(ssa.graph.dependents,[[0,1],[1]])
+		reference = DirectMethodSimulator(build_release_model(),sim)
+		while ssa.queue.top()[1] < math.inf:
+			ssa.run(max_events=1)
+			self.assertEqual(ssa.propensities,[r.update(sim).propensity for r in reference.rules])
+		self.assertEqual(count_bonds(sim),0)
+
+class TestRejectionSSA(unittest.TestCase):
+
+	def test_irreversible_binding(self):
+		sim = build_state(10,4)
+		ssa = RejectionSimulator(build_model(),sim).run()
+		self.assertEqual(ssa.nevents,4)
+		self.assertEqual(count_bonds(sim),4)
+		self.assertEqual(ssa.total,0)
+
+	def test_absorbing_state(self):
+		# the last binding leaves every pattern count inside its interval,
+		# the rejected rules are rebounded to zero and the run ends
+		sim = build_state(3,3)
+		ssa = RejectionSimulator(build_model(1.0,0.0),sim).run()
+		self.assertEqual((count_bonds(sim),ssa.nevents,ssa.total),(3,3,0))
+		self.assertEqual(ssa.upper,[0.0,0.0])
+
+	def test_bounds(self):
+		sim = build_state(10,4)
+		ssa = RejectionSimulator(build_model(1.0,2.0),sim,seed=3).run(max_events=50)
+		for rule,lo,hi in zip(ssa.rules,ssa.lower,ssa.upper):
+			exact = rule.compute_propensity()
+			self.assertTrue(lo <= exact <= hi)
+			# pools hold exactly the valid matches once validated
+			for r,pool in rule.matches.items():
+				self.assertEqual(pool.count(),rule.reactants[r].count(sim))
+		self.assertGreaterEqual(ssa.ntrials,ssa.nevents)
+
+	def test_equilibrium(self):
+		expected = equilibrium_bonds(10,4,1.0,5.0)
+		ssa = RejectionSimulator(build_model(1.0,5.0),build_state(10,4),seed=1)
+		self.assertAlmostEqual(time_averaged_bonds(ssa,2000),expected,delta=0.15)
+
+	def test_chained_constraints(self):
+		sim = build_bonded_state(3)
+		ssa = RejectionSimulator(build_release_model(),sim,seed=1)
+		while ssa.total > 0:
+			ssa.run(max_events=1)
+			for rule,lo,hi in zip(ssa.rules,ssa.lower,ssa.upper):
+				self.assertTrue(lo <= rule.compute_propensity() <= hi)
+		self.assertEqual(count_bonds(sim),0)
+
+class TestTauLeaping(unittest.TestCase):
+
+	def test_low_copy_rules_are_exact(self):
+		sim = build_state(10,4)
+		ssa = TauLeapingSimulator(build_model(),sim).run()
+		self.assertEqual(ssa.nleaps,0)
+		self.assertEqual(ssa.nevents,4)
+		self.assertEqual(count_bonds(sim),4)
+
+	def test_terminate_on_last_exact_step(self):
+		lig,rec,bound = build_patterns()
+		terminate_rule = Rule(
+			name = 'bind_then_terminate',
+			reactants = {'L':lig,'R':rec},
+			actions = ['L.s.add_bond(R.s)','terminate(True)'],
+			rate_prefix = 'k',
+			parameters = ['k']
+			)
+		model = RuleBasedModel('terminate_model',rules=[terminate_rule])
+		sim = build_state(2,2)
+		ssa = TauLeapingSimulator(model,sim,parameters={'k':1.0})
+		# the terminating firing is the last of a run of exact steps
+		ssa.ssa_steps = 1
+		ssa.run()
+		self.assertEqual((ssa.nevents,ssa.terminated,count_bonds(sim)),(1,True,1))
+
+	def test_leapable(self):
+		lig,rec,bound = build_patterns()
+		rollback_rule = Rule(
+			name = 'bind_then_rollback',
+			reactants = {'L':lig,'R':rec},
+			actions = ['L.s.add_bond(R.s)','rollback(True)'],
+			rate_prefix = 'k',
+			parameters = ['k']
+			)
+		model = RuleBasedModel('model',rules=build_model().rules + [rollback_rule])
+		ssa = TauLeapingSimulator(model,build_state(2,2),parameters={'kf':1.0,'kr':1.0,'k':1.0})
+		self.assertEqual([is_leapable(r) for r in ssa.rules],[True,True,False])
+
+	def test_take_disjoint(self):
+		sim = build_state(3,1)
+		lig,rec,bound = build_patterns()
+		sim.resolve('lig0_s').safely_add_edge('bond',sim.resolve('rec0_s'))
+		matches = list(PatternMatcher(Pattern(GraphContainer([LigSite('s')]))).iter_matches(sim))
+		# lig0_s neighbors rec0_s
+		reserved = {'rec0_s'}
+		chosen = take_disjoint(iter(matches),2,reserved)
+		self.assertEqual(sorted(m['s'].id for m in chosen),['lig1_s','lig2_s'])
+		self.assertIsNone(take_disjoint(iter(matches),1,reserved))
+
+	def test_lazy_sampling(self):
+		lig,rec,bound = build_patterns()
+		g = GraphContainer(Rec('rec',sites=[RecSite('s',bond=LigSite('l',molecule=Lig('lig')))]).get_connected())
+		# rec.sites is to-many, but every variable is reached from s or l over to-one attributes
+		self.assertEqual([PatternMatcher(p).sampling_root for p in [lig,rec,bound,Pattern(g)]],['s','s','ls','s'])
+		two_sites = Pattern(GraphContainer(Lig('lig',sites=[LigSite('s1'),LigSite('s2')]).get_connected()))
+		self.assertIsNone(PatternMatcher(two_sites).sampling_root)
+
+		sim = build_state(20,10)
+		for i in range(5):
+			sim.resolve(f'lig{i}_s').safely_add_edge('bond',sim.resolve(f'rec{i}_s'))
+		m = PatternMatcher(lig)
+		rng = random.Random(0)
+		matches = list(m.iter_random_matches(sim,rng))
+		self.assertEqual(sorted(x['s'].id for x in matches),sorted(x['s'].id for x in m.iter_matches(sim)))
+		self.assertNotEqual([x['s'].id for x in matches],[x['s'].id for x in m.iter_matches(sim)])
+
+		# a leap extends only the matches its firings need
+		ssa = TauLeapingSimulator(build_model(),sim,seed=1)
+		firings = ssa.sample_firings({0:2,1:1})
+		self.assertEqual([i for i,_ in firings],[0,0,1])
+		self.assertTrue(all(x._matches is None for r in ssa.rules for x in r.matches.values()))
+
+	def test_leaping(self):
+		sim = build_state(100,100)
+		ssa = TauLeapingSimulator(build_model(0.05,1.0),sim,seed=1)
+		ssa.epsilon = 0.1
+		ssa.run(end_time=2.0)
+		self.assertEqual(ssa.time,2.0)
+		self.assertGreater(ssa.nleaps,0)
+		# bonds stay one-to-one and close to the deterministic steady state
+		ligsites = [x for x in sim.state.values() if isinstance(x,LigSite) and x.bond is not None]
+		self.assertEqual(len(set(x.bond.id for x in ligsites)),len(ligsites))
+		self.assertAlmostEqual(count_bonds(sim),64.2,delta=10)
+		nbonds = count_bonds(sim)
+		self.assertEqual(ssa.propensities,[(100-nbonds)**2*0.05,nbonds*1.0])
+
+def build_unnamed_state(nl,nr):
+	# ids come from the global id generator
+	nodes = []
+	for i in range(nl):
+		nodes.extend(Lig(sites=[LigSite()]).get_connected())
+	for i in range(nr):
+		nodes.extend(Rec(sites=[RecSite()]).get_connected())
+	return SimulationState(nodes)
+
+def bonded_ids(sim):
+	return sorted(x.id for x in sim.state.values() if isinstance(x,LigSite) and x.bond is not None)
+
+class TestEnsemble(unittest.TestCase):
+
+	def build_ensemble(self,**kwargs):
+		return Ensemble(partial(build_model,1.0,2.0),partial(build_state,10,4),{'bonds':count_bonds},[0.0,0.1,0.2],**kwargs)
+
+	def test_p2_quantile(self):
+		rng = random.Random(0)
+		xs = [rng.gauss(0,1) for i in range(5000)]
+		for p in [0.05,0.5,0.95]:
+			q = P2Quantile(p)
+			for x in xs:
+				q.add(x)
+			self.assertAlmostEqual(q.value(),np.quantile(xs,p),delta=0.05)
+		self.assertEqual(P2Quantile(0.5).add(3).add(1).add(2).value(),2)
+
+	def test_streaming_statistics(self):
+		ensemble = self.build_ensemble()
+		model = ensemble.build_model()
+		values = np.array([ensemble.simulate(model,k) for k in range(10)])
+		summary = ensemble.run(10,max_workers=0)
+		self.assertEqual(summary.ntrajectories,10)
+		self.assertTrue(np.allclose(summary.mean,values.mean(axis=0)))
+		self.assertTrue(np.allclose(summary.variance,values.var(axis=0,ddof=1)))
+		self.assertEqual(list(summary.get('bonds')),list(summary.mean[:,0]))
+		self.assertEqual(summary.get('bonds')[0],0)
+
+	def test_reproducible_across_workers(self):
+		ensemble = self.build_ensemble(seed=7)
+		serial = ensemble.run(6,max_workers=0)
+		for max_workers,chunksize in [(1,None),(3,2)]:
+			summary = ensemble.run(6,max_workers=max_workers,chunksize=chunksize)
+			self.assertTrue(np.array_equal(summary.mean,serial.mean))
+			self.assertTrue(np.array_equal(summary.variance,serial.variance))
+			self.assertTrue(np.array_equal(summary.quantile(0.5),serial.quantile(0.5)))
+
+	def test_id_streams(self):
+		ensemble = Ensemble(build_model,partial(build_unnamed_state,3,3),{},[1.0])
+		model = build_model()
+		def run(k):
+			ensemble.simulate(model,k)
+			return generate_id()
+		# ids depend only on the trajectory, not on what ran before
+		self.assertEqual(run(1),run(1))
+		self.assertNotEqual(run(1),run(2))
+		generate_id()
+		self.assertEqual(run(2),run(2))
+
+class TestCheckpoint(unittest.TestCase):
+
+	def roundtrip(self,sim,**kwargs):
+		f = io.BytesIO()
+		checkpoint(sim,f,**kwargs)
+		f.seek(0)
+		return restore(f)
+
+	def test_roundtrip(self):
+		sim = build_state(5,3)
+		sim.resolve('lig0_s').safely_add_edge('bond',sim.resolve('rec1_s'))
+		sim.resolve('lig3_s').safely_add_edge('bond',sim.resolve('rec0_s'))
+		sim.resolve('rec0_s').active = True
+		sim.resolve('rec1_s').active = False
+		restored, metadata = self.roundtrip(sim,metadata={'time':1.5})
+		self.assertEqual(metadata,{'time':1.5})
+		self.assertEqual(list(restored.state),list(sim.state))
+		self.assertEqual(restored.get_contents(),sim.get_contents())
+		self.assertIsNone(restored.resolve('rec2_s').active)
+		# both endpoints are wired
+		x = restored.resolve('rec1_s')
+		self.assertIs(x.bond.bond,x)
+		self.assertIs(x.molecule,restored.resolve('rec1'))
+		self.assertEqual(restored.resolve('rec1').sites,[x])
+
+	def test_compressed_and_empty(self):
+		sim = build_state(2,2)
+		f = io.BytesIO()
+		checkpoint(sim,f,compress=True)
+		f.seek(0)
+		self.assertEqual(restore(f)[0].get_contents(),sim.get_contents())
+		restored, metadata = self.roundtrip(SimulationState())
+		self.assertEqual(restored.state,{})
+		self.assertEqual(metadata,{})
+
+	def test_resume_from_checkpoint(self):
+		# a restored state continues the same trajectory
+		model = build_model(1.0,2.0)
+		sim = build_state(10,4)
+		DirectMethodSimulator(model,sim,seed=4).run(max_events=10)
+		restored, _ = self.roundtrip(sim)
+		ssa1 = DirectMethodSimulator(model,sim,seed=5).run(max_events=20)
+		ssa2 = DirectMethodSimulator(model,restored,seed=5).run(max_events=20)
+		self.assertEqual(ssa1.time,ssa2.time)
+		self.assertEqual(sim.get_contents(),restored.get_contents())
+
+class TestRecorder(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmp.name,'recording')
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_observables(self):
+		lig,rec,bound = build_patterns()
+		sim = build_state(5,3)
+		sim.resolve('lig0_s').safely_add_edge('bond',sim.resolve('rec1_s'))
+		sim.resolve('lig3_s').safely_add_edge('bond',sim.resolve('rec0_s'))
+		sim.resolve('rec0_s').active = True
+		self.assertEqual(PatternCount('free',lig)(sim),[3])
+		self.assertEqual(AttributeSum('active',RecSite,'active')(sim),[1])
+		nodes = ComplexSizeHistogram('nodes',4)
+		self.assertEqual(nodes.columns,['nodes[1]','nodes[2]','nodes[3]','nodes[4+]'])
+		self.assertEqual(nodes(sim),[0,4,0,2])
+		self.assertEqual(ComplexSizeHistogram('molecules',2,Molecule)(sim),[4,2])
+
+	def test_recording(self):
+		lig,rec,bound = build_patterns()
+		observables = [PatternCount('bonds',bound),AttributeSum('active',RecSite,'active')]
+		ssa = DirectMethodSimulator(build_model(1.0,2.0),build_state(10,4),seed=1)
+		with Recorder(self.path,observables,0.25,buffer_size=3) as recorder:
+			recorder.run(ssa,2.0)
+		self.assertEqual(recorder.nsamples,9)
+		self.assertEqual(recorder.nchunks,3)
+		data = load_recording(self.path)
+		self.assertEqual(list(data),['time','bonds','active'])
+		self.assertEqual(list(data['time']),[0.25*k for k in range(9)])
+		self.assertEqual(data['bonds'][0],0)
+		self.assertEqual(data['bonds'][-1],count_bonds(ssa.state))
+		self.assertEqual(list(data['active']),[0]*9)
+
+		# the same trajectory recorded in two runs with a large buffer gives the same data
+		ssa = DirectMethodSimulator(build_model(1.0,2.0),build_state(10,4),seed=1)
+		path = os.path.join(self.tmp.name,'other')
+		recorder = Recorder(path,observables,0.25).run(ssa,1.0)
+		recorder.run(ssa,2.0)
+		other = load_recording(path)
+		self.assertEqual(list(other['time']),list(data['time']))
+		self.assertEqual(list(other['bonds']),list(data['bonds']))
+
+		with self.assertRaises(AssertionError):
+			Recorder(self.path,observables[:1],0.25)
+
+class TestLiveObservables(unittest.TestCase):
+
+	def build_model(self):
+		activation = Rule(
+			name = 'activation',
+			reactants = {'R':Pattern(GraphContainer([RecSite('s')]),constraints=['s.active == False'])},
+			actions = ['R.s.setTrue_active()'],
+			rate_prefix = 'ka',
+			parameters = ['ka']
+			)
+		model = build_model(1.0,2.0)
+		return RuleBasedModel('model',rules=model.rules + [activation])
+
+	def test_incremental_updates(self):
+		lig,rec,bound = build_patterns()
+		sim = build_state(10,4)
+		for x in sim.state.values():
+			if isinstance(x,RecSite):
+				x.active = False
+		registry = ObservableRegistry(sim,[LivePatternCount('free',lig),LivePatternCount('bonds',bound),LiveAttributeSum('active',RecSite,'active')])
+		ssa = DirectMethodSimulator(self.build_model(),sim,parameters={'kf':1.0,'kr':2.0,'ka':5.0},seed=2)
+		for i in range(30):
+			ssa.run(max_events=1)
+			expected = {
+				'free': PatternMatcher(lig).count(sim),
+				'bonds': count_bonds(sim),
+				'active': sum(1 for x in sim.state.values() if isinstance(x,RecSite) and x.active),
+				}
+			self.assertEqual(registry.values(),expected)
+		self.assertGreater(registry.values()['active'],0)
+
+		# only touched nodes are rechecked
+		sim.push_to_stack(SetAttr.make(sim.resolve('rec0_s'),'active',False)).simulate()
+		self.assertEqual(registry.touched,{'rec0_s'})
+		registry.refresh()
+		self.assertEqual(registry.touched,set())
+		for x in registry.observables[:2]:
+			self.assertTrue(all('rec0_s' in key for key in x.pool.dirty))
+
+		registry.close()
+		self.assertEqual(sim.listeners,[])
+
+	def test_rollback_and_recording(self):
+		lig,rec,bound = build_patterns()
+		rollback_rule = Rule(
+			name = 'bind_then_rollback',
+			reactants = {'L':lig,'R':rec},
+			actions = ['L.s.add_bond(R.s)','rollback(True)'],
+			rate_prefix = 'k',
+			parameters = ['k']
+			)
+		sim = build_state(3,3)
+		bonds = LivePatternCount('bonds',bound)
+		registry = ObservableRegistry(sim,[bonds])
+		ssa = DirectMethodSimulator(RuleBasedModel('model',rules=[rollback_rule]),sim,parameters={'k':1.0})
+		ssa.run(max_events=3)
+		self.assertEqual(bonds(sim),[0])
+		with self.assertRaises(AssertionError):
+			bonds(build_state(1,1))
+
+		tmp = tempfile.TemporaryDirectory()
+		ssa = DirectMethodSimulator(build_model(1.0,2.0),sim,seed=3)
+		Recorder(tmp.name,[bonds],0.5).run(ssa,2.0)
+		data = load_recording(tmp.name)
+		self.assertEqual(data['bonds'][-1],count_bonds(sim))
+		tmp.cleanup()
+
+class TestJournal(unittest.TestCase):
+
+	def test_transactions(self):
+		sim = build_state(3,3).update(RecSite('lone',active=False))
+		before = sim.get_contents()
+		sim.push_to_stack(AddEdge.make(sim.resolve('lig0_s'),'bond',sim.resolve('rec0_s'))).simulate()
+		# outside a transaction, nothing is journaled
+		self.assertEqual(len(sim.journal),0)
+		with self.assertRaises(AssertionError):
+			sim.rollback()
+
+		outer = sim.begin()
+		sim.push_to_stack(SetAttr.make(sim.resolve('rec1_s'),'active',True)).simulate()
+		inner = sim.begin()
+		actions = [
+			AddEdge.make(sim.resolve('lig1_s'),'bond',sim.resolve('rec1_s')),
+			RemoveEdge.make(sim.resolve('lig0_s'),'bond',sim.resolve('rec0_s')),
+			RemoveNode.make(sim.resolve('lone')),
+			AddNode.make(Lig,'lig3',{}),
+			]
+		sim.push_to_stack(list(actions)).simulate()
+		self.assertEqual(sim.get_journal(inner),actions)
+		self.assertEqual(len(sim.get_journal(outer)),5)
+		sim.rollback(inner)
+		self.assertEqual(sim.marks,[0])
+		self.assertTrue(sim.resolve('rec1_s').active)
+		self.assertIs(sim.resolve('lig0_s').bond,sim.resolve('rec0_s'))
+		self.assertFalse(sim.resolve('lone').active)
+		self.assertNotIn('lig3',sim.state)
+
+		# a nested commit keeps actions for the enclosing transaction
+		sim.begin()
+		sim.push_to_stack(list(actions)).simulate()
+		sim.commit()
+		self.assertEqual(len(sim.journal),5)
+		sim.rollback(outer)
+		self.assertFalse(sim.resolve('rec1_s').active)
+		self.assertEqual(len(sim.journal),0)
+		self.assertEqual(sim.marks,[])
+		sim.push_to_stack(RemoveEdge.make(sim.resolve('lig0_s'),'bond',sim.resolve('rec0_s'))).simulate()
+		self.assertEqual(sim.get_contents(),before)
+
+	def test_commit_discards_entries(self):
+		sim = build_state(100,100)
+		sim.begin()
+		for i in range(100):
+			sim.push_to_stack(AddEdge.make(sim.resolve(f'lig{i}_s'),'bond',sim.resolve(f'rec{i}_s'))).simulate()
+		self.assertEqual(len(sim.journal),100)
+		self.assertGreaterEqual(sim.journal.capacity,100)
+		sim.commit()
+		self.assertEqual(len(sim.journal),0)
+		self.assertEqual(sim.journal.references,[])
+		self.assertEqual(count_bonds(sim),100)
+
+		# simulators keep only the actions of the rule being fired
+		ssa = DirectMethodSimulator(build_model(1.0,2.0),build_state(10,4),seed=1).run(max_events=50)
+		self.assertEqual(len(ssa.state.journal),0)
+		self.assertEqual(ssa.state.marks,[])
+
+class TestRete(unittest.TestCase):
+
+	def test_shared_nodes(self):
+		lig,rec,bound = build_patterns()
+		sim = build_state(5,3)
+		network = get_network(sim)
+		self.assertIs(get_network(sim),network)
+		free = network.add_pattern(PatternMatcher(lig))
+		self.assertIs(network.add_pattern(PatternMatcher(lig)),free)
+		network.add_pattern(PatternMatcher(rec))
+		# free lig and rec share the root-class alpha node, bound sites share none
+		nalphas = len(network.alphas)
+		network.add_pattern(PatternMatcher(bound))
+		self.assertEqual(len(network.alphas),nalphas+2)
+
+		# patterns on the same graph share the beta node of the root
+		# and differ in the alpha node of the site, which carries the constraint
+		g = GraphContainer(Lig('lig',sites=[LigSite('s')]).get_connected())
+		nbetas = len(network.betas)
+		any_lig = network.add_pattern(PatternMatcher(Pattern(g)))
+		bound_lig = network.add_pattern(PatternMatcher(Pattern(g,constraints=['len(s.bond)==1'])))
+		self.assertEqual(len(network.betas),nbetas+2)
+		self.assertEqual((free.count(),any_lig.count(),bound_lig.count()),(5,5,0))
+		network.close()
+
+	def test_incremental_counts(self):
+		lig,rec,bound = build_patterns()
+		symmetric = Pattern(GraphContainer(Lig('lig',sites=[LigSite('s1'),LigSite('s2')]).get_connected()))
+		active = Pattern(GraphContainer([RecSite('s',active=True)]))
+		with_helper = Pattern(GraphContainer([RecSite('x')]),helpers={'h':active},constraints=['h.contains(s=x) == False'])
+		patterns = [lig,rec,bound,symmetric,with_helper]
+
+		sim = build_state(6,6)
+		for x in Lig('dimer',sites=[LigSite('d1'),LigSite('d2')]).get_connected():
+			sim.update(x)
+		matchers = [PatternMatcher(p) for p in patterns]
+		network = get_network(sim)
+		terminals = [network.add_pattern(m) for m in matchers]
+		ligsites = [x for x in sim.state.values() if isinstance(x,LigSite)]
+		recsites = [x for x in sim.state.values() if isinstance(x,RecSite)]
+		rng = random.Random(0)
+		for i in range(200):
+			x = rng.choice(ligsites)
+			if rng.random() < 0.3:
+				action = SetAttr.make(rng.choice(recsites),'active',rng.random() < 0.5)
+			elif x.bond is not None:
+				action = RemoveEdge.make(x,'bond',x.bond)
+			else:
+				y = rng.choice(recsites)
+				if y.bond is not None:
+					continue
+				action = AddEdge.make(x,'bond',y)
+			sim.push_to_stack(action).simulate()
+			if i % 3 == 0:
+				self.assertEqual([t.count() for t in terminals],[m.count(sim) for m in matchers])
+		self.assertEqual(terminals[3].count(),2)
+		self.assertEqual(
+			sorted((m['ls'].id,m['rs'].id) for m in terminals[2]),
+			sorted((m['ls'].id,m['rs'].id) for m in matchers[2].iter_matches(sim))
+			)
+		network.close()
+
+	def test_simulation(self):
+		ssa = DirectMethodSimulator(build_model(1.0,0.0),build_state(4,6),seed=1,rule_class=ReteRule)
+		self.assertIsInstance(ssa.rules[0],ReteRule)
+		ssa.run(max_events=10)
+		self.assertEqual(count_bonds(ssa.state),4)
+		self.assertEqual(ssa.total,0)
+
+		# propensities match those of rules that search from scratch
+		ssa = DirectMethodSimulator(build_model(1.0,2.0),build_state(10,6),seed=2,rule_class=ReteRule)
+		for i in range(50):
+			ssa.run(max_events=1)
+			self.assertEqual([r.propensity for r in ssa.rules],[r.update(ssa.state).propensity for r in DirectMethodSimulator(build_model(1.0,2.0),ssa.state).rules])
+
+	def test_chained_constraints(self):
+		sim = build_bonded_state(3)
+		network = get_network(sim)
+		release = build_release_model().rules[1].reactants['L']
+		with self.assertRaises(AssertionError):
+			network.add_pattern(PatternMatcher(release))
+		# terminals hold their patterns, so their ids are not reused while they are keyed
+		lig,rec,bound = build_patterns()
+		self.assertIs(network.add_pattern(PatternMatcher(lig)).pattern,lig)
+
+		# release is searched in full, activation is kept by the network
+		ssa = DirectMethodSimulator(build_release_model(),sim,seed=1,rule_class=ReteRule)
+		self.assertEqual([type(r.matches[x]) for r,x in zip(ssa.rules,'RL')],[ReteMatchSet,MatchSet])
+		reference = DirectMethodSimulator(build_release_model(),sim)
+		while ssa.total > 0:
+			ssa.run(max_events=1)
+			self.assertEqual(ssa.propensities,[r.update(sim).propensity for r in reference.rules])
+		self.assertEqual(count_bonds(sim),0)
+		network.close()
+
+	def test_collected(self):
+		# networks live on their states and are collected with them
+		refs = []
+		for seed in range(3):
+			ssa = DirectMethodSimulator(build_model(1.0,2.0),build_state(4,4),seed=seed,rule_class=ReteRule).run(max_events=5)
+			refs.append((weakref.ref(ssa.state),weakref.ref(ssa.state.rete)))
+			del ssa
+		gc.collect()
+		self.assertEqual([(a(),b()) for a,b in refs],[(None,None)]*3)
+
+class TestNodeIndex(unittest.TestCase):
+
+	def test_index(self):
+		sim = build_state(5,3)
+		self.assertEqual([sim.count_nodes(c) for c in [Lig,Rec,LigSite,RecSite,Site,Molecule,BaseClass]],[5,3,5,3,8,8,16])
+		self.assertEqual(sim.index.count_label('Site'),8)
+		self.assertEqual(sim.index.count_label('Entity'),0)
+		self.assertEqual([x.id for x in sim.get_nodes(Rec)],['rec0','rec1','rec2'])
+		sample = sim.index.sample(Site,8,random.Random(0))
+		self.assertEqual(sorted(x.id for x in sample),sorted(x.id for x in sim.state.values() if isinstance(x,Site)))
+
+		# actions keep the index current
+		sim.push_to_stack([RemoveNode.make(sim.resolve('lig4')),RemoveNode.make(sim.resolve('lig4_s')),AddNode.make(RecSite,'extra',{})]).simulate()
+		self.assertEqual([sim.count_nodes(c) for c in [Lig,LigSite,RecSite,Site]],[4,4,4,8])
+		self.assertEqual(sim.get_nodes(RecSite).count(),len(sim.get_nodes(RecSite).keys))
+		self.assertNotIn('lig4',sim.index.get(Molecule).nodes)
+		self.assertTrue(all(sim.index.get_label(x.__class__.__name__) for x in sim.state.values()))
+		# classes outside the schema are found by scanning
+		self.assertEqual(sim.count_nodes(object),len(sim.state))
+
+		restored, _ = TestCheckpoint().roundtrip(sim)
+		self.assertEqual(restored.count_nodes(Site),8)
+
+	def test_attribute_indexes(self):
+		lig,rec,bound = build_patterns()
+		sim = build_state(6,4)
+		for i,x in enumerate(sim.get_nodes(RecSite)):
+			x.active = i < 2
+		degrees = sim.add_attribute_index(Site,'bond')
+		values = sim.add_attribute_index(RecSite,'active')
+		self.assertIs(sim.add_attribute_index(Site,'bond'),degrees)
+		self.assertEqual((len(degrees.get(0)),len(degrees.get(1)),len(values.get(True))),(10,0,2))
+
+		sim.push_to_stack([
+			AddEdge.make(sim.resolve('lig0_s'),'bond',sim.resolve('rec0_s')),
+			SetAttr.make(sim.resolve('rec3_s'),'active',True),
+			]).simulate()
+		self.assertEqual(sorted(x.id for x in degrees.get(1)),['lig0_s','rec0_s'])
+		self.assertEqual(len(values.get(True)),3)
+		sim.begin()
+		sim.push_to_stack(RemoveEdge.make(sim.resolve('lig0_s'),'bond',sim.resolve('rec0_s'))).simulate()
+		self.assertEqual(len(degrees.get(1)),0)
+		sim.rollback()
+		self.assertEqual(len(degrees.get(1)),2)
+
+		# the matcher starts from the smallest bucket
+		active = Pattern(GraphContainer(Rec('rec',sites=[RecSite('s',active=True)]).get_connected()),constraints=['len(s.bond)==0'])
+		m = PatternMatcher(active)
+		self.assertIn(('bond',True,0),m.index_tests['s'])
+		self.assertEqual([x.id for x in m.root_candidates('s',sim)],[x.id for x in values.get(True)])
+		self.assertEqual(len(m.root_candidates('rec',sim)),4)
+		self.assertEqual(sorted(x['rec'].id for x in m.iter_matches(sim)),['rec1','rec3'])
+		self.assertEqual([m.count(sim) for m in map(PatternMatcher,[lig,rec,bound])],[5,3,1])
+		# indexes are not required
+		self.assertEqual(m.count(build_state(2,2)),0)
+
+class TestLocalRematching(unittest.TestCase):
+
+	def test_neighborhoods(self):
+		lig,rec,bound = build_patterns()
+		m = PatternMatcher(lig)
+		self.assertEqual((m.eccentricities,m.diameter,m.reach),({'lig':1,'s':1},1,0))
+		g = GraphContainer(Rec('rec',sites=[RecSite('s',bond=LigSite('l',molecule=Lig('lig')))]).get_connected())
+		self.assertEqual(PatternMatcher(Pattern(g)).diameter,3)
+
+		# free ligand sites whose partner would be active
+		p = Pattern(GraphContainer([LigSite('s')]),constraints=['len(s.bond)==1','s.bond.active == True'])
+		m = PatternMatcher(p)
+		self.assertEqual(m.reach,1)
+		sim = build_state(3,3)
+		sim.resolve('lig0_s').safely_add_edge('bond',sim.resolve('rec0_s'))
+		self.assertEqual(m.neighborhood(sim,{'rec0_s','gone'}),{'rec0_s','lig0_s','rec0','gone'})
+		pool = CandidatePool(m,sim,dict())
+		self.assertEqual(pool.count(),0)
+		# the match appears although its only node is not touched
+		sim.push_to_stack(SetAttr.make(sim.resolve('rec0_s'),'active',True)).simulate()
+		self.assertEqual(pool.touch({'rec0_s'}).count(),1)
+
+	def test_added_edges(self):
+		lig,rec,bound = build_patterns()
+		sim = build_state(3,3)
+		pools = [CandidatePool(PatternMatcher(p),sim,dict()) for p in [lig,bound]]
+		action = AddEdge('lig0_s','bond','rec0_s','bond')
+		sim.push_to_stack(action).simulate()
+		# lig reads the bond in a constraint and is rechecked, bound is searched from its edge only
+		self.assertEqual([p.is_seedable(action) for p in pools],[False,True])
+		searched = []
+		for p in pools:
+			p.matcher.iter_local_matches = lambda sim,ids,params,f=p.matcher.iter_local_matches: searched.append(set(ids)) or f(sim,ids,params)
+		self.assertEqual([p.touch(set(),[action]).count() for p in pools],[2,1])
+		self.assertEqual(searched,[{'lig0_s','rec0_s'},set()])
+		# an edge that no longer exists is rechecked
+		sim.push_to_stack(RemoveEdge('lig0_s','bond','rec0_s','bond')).simulate()
+		self.assertFalse(pools[1].is_seedable(action))
+		self.assertEqual(pools[1].touch(set(),[action]).count(),0)
+
+	def test_simulation(self):
+		model = TestLiveObservables().build_model()
+		parameters = {'kf':1.0,'kr':2.0,'ka':1.0}
+		sim = build_state(10,6)
+		for x in sim.get_nodes(RecSite):
+			x.active = False
+		ssa = DirectMethodSimulator(model,sim,parameters,seed=3,rule_class=LocalRule)
+		reference = DirectMethodSimulator(model,sim,parameters)
+		for i in range(60):
+			ssa.run(max_events=1)
+			exact = [r.update(sim).propensity for r in reference.rules]
+			self.assertEqual([ssa.update_rule(j)[1] for j in range(len(ssa.rules))],exact)
+		self.assertGreater(count_bonds(sim),0)
+		self.assertTrue(all(len(r.touched)==0 for r in ssa.rules))
+		for r in ssa.rules:
+			r.close()
+		self.assertEqual(sim.listeners,[])
+
+	def test_chained_constraints(self):
+		# release reads s.bond.active, so its matches change when only the partner of s is touched
+		sim = build_bonded_state(3)
+		ssa = DirectMethodSimulator(build_release_model(),sim,seed=1,rule_class=LocalRule)
+		reference = DirectMethodSimulator(build_release_model(),sim)
+		while ssa.total > 0:
+			ssa.run(max_events=1)
+			self.assertEqual(ssa.propensities,[r.update(sim).propensity for r in reference.rules])
+		self.assertEqual(count_bonds(sim),0)
+		for r in ssa.rules:
+			r.close()
@@ -204,9 +204,10 @@ class ActionCaller(ExecutableExpression):
     start = 'function_call'
     builtins = ChainMap(global_builtins,dict(rollback=rollback,terminate=terminate))
     allowed_forms = ['<actioncall> ( <boolexpr> )', '<pattern>.<var>.<actioncall> (<params>)', '<pattern>.<actioncall> (<params>)']
+    allowed_returns = None
 
     def exec(self,matches,helpers):
-        v = super().exec(matches,helper)
+        v = super().exec(matches,helpers)
         #err = 'An element in the following nested list is not a recognized Action: {0}'
         #assert verify_list(v,(SimulatorAction,PrimaryAction,CompositeAction)), err.format(list(v))
         # verifying that every element of a nested list is an action is slow AF
@@ -1,7 +1,7 @@
 from lark import Lark, tree, Transformer,Visitor, v_args, Tree,Token
 from ..utils.collections import merge_lists, merge_dicts, pipe_map,listmap
 from operator import itemgetter,attrgetter
-from functools import partial
+from functools import partial, lru_cache
 
 
 grammar = """
@@ -58,14 +58,18 @@ COMMENT: /#.*/
     #?start: [NEWLINE] expressions [NEWLINE]
 
 ### process constraint string
+@lru_cache(maxsize=None)
+def get_parser(start='start'):
+    # building the parser dominates the cost of parsing a short expression
+    return Lark(grammar, start=start)
+
 def process_expression_string(string_input,start='start'):
     #### This is the main method
     # parses a string input to generate a tree, prunes new lines,
     # simplifies based on basic arithmetic,
     # analyzes dependencies,
     
-    parser = Lark(grammar, start=start)
-    tree = parser.parse(string_input)
+    tree = get_parser(start).parse(string_input)
     tree,modified = simplify_tree(tree) 
     deps = Dependency_Analyzer().transform(tree=tree)
 
@@ -0,0 +1,246 @@
+from .canonical_labeling import canonical_label, label_compact
+from .compact import CompactGraph
+from ..utils.collections import Mapping
+from collections import OrderedDict, Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+# A cache of canonical labels, keyed by a Weisfeiler-Lehman hash
+# Colors of nodes are refined by WL rounds, starting from class and literal attributes:
+#	each round, a node's color becomes the hash of its color and the sorted colors of its neighbors,
+#	each tagged with the attribute pair of the edge
+# until the number of colors stops growing. The hash of a graph is the hash of its color multiset.
+# Isomorphic graphs have the same hash; graphs with the same hash need not be isomorphic,
+# and nodes with the same color need not have the same class and literal attributes.
+#
+# A bucket holds the canonical forms seen with a hash. A graph that hashes into a bucket is resolved
+# by searching for an isomorphism from the graph of each canonical form to the graph, guided by colors
+# and checked exactly: mapped nodes have equal labels (class and literal attributes) and mapped edges exist.
+# An isomorphism exists iff canonical_label would give the same CanonicalForm,
+# and gives a mapping from canonical names to variables such that C.build_graph_container(mapping) recapitulates g.
+# The mapping may differ from the one canonical_label returns by an automorphism of the form.
+# If no form matches, canonical_label runs and its form is added to the bucket.
+#
+# Buckets are evicted least recently used first once the cache holds more than maxsize forms.
+# Colors use Python's hash, so cached keys are only valid within a process.
+
+def node_label(node):
+	return (node.__class__,tuple(sorted((a,node.get(a)) for a in node.get_literal_attributes(ignore_id=True,ignore_None=True))))
+
+def get_labels(g):
+	return {idx:node_label(node) for idx,node in g.iter_nodes()}
+
+def get_adjacency(g):
+	# variable: [(attr,variable,related_attr)]
+	adjacency = {idx:[] for idx in g.keys()}
+	for edge in g.iter_edges():
+		n1,a1,n2,a2 = edge.unpack()
+		adjacency[n1].append((a1,n2,a2))
+		adjacency[n2].append((a2,n1,a1))
+	return adjacency
+
+def wl_colors(g,adjacency=None,labels=None):
+	adjacency = get_adjacency(g) if adjacency is None else adjacency
+	labels = get_labels(g) if labels is None else labels
+	colors = {idx:hash(x) for idx,x in labels.items()}
+	ncolors = len(set(colors.values()))
+	for _ in range(len(colors)):
+		colors = {idx:hash((c,tuple(sorted((a1,a2,colors[n]) for a1,n,a2 in adjacency[idx])))) for idx,c in colors.items()}
+		n = len(set(colors.values()))
+		if n == ncolors:
+			break
+		ncolors = n
+	return colors
+
+def wl_hash(colors):
+	return hash(tuple(sorted(Counter(colors.values()).items())))
+
+def search_order(adjacency):
+	# variables in breadth-first order, so each variable after the first of its component has an earlier neighbor
+	order, seen = [], set()
+	for root in sorted(adjacency):
+		if root in seen:
+			continue
+		seen.add(root)
+		queue = [root]
+		while queue:
+			x = queue.pop(0)
+			order.append(x)
+			for _,y,_ in sorted(adjacency[x]):
+				if y not in seen:
+					seen.add(y)
+					queue.append(y)
+	return order
+
+def find_isomorphism(entry,colors,adjacency,labels):
+	# a mapping from the canonical names of a cached form to variables of a graph, or None
+	order, form_colors, form_adjacency, form_labels = entry.order, entry.colors, entry.adjacency, entry.labels
+	by_color = defaultdict(list)
+	for idx,c in colors.items():
+		by_color[c].append(idx)
+	edges = set((n1,a1,n2) for n1,x in adjacency.items() for a1,n2,_ in x)
+	mapping, used = dict(), set()
+
+	def candidates(i):
+		v = order[i]
+		# neighbors of the image of an earlier neighbor, else all variables of the same color
+		for a1,u,a2 in form_adjacency[v]:
+			if u in mapping:
+				return [n for b2,n,b1 in adjacency[mapping[u]] if (b1,b2) == (a1,a2)]
+		return by_color[form_colors[v]]
+
+	def extend(i):
+		if i == len(order):
+			return True
+		v = order[i]
+		for x in candidates(i):
+			if x in used or colors[x] != form_colors[v] or labels[x] != form_labels[v]:
+				continue
+			if all((x,a1,mapping[u]) in edges for a1,u,_ in form_adjacency[v] if u in mapping):
+				mapping[v] = x
+				used.add(x)
+				if extend(i+1):
+					return True
+				del mapping[v]
+				used.discard(x)
+		return False
+
+	return mapping if extend(0) else None
+
+def resolve(entry,colors,adjacency,labels):
+	mapping = find_isomorphism(entry,colors,adjacency,labels)
+	if mapping is None:
+		return None
+	names = sorted(mapping)
+	return Mapping.create(names,[mapping[n] for n in names]), entry.form, entry.group
+
+class CacheEntry:
+
+	def __init__(self,form,group):
+		self.form = form
+		self.group = group
+		g = form.build_graph_container()
+		self.adjacency = get_adjacency(g)
+		self.labels = get_labels(g)
+		self.colors = wl_colors(g,self.adjacency,self.labels)
+		self.order = search_order(self.adjacency)
+
+class CanonicalLabelCache:
+
+	def __init__(self,maxsize=1024):
+		self.maxsize = maxsize
+		self.buckets = OrderedDict()
+		self.size = 0
+		self.hits, self.misses, self.collisions, self.evictions = 0, 0, 0, 0
+
+	def label(self,g):
+		# same as canonical_label(g)
+		if len(g) == 0:
+			return canonical_label(g)
+		adjacency, labels = get_adjacency(g), get_labels(g)
+		colors = wl_colors(g,adjacency,labels)
+		key = wl_hash(colors)
+		result = self.lookup(key,colors,adjacency,labels)
+		if result is None:
+			result = canonical_label(g)
+			self.add(key,result)
+		return result
+
+	def lookup(self,key,colors,adjacency,labels):
+		# the canonical label of a graph from a cached form, or None
+		bucket = self.buckets.get(key)
+		if bucket is not None:
+			self.buckets.move_to_end(key)
+			for entry in bucket:
+				result = resolve(entry,colors,adjacency,labels)
+				if result is not None:
+					self.hits += 1
+					return result
+			self.collisions += 1
+		self.misses += 1
+		return None
+
+	def add(self,key,result):
+		entry = CacheEntry(result[1],result[2])
+		self.buckets.setdefault(key,[]).append(entry)
+		self.size += 1
+		self.evict()
+		return entry
+
+	def evict(self):
+		while self.size > self.maxsize and len(self.buckets) > 1:
+			_, bucket = self.buckets.popitem(last=False)
+			self.size -= len(bucket)
+			self.evictions += 1
+		return self
+
+	def clear(self):
+		self.buckets.clear()
+		self.size = 0
+		return self
+
+	@property
+	def stats(self):
+		return dict(hits=self.hits,misses=self.misses,collisions=self.collisions,evictions=self.evictions,size=self.size)
+
+####### Default cache
+cache = CanonicalLabelCache()
+
+def cached_canonical_label(g):
+	return cache.label(g)
+
+####### Batches
+# canonical_label_many labels a list of graphs, resolving as many as possible without labeling them:
+#	graphs found in the cache are resolved in this process
+#	the others are grouped by WL hash; in each round, one graph per group is sent to a worker
+#	as its CompactGraph (see compact.py) and labeled there, and the rest of its group is resolved
+#	against the result, so only graphs that collide with a non-isomorphic graph wait for another round
+# max_workers=0 labels in the current process.
+# Without a cache, a cache for the batch is used; pass the default cache to share labels across batches.
+
+def canonical_label_many(graphs,max_workers=None,chunksize=None,cache=None):
+	cache = CanonicalLabelCache(maxsize=max(1,len(graphs))) if cache is None else cache
+	results = [None]*len(graphs)
+	# key: [(index,colors,adjacency,labels)] of unresolved graphs
+	pending = OrderedDict()
+	for i,g in enumerate(graphs):
+		if len(g) == 0:
+			results[i] = canonical_label(g)
+			continue
+		adjacency, labels = get_adjacency(g), get_labels(g)
+		colors = wl_colors(g,adjacency,labels)
+		key = wl_hash(colors)
+		results[i] = cache.lookup(key,colors,adjacency,labels)
+		if results[i] is None:
+			pending.setdefault(key,[]).append((i,colors,adjacency,labels))
+	if not pending:
+		return results
+
+	executor = None if max_workers == 0 else ProcessPoolExecutor(max_workers)
+	try:
+		while pending:
+			representatives = [(key,x[0][0]) for key,x in pending.items()]
+			compacts = [CompactGraph(graphs[i]) for _,i in representatives]
+			if executor is None:
+				labels = map(label_compact,compacts)
+			else:
+				if chunksize is None:
+					nworkers = max_workers or os.cpu_count() or 1
+					chunksize = max(1,len(compacts)//(4*nworkers))
+				labels = executor.map(label_compact,compacts,chunksize=chunksize)
+			for (key,i),result in zip(representatives,labels):
+				results[i] = result
+				entry = cache.add(key,result)
+				remaining = []
+				for j,colors,adjacency,labels in pending[key][1:]:
+					results[j] = resolve(entry,colors,adjacency,labels)
+					if results[j] is None:
+						remaining.append((j,colors,adjacency,labels))
+				if remaining:
+					pending[key] = remaining
+				else:
+					del pending[key]
+	finally:
+		if executor is not None:
+			executor.shutdown()
+	return results
@@ -1,8 +1,7 @@
 from ..utils.collections import Mapping, merge_lists, strgen
-from collections import deque, Counter, defaultdict
-from .collections import CanonicalForm
+from collections import defaultdict
 from .permutations import Permutation, PermutationGroup
-from copy import deepcopy
+from .compact import CompactGraph
 
 # Implements ISMAGS PLoS One 2014 (Houbraken et al.) Fig 4
 # DEFINITIONS
@@ -65,70 +64,100 @@ from copy import deepcopy
 # Without orbit pruning, each valid symmetry must be produced only once.
 # With orbit pruning, the symmetries produced must be sufficient to generate the full set.
 
+# Undo trail
+# The search keeps one mutable OPP. Cells are never modified in place:
+# splitting a cell replaces it with new cells and records (position, number of new cells, old cell) on a trail,
+# so backtracking to a search tree node pops the trail back to its length at that node.
+# Each level of the search adds at most O(n) to the trail, and exploring a branch copies nothing.
+
+# Integer representation
+# The search runs on the CompactGraph of g (see compact.py): elements of partitions are node numbers,
+# which sort like the variables they stand for, so cells, mapping options and generators are the same.
+# Leaves are kept as pairs of node lists; the first leaf gives the canonical order, and
+# generators are built directly on canonical names, as PermutationGroup.duplicate(mapping) would give them.
+
 def canonical_label(g):
+	return label_compact(CompactGraph(g))
 
+def label_compact(g):
+	# canonical_label of the CompactGraph of a graph
 	partition = initialize_partition(g)
 	opp = ordered_partition_pair(partition,partition)
+	trails = ([],[])
 	orbindex = initialize_orbindex(partition)
-	search_tree = deque([search_tree_element(opp)])
-	generators = []
-
-	while search_tree:
-		opp, source, target = search_tree.popleft()
-		if source == target == None:
-			# we are at a node of the search tree
-			idx = first_nontrivial_cell(opp)
-			if idx is not None:
-				# create branching options (edges)
-				for source, target in mapping_options(opp,idx):
-					search_tree.appendleft(search_tree_element(deepcopy(opp),source,target))
-			else:
-				# we are at a leaf node
-				gen = make_permutation(opp)
-				generators.append(gen)
-				orbindex = update_orbindex(orbindex,gen)
-		else:
-			# we are exploring an edge of the search tree
-			# prune with orbindex
-			if source == target or orbindex[source] != orbindex[target]:
-				# execute branching option and refine
-				opp = switch_and_split(opp,source,target)
-				opp = [refine_partition(p,g) for p in opp]
-				search_tree.appendleft(search_tree_element(opp))	
-	
-	order = generators[0].sources
-	mapping = Mapping.create(order,strgen(len(order)))
-	C = CanonicalForm.create(g,order,mapping)
-	G = PermutationGroup.create(generators).duplicate(mapping)
+	leaves = []
+	# frames: [idx, source, targets, next option, trail lengths]
+	stack = [search_tree_element(opp,trails)]
+
+	while stack:
+		frame = stack[-1]
+		idx, source, targets, i, marks = frame
+		undo(opp,trails,marks)
+		if idx is None:
+			# we are at a leaf node
+			leaves.append([merge_lists(p) for p in opp])
+			orbindex = update_orbindex(orbindex,opp)
+			stack.pop()
+			continue
+		if i == len(targets):
+			stack.pop()
+			continue
+		frame[3] += 1
+		# we are exploring an edge of the search tree
+		# prune with orbindex
+		target = targets[i]
+		if source == target or orbindex[source] != orbindex[target]:
+			# execute branching option and refine
+			changed = [set(p[idx]) for p in opp]
+			switch_and_split(opp,trails,idx,source,target)
+			for p,trail,x in zip(opp,trails,changed):
+				refine_partition(p,g,trail,x)
+			stack.append(search_tree_element(opp,trails))
+
+	order = leaves[0][0]
+	names = [None]*len(g)
+	for i,x in zip(order,strgen(len(order))):
+		names[i] = x
+	mapping = Mapping.create([g.names[i] for i in order],[names[i] for i in order])
+	C = g.canonical_form(order,mapping)
+	G = PermutationGroup.create([Permutation.create(*[[names[i] for i in x] for x in leaf]) for leaf in leaves])
 	G.validate()
-	reverse_mapping = mapping.reverse().sort()
+	# strgen generates names in sorted order
+	reverse_mapping = mapping.reverse()
 	# return the reverse of mapping so that
 	# C.build_graph_container(reverse_mapping) recapitulates g
 	return reverse_mapping,C,G
 
 # Search tree
-def search_tree_element(opp,source=None,target=None):
-	return (opp,source,target)
-
-def mapping_options(opp,idx):
-	# map leader of opp[0][idx] to each element in opp[1][idx]
-	# reversed to give first element top priority in DFS
-	return reversed([(opp[0][idx][0],t) for t in opp[1][idx]])
-
-def switch_and_split(opp,source,target):
+def search_tree_element(opp,trails):
+	# a node of the search tree, with its mapping options
+	# the leader of opp[0][idx] is mapped to each element of opp[1][idx] in turn
 	idx = first_nontrivial_cell(opp)
-	opp[0][idx].remove(source)
-	opp[1][idx].remove(target)
-	opp[0].insert(idx,[source])
-	opp[1].insert(idx,[target])
+	if idx is None:
+		return [None,None,None,0,[len(t) for t in trails]]
+	return [idx,opp[0][idx][0],list(opp[1][idx]),0,[len(t) for t in trails]]
+
+def switch_and_split(opp,trails,idx,source,target):
+	for p,trail,x in zip(opp,trails,[source,target]):
+		replace_cell(p,trail,idx,[[x],[y for y in p[idx] if y != x]])
 	return opp
 
-def make_permutation(opp):
-	return Permutation.create(merge_lists(opp[0]), merge_lists(opp[1]))
+def replace_cell(p,trail,idx,cells):
+	trail.append((idx,len(cells),p[idx]))
+	p[idx:idx+1] = cells
+	return p
+
+def undo(opp,trails,marks):
+	for p,trail,mark in zip(opp,trails,marks):
+		while len(trail) > mark:
+			idx,n,cell = trail.pop()
+			p[idx:idx+n] = [cell]
+	return opp
 
 ####### Ordered Partition Pair
 def ordered_partition_pair(p1,p2):
-	return [deepcopy(p1),deepcopy(p2)]
+	# cells are shared, since they are never modified in place
+	return [list(p1),list(p2)]
 
 def first_nontrivial_cell(opp):
 	idxs = [i for i,x in enumerate(opp[0]) if len(x)>1]
@@ -147,60 +176,75 @@ def vis_cell(c):
 
 ###### Partitions
 def initialize_partition(g):
-	partition = group_by_certificate(initial_certificate,g.variables,g=g)
+	partition = group_by_certificate(g.initial_certificate,range(len(g)))
 	partition = refine_partition(partition,g)
 	return partition
 
-def refine_partition(partition,g):
-	indexes = index_partition(partition)
-	while True:
-		partition = merge_lists([refine_cell(cell,indexes,g) for cell in partition])
-		new_indexes = index_partition(partition)
-		if new_indexes == indexes:
-			break
-		indexes = new_indexes
+# Refinement by splitter queue
+# Cells are labeled by the position of their first element, so splitting a cell relabels
+# only the elements of its new cells after the first, and the labels of other cells stay put.
+# Labels are order-preserving, so certificates sort and group exactly as with cell positions.
+# A pass recertifies only the cells containing a neighbor of a relabeled element;
+# other cells were equitable before the pass and still are.
+# Passes split all their cells simultaneously, like a full pass, so the refined partition is the same.
+# `changed` are elements relabeled since the partition was last equitable, or None to certify every cell.
+
+def refine_partition(partition,g,trail=None,changed=None):
+	# refines partition of the nodes of a CompactGraph in place, recording splits on trail
+	trail = [] if trail is None else trail
+	labels = index_partition(partition,len(g))
+	while changed is None or changed:
+		affected = None if changed is None else set(labels[g.targets[k]] for x in changed for k in range(g.offsets[x],g.offsets[x+1]))
+		splits, start = [], 0
+		for i,cell in enumerate(partition):
+			if not cell:
+				splits.append((i,[]))
+			elif len(cell) > 1 and (affected is None or start in affected):
+				cells = group_by_certificate(g.edge_certificate,cell,labels=labels)
+				if len(cells) > 1:
+					splits.append((i,cells))
+			start += len(cell)
+		changed = set()
+		for i,cells in reversed(splits):
+			replace_cell(partition,trail,i,cells)
+			start = labels[cells[0][0]] if cells else 0
+			for j,cell in enumerate(cells):
+				if j > 0:
+					for x in cell:
+						labels[x] = start
+					changed.update(cell)
+				start += len(cell)
 	return partition
 
-def index_partition(partition):
-	return dict([(x,i) for i,gr in enumerate(partition) for x in gr])
-
-def refine_cell(cell,indexes,g):
-	if len(cell)==1:
-		return [cell]
-	groups = group_by_certificate(edge_certificate,cell,indexes=indexes,g=g)
-	return groups
+def index_partition(partition,n):
+	# the position of the first element of its cell, for each element
+	labels, start = [None]*n, 0
+	for cell in partition:
+		for x in cell:
+			labels[x] = start
+		start += len(cell)
+	return labels
 
 ######### Orbindex
 def initialize_orbindex(partition):
-	return {v:k for k,v in enumerate(merge_lists(partition))}
-
-def update_orbindex(orbindex,gen):
-	for cyc in gen.cyclic_form():
-		if len(cyc)>1:
-			nums = [orbindex[x] for x in cyc]
-			keys = [x for x in orbindex if orbindex[x] in nums]
-			for key in keys:
-				orbindex[key] = min(nums)
+	orbindex = [None]*len(merge_lists(partition))
+	for k,v in enumerate(merge_lists(partition)):
+		orbindex[v] = k
+	return orbindex
+
+def update_orbindex(orbindex,opp):
+	# merges the orbits of elements paired by the permutation of a leaf OPP
+	for x,y in zip(merge_lists(opp[0]),merge_lists(opp[1])):
+		a, b = orbindex[x], orbindex[y]
+		if a != b:
+			a, b = min(a,b), max(a,b)
+			for i,k in enumerate(orbindex):
+				if k == b:
+					orbindex[i] = a
 	return orbindex
 	
 ####### Certification of nodes
-def initial_certificate(idx,g):
-	x = g[idx]
-	cert = (
-		-x.degree(),
-		x.__class__.__name__,
-		tuple(sorted(x.iter_literal_attrs())),
-		tuple(sorted(Counter([a for a,_ in x.iter_edges()]))),
-		)
-	return cert
-
-def edge_certificate(idx,indexes,g):
-	x,cert = g[idx], deque()
-	for attr,node in x.iter_edges():
-		cert.append((indexes[node.id],attr))
-	cert = tuple(sorted(cert))
-	return cert
-	
+# see CompactGraph.initial_certificate and CompactGraph.edge_certificate
 def group_by_certificate(fn,elems,**kwargs):
 	d = defaultdict(list)
 	for elem in elems:
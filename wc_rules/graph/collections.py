@@ -3,15 +3,21 @@ from ..utils.collections import DictLike, listmap, Mapping
 from itertools import chain
 from typing import Tuple, Any
 
+def reduce_slots(self):
+    # frozen dataclasses with __slots__ cannot be unpickled field by field; rebuild them from their fields
+    return (self.__class__, tuple(getattr(self,x) for x in self.__slots__))
+
 @dataclass(order=True,frozen=True)
 class Port:
     __slots__ = ['node','attr']
+    __reduce__ = reduce_slots
     node: str
     attr: str
 
 @dataclass(order=True,frozen=True)
 class Edge:
     __slots__ = ['ports']
+    __reduce__ = reduce_slots
     ports: Tuple[Port]
 
     @staticmethod
@@ -39,6 +45,7 @@ class Edge:
 @dataclass(order=True,frozen=True)
 class Attr:
     __slots__ = ['node','attr','value']
+    __reduce__ = reduce_slots
     node: str
     attr: str
     value: Any
@@ -138,6 +145,7 @@ class GraphContainer(DictLike):
 @dataclass(eq=True,order=True,frozen=True)
 class CanonicalForm:
     __slots__ = ['names','classes','attrs','edges']
+    __reduce__ = reduce_slots
 
     names: Tuple[str]
     classes: Tuple[type]
@@ -0,0 +1,62 @@
+from .collections import CanonicalForm, Attr, Edge
+
+# An integer representation of a GraphContainer for canonical labeling
+# Nodes are 0..n-1 in sorted order of their variables, so sorting nodes sorts variables.
+# Attribute names are coded in sorted order, so sorting codes sorts names.
+# Adjacency is in CSR form: the edges of node i are k in range(offsets[i],offsets[i+1]),
+# with targets[k] the neighbor, attrs[k] the code of the attribute of i holding it
+# and related[k] the code of the attribute of the neighbor holding i.
+# Edges are listed as node.iter_edges() lists them, so degrees and certificates are the same as on the nodes.
+#
+# The schema objects are traversed once, when the representation is built;
+# labeling, group computation and building the CanonicalForm only index lists.
+
+class CompactGraph:
+
+	def __init__(self,g):
+		self.names = sorted(g.keys())
+		nodes = [g[x] for x in self.names]
+		self.codes = codes = {x:i for i,x in enumerate(self.names)}
+		self.classes = [x.__class__ for x in nodes]
+		# (attr,value) pairs of literal attributes, sorted
+		self.literals = [tuple(sorted(x.iter_literal_attrs())) for x in nodes]
+
+		edges = [[(a,x.get_related_name(a),codes[y.id]) for a,y in x.iter_edges()] for x in nodes]
+		self.attr_names = sorted(set(a for e in edges for a,r,_ in e) | set(r for e in edges for a,r,_ in e))
+		attr_codes = {a:i for i,a in enumerate(self.attr_names)}
+		self.offsets, self.targets, self.attrs, self.related = [0], [], [], []
+		for e in edges:
+			for a,r,y in e:
+				self.targets.append(y)
+				self.attrs.append(attr_codes[a])
+				self.related.append(attr_codes[r])
+			self.offsets.append(len(self.targets))
+
+	def __len__(self):
+		return len(self.names)
+
+	def degree(self,i):
+		return self.offsets[i+1] - self.offsets[i]
+
+	def initial_certificate(self,i):
+		# degree, class, literal attributes, attributes with edges
+		return (
+			-self.degree(i),
+			self.classes[i].__name__,
+			self.literals[i],
+			tuple(self.attr_names[a] for a in sorted(set(self.attrs[self.offsets[i]:self.offsets[i+1]]))),
+			)
+
+	def edge_certificate(self,i,labels):
+		targets, attrs = self.targets, self.attrs
+		return tuple(sorted([(labels[targets[k]],attrs[k]) for k in range(self.offsets[i],self.offsets[i+1])]))
+
+	def canonical_form(self,order,mapping):
+		# the CanonicalForm of the graph for a labeling order (nodes) and a mapping of variables to canonical names
+		names = [mapping._dict[x] for x in self.names]
+		attrs = [Attr(names[i],a,v) for i in range(len(self)) for a,v in self.literals[i]]
+		edges = set()
+		for i in range(len(self)):
+			for k in range(self.offsets[i],self.offsets[i+1]):
+				edges.add(Edge.create(names[i],self.attr_names[self.attrs[k]],names[self.targets[k]],self.attr_names[self.related[k]]))
+		return CanonicalForm(tuple(names[i] for i in order),tuple(self.classes[i] for i in order),tuple(sorted(attrs)),tuple(sorted(edges)))
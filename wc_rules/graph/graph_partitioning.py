@@ -1,6 +1,6 @@
 from ..utils.collections import strgen, split_iter, merge_lists, invert_dict
 from .collections import CanonicalForm, Mapping
-from .canonical_labeling import canonical_label
+from .canonical_cache import cached_canonical_label
 from itertools import combinations, product
 from collections import Counter, ChainMap
 from copy import deepcopy
@@ -18,13 +18,15 @@ def partition_canonical_form(labeling,group):
 	lg_nodes, lg_edges,lg_orbits = line_graph(labeling.names,labeling.edges,group.orbits())
 	partition = kernighan_lin(lg_nodes.values(),lg_edges,lg_orbits)
 	g1, g2 = [deinduce(labeling,lg_nodes,x) for x in partition]
-	CL1, CL2 = [canonical_label(x) for x in [g1,g2]]
+	CL1, CL2 = [cached_canonical_label(x) for x in [g1,g2]]
 	return CL1,CL2
 
-def partition_until_edge(labeling,group,examined=set(),partitions=[]):
+def partition_until_edge(labeling,group,examined=None,partitions=None):
 	# input: canonically labeled graph
 	# repeatedly partition with partition_canonical_form until you obtain single-edge graphs
 	# output: examined set of labels (hashed versions), successive partitions of the graph
+	examined = set() if examined is None else examined
+	partitions = [] if partitions is None else partitions
 	CL1, CL2 = partition_canonical_form(labeling,group)
 	if CL1 is None:
 		return examined,partitions
@@ -42,7 +44,7 @@ def partition_until_edge(labeling,group,examined=set(),partitions=[]):
 
 	if L1 not in examined and len(L1.edges)>1:
 		examined,partitions = partition_until_edge(L1,G1,examined,partitions)
-	if L2 not in examined and len(L1.edges)>1:
+	if L2 not in examined and len(L2.edges)>1:
 		examined,partitions = partition_until_edge(L2,G2,examined,partitions)
 
 	return examined,partitions
@@ -58,7 +60,7 @@ def recompose(m1,L1,m2,L2):
 	edges = tuple(sorted(set(L11.edges + L21.edges)))
 	big_L = CanonicalForm(names,classes,attrs,edges)
 	big_g = big_L.build_graph_container()
-	return canonical_label(big_g)
+	return cached_canonical_label(big_g)
 
 
 def line_graph(nodes,edges,orbits):
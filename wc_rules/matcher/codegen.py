@@ -0,0 +1,127 @@
+from ..expressions.executable import Computation
+
+# Generated matching code for a search plan
+# A plan (see PatternMatcher.get_plan) is unrolled into nested loops, one per step:
+#	the root loops over its candidates, a step reached over a to-many attribute loops over it,
+#	a step reached over a to-one attribute is a single assignment
+# with class checks, literal attributes, edges to earlier steps, injectivity against earlier steps
+# of overlapping classes and symmetry-breaking orderings inlined as `continue` statements.
+# Constraints are inlined from their serialized code (the `code` of each executable):
+#	single-variable constraints at the step of their variable
+#	the remaining constraints and computations, in order, in the innermost loop
+# Params and helper match sets are bound to local names before the loops.
+# The generated function yields match dicts, or with count=True returns the number of matches.
+#
+# E.g., for a Lig `lig` with a LigSite `s` and constraint `len(s.bond)==0`, roughly
+#	def match(_roots,_params,_helpers):
+#		for lig in _roots:
+#			if not isinstance(lig,_C0): continue
+#			for s in lig.sites:
+#				if not isinstance(s,_C1): continue
+#				if not (len(s.bond) == 0): continue
+#				yield {'lig':lig,'s':s}
+
+class CodeWriter:
+
+	def __init__(self):
+		self.lines = []
+		self.depth = 1
+		self.constants = dict()
+
+	def write(self,line):
+		self.lines.append('\t'*self.depth + line)
+		return self
+
+	def skip_unless(self,condition):
+		return self.write(f'if not ({condition}): continue')
+
+	def skip_if(self,condition):
+		return self.write(f'if {condition}: continue')
+
+	def constant(self,prefix,value):
+		# binds a value to a global name in the generated code
+		for name,x in self.constants.items():
+			if name.startswith(prefix) and x is value:
+				return name
+		name = f'{prefix}{len(self.constants)}'
+		self.constants[name] = value
+		return name
+
+def is_to_many(_class,attr):
+	return _class.Meta.local_attributes[attr].is_related_to_many
+
+def overlaps(c1,c2):
+	return issubclass(c1,c2) or issubclass(c2,c1)
+
+def generate_source(matcher,steps,orderings=None,count=False):
+	# returns the source of the matching function and the globals it needs
+	w = CodeWriter()
+	names = set(k for c in matcher.remaining_constraints for k in c.keywords)
+	for p in matcher.params:
+		if p in names:
+			w.write(f'{p} = _params[{p!r}]')
+	for h in matcher.helpers:
+		if h in names:
+			w.write(f'{h} = _helpers[{h!r}]')
+	if count:
+		w.write('_n = 0')
+
+	classes = dict()
+	for i,step in enumerate(steps):
+		v = step.variable
+		if step.parent is None:
+			w.write(f'for {v} in _roots:')
+			w.depth += 1
+		elif is_to_many(classes[step.parent],step.attr):
+			w.write(f'for {v} in {step.parent}.{step.attr}:')
+			w.depth += 1
+		else:
+			w.write(f'{v} = {step.parent}.{step.attr}')
+			w.skip_if(f'{v} is None')
+		w.skip_unless(f'isinstance({v},{w.constant("_C",step._class)})')
+		for u,c in classes.items():
+			if overlaps(c,step._class):
+				w.skip_if(f'{v} is {u}')
+		for attr,value in step.literals:
+			w.skip_if(f'{v}.{attr} != {w.constant("_L",value)}')
+		for c in matcher.local_constraints[v]:
+			w.skip_unless(c.code)
+		classes[v] = step._class
+		for attr,u in step.checks:
+			# the reverse of the traversed edge holds by construction
+			if u == step.parent and attr == classes[u].Meta.local_attributes[step.attr].related_name:
+				continue
+			if is_to_many(step._class,attr):
+				w.skip_if(f'{u} not in {v}.{attr}')
+			else:
+				w.skip_if(f'{v}.{attr} is not {u}')
+		for u1,u2 in (orderings[i] if orderings else []):
+			w.skip_unless(f'{u1}.id < {u2}.id')
+
+	assigned = []
+	for c in matcher.remaining_constraints:
+		if isinstance(c,Computation):
+			w.write(f'{c.deps.declared_variable} = {c.code}')
+			assigned.append(c.deps.declared_variable)
+		else:
+			w.skip_unless(c.code)
+	if count:
+		w.write('_n += 1')
+		w.depth = 1
+		w.write('return _n')
+	else:
+		w.write('yield {' + ','.join(f'{v!r}:{v}' for v in [s.variable for s in steps] + assigned) + '}')
+
+	header = 'def match(_roots,_params,_helpers):'
+	return '\n'.join([header] + w.lines), w.constants
+
+def compile_plan(matcher,steps,orderings=None,count=False):
+	source, constants = generate_source(matcher,steps,orderings,count)
+	namespace = dict()
+	for c in matcher.constraints:
+		namespace.update((k,v) for k,v in c.builtins.items() if k != '__builtins__')
+	namespace.update(constants)
+	exec(compile(source,f'<pattern matcher {id(matcher)}>','exec'),namespace)
+	fn = namespace['match']
+	fn.source = source
+	return fn
@@ -0,0 +1,81 @@
+from ..simulator.index import ancestors
+from .matcher import attribute_chain
+from collections import defaultdict
+
+# An index from edge types to the patterns that contain them
+# The type of an edge is the unordered pair of its ports (class,attr), e.g.,
+# {(LigSite,'bond'),(RecSite,'bond')}; literal attributes of the endpoints are not part of the type.
+# Each edge of a pattern graph is recorded as an occurrence (u,attr,v) of the pattern under its type.
+#
+# Given an AddEdge, its type is looked up over all ancestor classes of its endpoints,
+# and each occurrence is searched by seeding the pattern with the two endpoints.
+# Only patterns containing an edge of that type are searched.
+# These are the matches that contain the new edge; matches that appear because a constraint
+# reads the new edge, e.g. `len(s.bond)==1` on a pattern without the bond, are not found this way.
+# CandidatePool.touch (simulator/rssa.py), used by RejectionRule and LocalRule, keeps an index of its pattern
+# and searches an added edge only from its occurrences, unless constraints read the edge (reads_attribute).
+
+def reads_attribute(matcher,attr):
+	# whether constraints of a pattern may read attr of its nodes
+	# attribute chains past the pattern, and methods of nodes, may read anything
+	if matcher.reach > 0:
+		return True
+	namespace = matcher.graph.namespace
+	for c in matcher.constraints:
+		for m in attribute_chain.finditer(c.code):
+			if m.group(1) in namespace:
+				a = m.group(2).split('.')[1]
+				if a == attr or a not in namespace[m.group(1)].Meta.local_attributes:
+					return True
+	return False
+
+def edge_type(c1,a1,c2,a2):
+	return frozenset([(c1,a1),(c2,a2)])
+
+class EdgeIndex:
+
+	def __init__(self,matchers=()):
+		# edge type: [(matcher,u,attr,v)] with u.attr containing v
+		self.occurrences = defaultdict(list)
+		# matcher: edge types of its graph
+		self.types = dict()
+		for m in matchers:
+			self.add_pattern(m)
+
+	def add_pattern(self,matcher):
+		if matcher in self.types:
+			return self
+		g, types = matcher.graph, set()
+		for edge in g.iter_edges():
+			u,attr,v,related_attr = edge.unpack()
+			t = edge_type(g[u].__class__,attr,g[v].__class__,related_attr)
+			self.occurrences[t].append((matcher,u,attr,v))
+			types.add(t)
+		self.types[matcher] = types
+		return self
+
+	def get_occurrences(self,source,attr,target,related_attr):
+		# occurrences (matcher,seed) of the edge source.attr--target.related_attr
+		for c1 in ancestors(source.__class__):
+			for c2 in ancestors(target.__class__):
+				for matcher,u,a,v in self.occurrences.get(edge_type(c1,attr,c2,related_attr),()):
+					for x,y in [(source,target),(target,source)]:
+						if a == (attr if x is source else related_attr) and isinstance(x,matcher.graph[u].__class__) and isinstance(y,matcher.graph[v].__class__):
+							yield matcher, {u:x,v:y}
+
+	def get_patterns(self,sim,action):
+		# matchers that can contain the edge added by an AddEdge
+		return set(m for m,_ in self.get_occurrences(*self.get_endpoints(sim,action)))
+
+	def get_endpoints(self,sim,action):
+		return sim.resolve(action.source_idx), action.source_attr, sim.resolve(action.target_idx), action.target_attr
+
+	def iter_new_matches(self,sim,action,params=dict()):
+		# (matcher,match) for matches containing the edge added by an AddEdge, each yielded once
+		seen = set()
+		for matcher,seed in self.get_occurrences(*self.get_endpoints(sim,action)):
+			for match in matcher.iter_matches(sim,params,seed=seed):
+				key = (matcher,tuple(match[v].id for v in matcher.variables))
+				if key not in seen:
+					seen.add(key)
+					yield matcher, match
@@ -0,0 +1,77 @@
+from ..graph.canonical_cache import cached_canonical_label
+import re
+
+# A cache of helper match sets, shared by all rules and patterns matched on a SimulationState
+# Helpers are keyed by pattern_key, so helpers that are canonically identical share an entry
+# even if they are different Pattern objects with different variable names.
+# The key of a pattern is
+#	the canonical form of its graph (see canonical_labeling.py)
+#	its constraints, with variables renamed to their canonical names,
+#	taking the least renaming over the automorphisms of the graph
+#	the keys of its own helpers, with helper names replaced by placeholders
+# An entry is keyed by the pattern key and the values of the params the pattern reads.
+#
+# Each SimulationState holds a cache and counts the changes to instances of each class.
+# An entry records the counts of its classes (PatternMatcher.classes) when it was built
+# and is rebuilt as a fresh match set when requested after one of them changed,
+# or after any action if a constraint reads beyond the pattern,
+# so a helper is evaluated at most once per change to instances of its classes, not per change to its own nodes:
+# any change to an instance of one of its classes rebuilds it, whether or not its matches involve that instance.
+# Like attribute indexes, this assumes nodes are changed through actions, update() and remove().
+# Renaming is textual, on identifiers not preceded by `.`, and does not look inside string literals.
+#
+# A shared match set is bound to the matcher that built it. The renaming that gives the key
+# (PatternMatcher.canonical_names) takes variables of each matcher to canonical names,
+# so another matcher with the same key sees the match set through its own variables (see MatchSet.renamed).
+
+def rename(code,names):
+	if not names:
+		return code
+	pattern = r'(?<![\w.])(' + '|'.join(re.escape(x) for x in sorted(names,key=len,reverse=True)) + r')(?!\w)'
+	return re.sub(pattern,lambda m: names[m.group(1)],code)
+
+def pattern_key(matcher):
+	# the key, and the renaming of variables to canonical names it was taken under
+	helper_keys = {h:m.key for h,m in matcher.helpers.items()}
+	placeholders = {k:f'_h{i}' for i,k in enumerate(sorted(set(helper_keys.values()),key=repr))}
+	names = {h:placeholders[k] for h,k in helper_keys.items()}
+	if not matcher.variables:
+		form, renamings = None, [names]
+	else:
+		mapping, form, group = cached_canonical_label(matcher.graph)
+		canonical = mapping.reverse()
+		renamings = [dict(names,**{v:canonical.get(g.get(v)) for v in matcher.variables}) for g in group.duplicate(mapping).expand()]
+	constraints, renaming = min(((tuple(sorted(rename(c.code,r) for c in matcher.constraints)),r) for r in renamings),key=lambda x: x[0])
+	return (form, constraints, tuple(sorted(placeholders.items(),key=repr))), {v:renaming[v] for v in matcher.variables}
+
+def get_params(matcher):
+	# names of the params read by a pattern and its helpers
+	return set(matcher.params).union(*[get_params(m) for m in matcher.helpers.values()])
+
+def get_classes(matcher):
+	# classes whose instances, when touched, invalidate the matches of a pattern
+	# constraints that read beyond the pattern (see PatternMatcher.reach) may read nodes of any class
+	if matcher.reach or any(get_classes(m) == (object,) for m in matcher.helpers.values()):
+		return (object,)
+	return tuple(matcher.classes)
+
+class HelperCache:
+
+	def __init__(self,sim):
+		self.sim = sim
+		# key: (classes,version of the classes when the entry was built,match set)
+		self.entries = dict()
+		self.hits, self.misses = 0, 0
+
+	def get(self,matcher,params,make):
+		# the entry for a helper matcher and params, rebuilt with make() if missing or out of date
+		key = (matcher.key,tuple(sorted((p,params[p]) for p in get_params(matcher) if p in params)))
+		entry = self.entries.get(key)
+		if entry is not None and entry[1] == self.sim.get_version(entry[0]):
+			self.hits += 1
+			return entry[2]
+		self.misses += 1
+		classes = get_classes(matcher)
+		x = make()
+		self.entries[key] = (classes,self.sim.get_version(classes),x)
+		return x
@@ -0,0 +1,561 @@
+from ..modeling.pattern import Pattern
+from ..expressions.executable import Computation
+from ..graph.canonical_cache import cached_canonical_label
+from ..graph.permutations import PermutationGroup
+from .codegen import compile_plan
+from .helpers import pattern_key
+from collections import deque, ChainMap
+import ast, re
+
+# A backtracking matcher for patterns
+# A pattern is unrolled into
+#	a graph (the GraphContainer at the root of the parent chain)
+#	constraints (executables, in the order they are declared from root to leaf)
+#	helpers and params
+# Matching a pattern on a simulation state proceeds by
+#	choosing a root variable and an order of the remaining variables (see Search plans below)
+#	each subsequent variable is reached by traversing an edge from a visited variable
+#	candidates are checked for class, literal attributes and edges to visited variables
+#	complete assignments are checked against the constraints
+# A match is a dict {variable: node} extended with assigned variables from computations
+#
+# Search plans
+# Without a seed, the search follows a plan chosen from the statistics of the simulation state.
+# The estimated cardinality of a variable is the number of root candidates it would have:
+#	instances of its class (see simulator/index.py)
+#	or, with attribute indexes, the smallest bucket selected by its literal attributes
+#	and constraints of the forms `x.attr == literal` and `len(x.attr) == n`
+# The plan starts from the variable with the lowest estimate and then greedily traverses
+# to-one edges before to-many edges, and among those, to the variable with the lowest estimate.
+# Plans are cached and rebuilt when any estimate drifts by more than a factor of `drift`.
+# Candidates from a bucket are still checked, so indexes only prune the search.
+#
+# With symmetry breaking, a matcher enumerates one match per orbit of the automorphism group of the pattern
+# (from canonical_label), restricted to automorphisms that fix every variable used by a constraint.
+# The group acts freely on matches, so every orbit has count_symmetries() matches.
+# Representatives are selected by orderings on node ids, found as in Grochow & Kellis (2007):
+#	take the first variable v with a nontrivial orbit, require id(v) < id(w) for w in its orbit,
+#	restrict the group to the stabilizer of v and repeat.
+# Matches extending a seed are enumerated without orderings.
+# MatchSet counts, samples and lists all matches by applying the automorphisms to the representatives.
+#
+# Constraints on a single variable, e.g., `len(s.bond)==0`, are checked when the variable is assigned.
+# Counting does not materialize matches: if no other constraints remain,
+# the search tree is traversed without building match dicts.
+# MatchSet counts on demand and enumerates matches only to sample or list them,
+# so rules that are updated but do not fire hold no matches.
+#
+# Unseeded searches run generated code for the plan (see codegen.py), unless `compiled` is False.
+# Seeded searches, which are short, are interpreted.
+#
+# Locality
+# A match can only appear or disappear if an action touches one of its nodes,
+# or a node that a constraint reads through an attribute chain, e.g., `s.bond.active` reads the partner of s.
+# `reach` is the number of hops such chains take beyond the pattern (1 for `s.bond.active`),
+# so the matches affected by touched nodes contain a node of neighborhood(sim,ids), the nodes within reach.
+# A search seeded at variable v visits nodes within eccentricity(v) <= diameter hops of the seed.
+#
+# Sampling
+# If every variable can be reached from a variable r over to-one attributes (sampling_root),
+# each candidate for r extends to at most one match, so drawing candidates for r without replacement
+# and extending them yields matches in uniformly random order, visiting only as many nodes as are drawn.
+
+def unroll_pattern(pattern):
+	patterns = deque()
+	while isinstance(pattern,Pattern):
+		patterns.appendleft(pattern)
+		pattern = pattern.parent
+	graph, constraints, helpers, params = pattern, [], dict(), []
+	for p in patterns:
+		constraints.extend(p.make_executable_constraints())
+		helpers.update(p.helpers)
+		params.extend(p.params)
+	return graph, constraints, helpers, params
+
+def check_constraints(constraints,match,helpers,params):
+	# returns the match extended with computed variables, or None if a constraint fails
+	namespace = ChainMap(match,helpers,params)
+	for c in constraints:
+		v = c.exec(namespace)
+		if isinstance(c,Computation):
+			match[c.deps.declared_variable] = v
+		elif not v:
+			return None
+	return match
+
+value_test = re.compile(r'^(\w+)\.(\w+) == (.+)$')
+degree_test = re.compile(r'^len\((\w+)\.(\w+)\) == (\d+)$')
+
+def get_index_tests(graph,constraints):
+	# {variable: [(attr,related,key)]} of tests that attribute indexes can answer
+	tests = {v:[(a,False,x) for a,x in graph[v].iter_literal_attrs()] for v in graph.keys()}
+	for c in constraints:
+		for regex,related in [(degree_test,True),(value_test,False)]:
+			m = regex.match(c.code)
+			if m is None or m.group(1) not in tests:
+				continue
+			try:
+				key = ast.literal_eval(m.group(3))
+			except (ValueError,SyntaxError):
+				break
+			tests[m.group(1)].append((m.group(2),related,key))
+			break
+	return tests
+
+attribute_chain = re.compile(r'\b([A-Za-z_]\w*)((?:\.[A-Za-z_]\w*)+)')
+
+def get_reach(variables,constraints):
+	# hops beyond a variable taken by attribute chains in constraints
+	reach = 0
+	for c in constraints:
+		for m in attribute_chain.finditer(c.code):
+			if m.group(1) in variables:
+				reach = max(reach,m.group(2).count('.')-1)
+	return reach
+
+def get_eccentricities(graph):
+	# {variable: largest number of edges on a shortest path to another variable}
+	eccentricities = dict()
+	for root in graph.keys():
+		dist, queue = {root:0}, deque([root])
+		while queue:
+			v = queue.popleft()
+			for _,x in graph[v].iter_edges():
+				if x.id not in dist:
+					dist[x.id] = dist[v] + 1
+					queue.append(x.id)
+		eccentricities[root] = max(dist.values())
+	return eccentricities
+
+def get_helper_matches(helpers,sim,params):
+	# match sets of helper matchers, shared through the helper cache of the simulation state
+	cache = sim.helper_cache
+	return {h:cache.get(m,params,lambda m=m: MatchSet(m,sim,params)).renamed(m) for h,m in helpers.items()}
+
+class SearchStep:
+	# variable: pattern variable assigned at this step
+	# parent, attr: candidates are parent_node.attr (parent is None for the root)
+	# checks: (attr,variable) pairs that must be edges to already-assigned variables
+	__slots__ = ['variable','_class','parent','attr','literals','checks']
+
+	def __init__(self,variable,_class,parent,attr,literals,checks):
+		self.variable = variable
+		self._class = _class
+		self.parent = parent
+		self.attr = attr
+		self.literals = literals
+		self.checks = checks
+
+class PatternMatcher:
+
+	def __init__(self,pattern,symmetry_breaking=False):
+		self.pattern = pattern
+		self.graph, self.constraints, helpers, self.params = unroll_pattern(pattern)
+		self.helpers = {h:PatternMatcher(p) for h,p in helpers.items()}
+		self.variables = self.graph.keys()
+		self.index_tests = get_index_tests(self.graph,[c for c in self.constraints if not isinstance(c,Computation)])
+		# constraints checked when their only variable is assigned, and the remaining ones
+		self.local_constraints = {v:[] for v in self.variables}
+		self.remaining_constraints = []
+		for c in self.constraints:
+			if not isinstance(c,Computation) and len(c.keywords)==1 and c.keywords[0] in self.local_constraints:
+				self.local_constraints[c.keywords[0]].append(c)
+			else:
+				self.remaining_constraints.append(c)
+		self._steps = dict()
+		self._plan, self._estimates = None, None
+		self._compiled = dict()
+		self.eccentricities = get_eccentricities(self.graph)
+		self.diameter = max(self.eccentricities.values(),default=0)
+		self.reach = get_reach(set(self.variables),self.constraints)
+		self.sampling_root = self.get_sampling_root()
+		self.symmetry_breaking = symmetry_breaking and len(self.variables) > 1
+		self.automorphisms = self.get_automorphisms() if self.symmetry_breaking else []
+		self.symmetries = PermutationGroup.create(self.automorphisms).count_symmetries() if self.automorphisms else 1
+		self.orderings = self.get_orderings() if self.symmetry_breaking else []
+		self._step_orderings = dict()
+		self._key, self._canonical_names = None, None
+
+	@property
+	def key(self):
+		# canonical key of the pattern, see helpers.py
+		if self._key is None:
+			self._key, self._canonical_names = pattern_key(self)
+		return self._key
+
+	@property
+	def canonical_names(self):
+		# {variable: canonical name} under which the key was taken
+		self.key
+		return self._canonical_names
+
+	@property
+	def classes(self):
+		# all classes whose instances can participate in a match, including helpers
+		classes = set(self.graph.namespace.values())
+		for m in self.helpers.values():
+			classes.update(m.classes)
+		return classes
+
+	def get_steps(self,root):
+		if root not in self._steps:
+			self._steps[root] = self.build_steps(root)
+		return self._steps[root]
+
+	def build_steps(self,root,estimates=None):
+		# BFS order from root, or with estimates, the cheapest edge out of the visited variables first
+		g, visited, steps = self.graph, [], []
+		queue = deque([(root,None,None)])
+		while queue:
+			if estimates is not None:
+				queue = deque(sorted(queue,key=lambda x: self.edge_cost(*x,estimates)))
+			v, parent, attr = queue.popleft()
+			if v in visited:
+				continue
+			visited.append(v)
+			node = g[v]
+			literals = tuple(node.iter_literal_attrs())
+			checks = tuple((a,x.id) for a,x in node.iter_edges() if x.id in visited)
+			steps.append(SearchStep(v,node.__class__,parent,attr,literals,checks))
+			queue.extend((x.id,v,a) for a,x in node.iter_edges() if x.id not in visited)
+		return steps
+
+	####### Search plans
+	drift = 2.0
+
+	def edge_cost(self,v,parent,attr,estimates):
+		if parent is None:
+			return (False,estimates[v])
+		to_many = self.graph[parent].__class__.Meta.local_attributes[attr].is_related_to_many
+		return (to_many,estimates[v])
+
+	def estimate(self,sim):
+		return {v:len(self.root_candidates(v,sim)) for v in self.variables}
+
+	def has_drifted(self,estimates):
+		return any(max(a,1) > self.drift*max(b,1) or max(b,1) > self.drift*max(a,1) for a,b in zip(estimates.values(),self._estimates.values()))
+
+	def get_plan(self,sim):
+		# the steps of the cached plan, rebuilt if statistics have drifted
+		estimates = self.estimate(sim)
+		if self._plan is None or self.has_drifted(estimates):
+			root = min(self.variables,key=estimates.get)
+			self._plan, self._estimates = self.build_steps(root,estimates), estimates
+		return self._plan
+
+	####### Symmetry breaking
+	def get_automorphisms(self):
+		# automorphisms of the graph that fix variables used by constraints
+		mapping, _, group = cached_canonical_label(self.graph)
+		fixed = set(self.variables) & set(v for c in self.constraints for v in c.keywords)
+		return [g for g in group.duplicate(mapping).expand() if all(g.get(v)==v for v in fixed)]
+
+	def get_orderings(self):
+		# pairs (v,w) such that matches with id(v) < id(w) are orbit representatives
+		group, orderings = self.automorphisms, []
+		for v in self.variables:
+			orbit = sorted(set(g.get(v) for g in group) - {v})
+			orderings.extend((v,w) for w in orbit)
+			group = [g for g in group if g.get(v)==v]
+		return orderings
+
+	def get_step_orderings(self,steps):
+		# orderings checked at each step, once both variables are assigned
+		key = tuple(step.variable for step in steps)
+		if key not in self._step_orderings:
+			position = {v:i for i,v in enumerate(key)}
+			orderings = [[] for _ in position]
+			for v,w in self.orderings:
+				orderings[max(position[v],position[w])].append((v,w))
+			self._step_orderings[key] = orderings
+		return self._step_orderings[key]
+
+	def permute(self,match,g):
+		# the match composed with an automorphism
+		permuted = dict(match)
+		for v in self.variables:
+			permuted[v] = match[g.get(v)]
+		return permuted
+
+	####### Locality
+	def neighborhood(self,sim,ids):
+		# ids of nodes within reach of ids, including ids of removed nodes
+		ids, frontier = set(ids), [sim.state[idx] for idx in ids if idx in sim.state]
+		for _ in range(self.reach):
+			frontier = [y for x in frontier for y in x.listget_all_related() if y.id not in ids]
+			ids.update(y.id for y in frontier)
+		return ids
+
+	def iter_local_matches(self,sim,ids,params=dict()):
+		# matches containing a node of ids, each yielded once
+		seen = set()
+		for idx in ids:
+			node = sim.state.get(idx)
+			if node is None:
+				continue
+			for v,_class in self.graph.namespace.items():
+				if not isinstance(node,_class):
+					continue
+				for match in self.iter_matches(sim,params,seed={v:node}):
+					key = tuple(match[u].id for u in self.variables)
+					if key not in seen:
+						seen.add(key)
+						yield match
+
+	####### Sampling
+	def get_sampling_root(self):
+		# a variable from which every variable is reached over to-one attributes, or None
+		return next((v for v in self.variables if len(self.to_one_closure(v))==len(self.variables)),None)
+
+	def to_one_closure(self,root):
+		reached, stack = {root}, [root]
+		while stack:
+			node = self.graph[stack.pop()]
+			for attr,x in node.iter_edges():
+				if x.id not in reached and not node.__class__.Meta.local_attributes[attr].is_related_to_many:
+					reached.add(x.id)
+					stack.append(x.id)
+		return reached
+
+	def iter_random_matches(self,sim,rng,params=dict()):
+		# matches in uniformly random order, extended from root candidates drawn without replacement
+		root = self.sampling_root
+		candidates, tried = self.root_candidates(root,sim), set()
+		while len(tried) < len(candidates):
+			if 2*len(tried) < len(candidates):
+				nodes = candidates.sample(1,rng)
+			else:
+				# once most candidates are tried, draw the rest in one shuffle
+				nodes = [x for x in candidates if x.id not in tried]
+				nodes = rng.sample(nodes,len(nodes))
+			for node in nodes:
+				if node.id not in tried:
+					tried.add(node.id)
+					yield from self.iter_matches(sim,params,seed={root:node})
+
+	####### Generated code
+	compiled = True
+
+	def get_compiled(self,steps,count=False):
+		key = (tuple(step.variable for step in steps),count)
+		if key not in self._compiled:
+			orderings = self.get_step_orderings(steps) if self.orderings else None
+			self._compiled[key] = compile_plan(self,steps,orderings,count)
+		return self._compiled[key]
+
+	def run_compiled(self,sim,params,count=False):
+		steps = self.get_plan(sim)
+		helpers = get_helper_matches(self.helpers,sim,params)
+		return self.get_compiled(steps,count)(list(self.root_candidates(steps[0].variable,sim)),params,helpers)
+
+	####### Matching
+	def iter_matches(self,sim,params=dict(),seed=dict()):
+		# seed is a partial assignment {variable:node} that matches must extend
+		# with symmetry breaking and no seed, yields one representative per orbit
+		if not self.variables:
+			return
+		if self.compiled and not seed:
+			yield from self.run_compiled(sim,params)
+			return
+		root = next((v for v in self.variables if v in seed),None)
+		steps = self.get_steps(root) if root is not None else self.get_plan(sim)
+		orderings = self.get_step_orderings(steps) if self.orderings and not seed else None
+		helpers = get_helper_matches(self.helpers,sim,params)
+		for match in self.extend(steps,0,dict(),set(),sim,seed,orderings):
+			match = check_constraints(self.remaining_constraints,match,helpers,params)
+			if match is not None:
+				yield match
+
+	def iter_candidates(self,step,match,sim,seed):
+		if step.variable in seed:
+			return [seed[step.variable]]
+		if step.parent is None:
+			return self.root_candidates(step.variable,sim)
+		return match[step.parent].listget(step.attr)
+
+	def root_candidates(self,variable,sim):
+		_class = self.graph[variable].__class__
+		candidates = sim.get_nodes(_class)
+		if sim.index.attributes:
+			for attr,related,key in self.index_tests[variable]:
+				bucket = sim.index.get_bucket(_class,attr,related,key)
+				if bucket is not None and len(bucket) < len(candidates):
+					candidates = bucket
+		return candidates
+
+	def is_candidate(self,node,step,match,used):
+		if node.id in used or not isinstance(node,step._class):
+			return False
+		for attr,value in step.literals:
+			if node.get(attr) != value:
+				return False
+		for c in self.local_constraints[step.variable]:
+			if not c.exec({step.variable:node}):
+				return False
+		match[step.variable] = node
+		for attr,v in step.checks:
+			if match[v] not in node.listget(attr):
+				del match[step.variable]
+				return False
+		del match[step.variable]
+		return True
+
+	def extend(self,steps,i,match,used,sim,seed,orderings=None):
+		if i == len(steps):
+			yield dict(match)
+			return
+		step = steps[i]
+		for node in list(self.iter_candidates(step,match,sim,seed)):
+			if not self.is_candidate(node,step,match,used):
+				continue
+			match[step.variable] = node
+			if orderings and not all(match[v].id < match[w].id for v,w in orderings[i]):
+				del match[step.variable]
+				continue
+			used.add(node.id)
+			yield from self.extend(steps,i+1,match,used,sim,seed,orderings)
+			used.remove(node.id)
+			del match[step.variable]
+
+	def check_constraints(self,match,helpers,params):
+		return check_constraints(self.constraints,match,helpers,params)
+
+	####### Counting
+	def count(self,sim,params=dict()):
+		return self.symmetries*self.count_representatives(sim,params)
+
+	def count_representatives(self,sim,params=dict()):
+		# number of matches yielded by iter_matches(sim,params)
+		if not self.variables:
+			return 0
+		if self.compiled:
+			return self.run_compiled(sim,params,count=True)
+		if self.remaining_constraints:
+			return sum(1 for _ in self.iter_matches(sim,params))
+		steps = self.get_plan(sim)
+		orderings = self.get_step_orderings(steps) if self.orderings else None
+		return self.count_extensions(steps,0,dict(),set(),sim,orderings)
+
+	def count_extensions(self,steps,i,match,used,sim,orderings=None):
+		step, last, n = steps[i], i == len(steps)-1, 0
+		for node in list(self.iter_candidates(step,match,sim,dict())):
+			if not self.is_candidate(node,step,match,used):
+				continue
+			match[step.variable] = node
+			if orderings and not all(match[v].id < match[w].id for v,w in orderings[i]):
+				del match[step.variable]
+				continue
+			if last:
+				n += 1
+			else:
+				used.add(node.id)
+				n += self.count_extensions(steps,i+1,match,used,sim,orderings)
+				used.remove(node.id)
+			del match[step.variable]
+		return n
+
+class MatchSet:
+	# the set of matches of a pattern on a simulation state
+	# bound to variables in rate laws, helper constraints and actions
+	# e.g. `x.count()`, `h.contains(a=b)`
+	# matches are only enumerated when needed
+
+	def __init__(self,matcher,sim,params=dict()):
+		self.matcher = matcher
+		self.sim = sim
+		self.params = params
+		self._matches = None
+		self._count = None
+
+	@property
+	def representatives(self):
+		if self._matches is None:
+			self._matches = list(self.matcher.iter_matches(self.sim,self.params))
+		return self._matches
+
+	@property
+	def matches(self):
+		if self.matcher.symmetries == 1:
+			return self.representatives
+		return [self.matcher.permute(m,g) for m in self.representatives for g in self.matcher.automorphisms]
+
+	def count(self):
+		if self._count is None:
+			n = len(self._matches) if self._matches is not None else self.matcher.count_representatives(self.sim,self.params)
+			self._count = self.matcher.symmetries*n
+		return self._count
+
+	def contains(self,**kwargs):
+		err = 'Unknown variables {} for pattern with variables {}.'
+		assert all(k in self.matcher.variables for k in kwargs), err.format(sorted(set(kwargs)-set(self.matcher.variables)),sorted(self.matcher.variables))
+		if self._matches is not None and self.matcher.symmetries == 1:
+			return any(all(m[k] is v for k,v in kwargs.items()) for m in self._matches)
+		return any(True for _ in self.matcher.iter_matches(self.sim,self.params,seed=kwargs))
+
+	def sample(self,n,rng):
+		# draws the same matches as rng.sample(self.matches,n)
+		# without materializing matches past the last one drawn
+		k = self.matcher.symmetries
+		idxs = rng.sample(range(self.count()),n)
+		if self._matches is not None:
+			chosen = {i//k:self._matches[i//k] for i in idxs}
+		else:
+			wanted, chosen = set(i//k for i in idxs), dict()
+			for j,match in enumerate(self.matcher.iter_matches(self.sim,self.params)):
+				if j in wanted:
+					chosen[j] = match
+					if len(chosen) == len(wanted):
+						break
+		# match i is the (i%k)-th automorphism of the (i//k)-th representative
+		if k == 1:
+			return [chosen[i] for i in idxs]
+		return [self.matcher.permute(chosen[i//k],self.matcher.automorphisms[i%k]) for i in idxs]
+
+	def renamed(self,matcher):
+		# the match set as seen by a matcher with the same key, e.g., a helper with other variable names
+		if matcher is self.matcher:
+			return self
+		variables = {c:v for v,c in self.matcher.canonical_names.items()}
+		names = {v:variables[c] for v,c in matcher.canonical_names.items()}
+		if all(k==v for k,v in names.items()):
+			return self
+		return RenamedMatchSet(self,names)
+
+	def __len__(self):
+		return self.count()
+
+	def __iter__(self):
+		return iter(self.matches)
+
+class RenamedMatchSet:
+	# a MatchSet under other variable names, with names = {variable: variable of the MatchSet}
+	# the matches, and their count, are those of the MatchSet
+
+	def __init__(self,matchset,names):
+		self.matchset = matchset
+		self.names = names
+
+	def rename(self,match):
+		inverse = {v:k for k,v in self.names.items()}
+		return {inverse.get(k,k):v for k,v in match.items()}
+
+	@property
+	def matches(self):
+		return [self.rename(m) for m in self.matchset.matches]
+
+	def count(self):
+		return self.matchset.count()
+
+	def contains(self,**kwargs):
+		err = 'Unknown variables {} for pattern with variables {}.'
+		assert all(k in self.names for k in kwargs), err.format(sorted(set(kwargs)-set(self.names)),sorted(self.names))
+		return self.matchset.contains(**{self.names[k]:v for k,v in kwargs.items()})
+
+	def sample(self,n,rng):
+		return [self.rename(m) for m in self.matchset.sample(n,rng)]
+
+	def __len__(self):
+		return self.count()
+
+	def __iter__(self):
+		return iter(self.matches)
@@ -0,0 +1,333 @@
+from .matcher import MatchSet, check_constraints, get_helper_matches
+from ..expressions.executable import Constraint
+from ..simulator.ssa import SimulationRule, touched_ids
+from collections import defaultdict
+
+# A Rete-style network of patterns, updated incrementally from the action stream of a SimulationState
+#
+# Alpha nodes hold the ids of nodes that pass per-node tests:
+#	class and literal attributes from the pattern graph
+#	constraints whose only variable is the node, e.g., `len(s.bond) == 0`
+# Beta nodes hold tokens, tuples of node ids that match the first k steps of a search order
+# (see PatternMatcher.get_steps). Beta node k joins tokens of beta node k-1 with nodes of an alpha node
+# over the edge from an earlier step and checks the remaining edges to earlier steps.
+# Terminal nodes turn tokens into matches by evaluating the remaining constraints and computations.
+#
+# Alpha and beta nodes are shared between patterns with the same tests in the same order,
+# e.g., patterns built on the same graph share beta nodes up to the first node with a different constraint.
+#
+# Primary actions are collected as touched node ids and propagated when a match set is next read:
+#	alpha memories retest touched nodes
+#	tokens containing touched nodes are removed, then rederived
+#	by extending parent tokens that contain touched nodes,
+#	and by joining touched nodes to parent tokens through their edges.
+# This assumes a token can only change when one of its nodes is touched.
+# Patterns with helpers do not satisfy this; their terminals reevaluate all tokens on every change.
+# Patterns whose constraints read beyond the pattern, e.g. `s.bond.active` (PatternMatcher.reach > 0),
+# do not satisfy it either, and are not compiled; ReteRule searches them in full on every update.
+
+class AlphaNode:
+
+	def __init__(self,_class,literals,variable=None,constraints=()):
+		self._class = _class
+		self.literals = literals
+		self.variable = variable
+		self.constraints = constraints
+		self.memory = set()
+
+	def test(self,node):
+		if not isinstance(node,self._class):
+			return False
+		if any(node.get(attr) != value for attr,value in self.literals):
+			return False
+		return all(c.exec({self.variable:node}) for c in self.constraints)
+
+	def update(self,node):
+		if self.test(node):
+			self.memory.add(node.id)
+		else:
+			self.memory.discard(node.id)
+
+class BetaNode:
+	# join: a token t extends to nodes x in alpha with x in t[parent].attr
+	# and t[j] in x.attr for each (attr,j) in checks
+
+	def __init__(self,parent,alpha,position=None,attr=None,related_attr=None,checks=()):
+		self.parent = parent
+		self.alpha = alpha
+		self.position = position
+		self.attr = attr
+		self.related_attr = related_attr
+		self.checks = checks
+		self.tokens = set()
+		self.index = defaultdict(set)
+
+	def add(self,token):
+		if token not in self.tokens:
+			self.tokens.add(token)
+			for idx in token:
+				self.index[idx].add(token)
+
+	def remove(self,token):
+		self.tokens.discard(token)
+		for idx in token:
+			self.index[idx].discard(token)
+			if not self.index[idx]:
+				del self.index[idx]
+
+	def containing(self,ids):
+		return set().union(*[self.index.get(idx,()) for idx in ids])
+
+	def extend(self,token,state):
+		# nodes that extend a parent token
+		for x in state[token[self.position]].listget(self.attr):
+			if x.id in self.alpha.memory and x.id not in token and self.check(token,x,state):
+				yield token + (x.id,)
+
+	def check(self,token,x,state):
+		return all(state[token[j]] in x.listget(attr) for attr,j in self.checks)
+
+	def join(self,x,state):
+		# parent tokens that a node extends
+		for y in x.listget(self.related_attr):
+			for token in list(self.parent.index.get(y.id,())):
+				if token[self.position] == y.id and x.id not in token and self.check(token,x,state):
+					yield token + (x.id,)
+
+	def populate(self,state):
+		if self.parent is None:
+			for idx in self.alpha.memory:
+				self.add((idx,))
+		else:
+			for token in self.parent.tokens:
+				for t in self.extend(token,state):
+					self.add(t)
+
+	def update(self,ids,state):
+		for token in self.containing(ids):
+			self.remove(token)
+		if self.parent is None:
+			for idx in ids:
+				if idx in self.alpha.memory:
+					self.add((idx,))
+			return
+		for token in self.parent.containing(ids):
+			for t in self.extend(token,state):
+				self.add(t)
+		for idx in ids:
+			if idx in self.alpha.memory:
+				for t in self.join(state[idx],state):
+					self.add(t)
+
+def within_pattern(matcher):
+	# whether the constraints of a pattern and its helpers only read nodes of the pattern
+	return matcher.reach == 0 and all(within_pattern(m) for m in matcher.helpers.values())
+
+class ReteMatchSet:
+	# matches of a pattern held by a terminal node
+	# same interface as MatchSet
+
+	def __init__(self,network,pattern,beta,variables,constraints,helpers,params):
+		self.network = network
+		# terminals are keyed by id(pattern); holding the pattern keeps the id from being reused
+		self.pattern = pattern
+		self.beta = beta
+		self.variables = variables
+		self.constraints = constraints
+		self.helpers = helpers
+		self.params = params
+		self.local = not helpers
+		self.populate()
+
+	def evaluate(self,token):
+		state = self.network.sim.state
+		match = {v:state[idx] for v,idx in zip(self.variables,token)}
+		return check_constraints(self.constraints,match,self.helpers,self.params)
+
+	def add(self,token):
+		if token in self.values:
+			return
+		match = self.evaluate(token)
+		if match is not None:
+			self.positions[token] = len(self.keys)
+			self.keys.append(token)
+			self.values[token] = match
+			for idx in token:
+				self.index[idx].add(token)
+
+	def remove(self,token):
+		# swap with the last key to keep sampling O(1)
+		i, last = self.positions.pop(token), self.keys.pop()
+		if last != token:
+			self.keys[i] = last
+			self.positions[last] = i
+		del self.values[token]
+		for idx in token:
+			self.index[idx].discard(token)
+			if not self.index[idx]:
+				del self.index[idx]
+
+	def populate(self):
+		self.keys, self.positions, self.values, self.index = [], dict(), dict(), defaultdict(set)
+		if self.beta is not None:
+			for token in self.beta.tokens:
+				self.add(token)
+
+	def update(self,ids):
+		if not self.local:
+			return self.populate()
+		for token in set().union(*[self.index.get(idx,()) for idx in ids]):
+			self.remove(token)
+		for token in self.beta.containing(ids):
+			self.add(token)
+
+	@property
+	def matches(self):
+		self.network.refresh()
+		return [self.values[k] for k in self.keys]
+
+	def count(self):
+		self.network.refresh()
+		return len(self.keys)
+
+	def contains(self,**kwargs):
+		return any(all(m[k] is v for k,v in kwargs.items()) for m in self.matches)
+
+	def sample(self,n,rng):
+		self.network.refresh()
+		return [self.values[k] for k in rng.sample(self.keys,n)]
+
+	def __len__(self):
+		return self.count()
+
+	def __iter__(self):
+		return iter(self.matches)
+
+class ReteNetwork:
+
+	def __init__(self,sim):
+		self.sim = sim
+		self.alphas = dict()
+		self.betas = dict()
+		self.terminals = dict()
+		self.alphas_by_class = dict()
+		self.touched = set()
+		sim.subscribe(self.notify)
+
+	def notify(self,action):
+		self.touched.update(touched_ids([action]))
+
+	def close(self):
+		self.sim.unsubscribe(self.notify)
+		return self
+
+	####### Compiling patterns
+	def get_alpha(self,_class,literals,variable,constraints):
+		key = (_class,literals,variable,tuple(c.code for c in constraints)) if constraints else (_class,literals)
+		if key not in self.alphas:
+			alpha = self.alphas[key] = AlphaNode(_class,literals,variable,constraints)
+			for node in self.sim.get_nodes(_class):
+				alpha.update(node)
+			self.alphas_by_class = dict()
+		return self.alphas[key]
+
+	def get_beta(self,parent,alpha,position=None,attr=None,related_attr=None,checks=()):
+		key = (id(parent),id(alpha),position,attr,checks)
+		if key not in self.betas:
+			beta = self.betas[key] = BetaNode(parent,alpha,position,attr,related_attr,checks)
+			beta.populate(self.sim.state)
+		return self.betas[key]
+
+	def add_pattern(self,matcher,params=dict()):
+		# returns the ReteMatchSet of a PatternMatcher
+		err = 'Pattern with constraints reading beyond it cannot be compiled into a Rete network.'
+		assert within_pattern(matcher), err
+		key = (id(matcher.pattern),tuple(sorted(params.items())))
+		if key not in self.terminals:
+			self.refresh()
+			self.terminals[key] = self.compile(matcher,params)
+		return self.terminals[key]
+
+	def compile(self,matcher,params):
+		variables = matcher.variables
+		# single-variable constraints become alpha tests
+		local = {v:[] for v in variables}
+		remaining = []
+		for c in matcher.constraints:
+			if isinstance(c,Constraint) and len(c.keywords)==1 and c.keywords[0] in local:
+				local[c.keywords[0]].append(c)
+			else:
+				remaining.append(c)
+		helpers = {h:self.add_pattern(m,params) for h,m in matcher.helpers.items()}
+
+		beta, order = None, []
+		if variables:
+			for step in matcher.get_steps(variables[0]):
+				alpha = self.get_alpha(step._class,step.literals,step.variable,tuple(local[step.variable]))
+				if step.parent is None:
+					beta = self.get_beta(None,alpha)
+				else:
+					related_attr = matcher.graph[step.parent].get_related_name(step.attr)
+					checks = tuple((attr,order.index(v)) for attr,v in step.checks)
+					beta = self.get_beta(beta,alpha,order.index(step.parent),step.attr,related_attr,checks)
+				order.append(step.variable)
+
+		return ReteMatchSet(self,matcher.pattern,beta,order,remaining,helpers,params)
+
+	####### Propagation
+	def get_alphas(self,_class):
+		if _class not in self.alphas_by_class:
+			self.alphas_by_class[_class] = [a for a in self.alphas.values() if issubclass(_class,a._class)]
+		return self.alphas_by_class[_class]
+
+	def refresh(self):
+		if not self.touched:
+			return self
+		ids, self.touched = self.touched, set()
+		state = self.sim.state
+		for idx in ids:
+			node = state.get(idx)
+			if node is None:
+				for alpha in self.alphas.values():
+					alpha.memory.discard(idx)
+			else:
+				for alpha in self.get_alphas(node.__class__):
+					alpha.update(node)
+		# betas are created after their parents
+		for beta in self.betas.values():
+			beta.update(ids,state)
+		for terminal in self.terminals.values():
+			terminal.update(ids)
+		return self
+
+####### One network per simulation state
+# the network is held by the state, so the two are collected together
+
+def get_network(sim):
+	if sim.rete is None:
+		sim.rete = ReteNetwork(sim)
+	return sim.rete
+
+class ReteRule(SimulationRule):
+	# a rule whose match sets are terminals of the network of its simulation state
+	# match sets are bound on the first update and kept current by the network
+	# patterns that cannot be compiled (see within_pattern) are searched in full on every update
+
+	def update(self,sim):
+		network = get_network(sim)
+		for group in self.groups:
+			m = self.reactants[group[0]]
+			if not within_pattern(m):
+				matches = MatchSet(m,sim,self.parameters)
+			elif group[0] not in self.matches:
+				matches = network.add_pattern(m,self.parameters)
+			else:
+				continue
+			for r in group:
+				self.matches[r] = matches
+		searched = {h:m for h,m in self.helpers.items() if not within_pattern(m)}
+		if not self.helper_matches or searched:
+			self.helper_matches = {h:network.add_pattern(m,self.parameters) for h,m in self.helpers.items() if h not in searched}
+			self.helper_matches.update(get_helper_matches(searched,sim,self.parameters))
+		self.propensity = self.compute_propensity()
+		return self
@@ -50,6 +50,12 @@ class RuleBasedModel:
 	def collect_rules(self):
 		return [rule.name for rule in self.rules]
 
+	def iter_rules(self,data,prefix=()):
+		# yields (path,rule,parameters) for every rule
+		# path is a tuple of model names ending with the rule name
+		for rule in self.rules:
+			yield prefix + (rule.name,), rule, {p:data[p] for p in rule.parameters}
+
 class AggregateModel:
 
 	defaults = None
@@ -91,4 +97,8 @@ class AggregateModel:
 			return self.defaults
 
 	def collect_rules(self):
-		return {model.name: model.collect_rules() for model in self.models}
\ No newline at end of file
+		return {model.name: model.collect_rules() for model in self.models}
+
+	def iter_rules(self,data,prefix=()):
+		for model in self.models:
+			yield from model.iter_rules(data[model.name],prefix + (model.name,))
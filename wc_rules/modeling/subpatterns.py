@@ -0,0 +1,101 @@
+from .model import RuleBasedModel
+from ..graph.collections import GraphContainer
+from ..graph.canonical_cache import cached_canonical_label
+from ..graph.graph_partitioning import partition_canonical_form
+
+# Common subpatterns of the reactant patterns of a model
+# The graph of every reactant pattern of every rule in a model tree is canonically labeled
+# and decomposed as in partition_until_edge: a graph with more than one edge is split by
+# partition_canonical_form into two halves, which are canonically labeled and split in turn
+# until single edges remain.
+# Pieces are identified by CanonicalForm equality, so a piece found in several patterns,
+# or several times in one, is a single node of a DAG:
+#	SubpatternNode.children: the halves of a piece, as (mapping,form) where mapping takes
+#	the canonical names of the half to the canonical names of the piece (see recompose)
+#	SubpatternNode.uses: reactants (rule path, reactant) whose graphs contain the piece
+# Matches of a shared piece can be computed once and joined into matches of its parents.
+# Constraints, helpers and params are not part of the pieces; they apply to the reactant as a whole.
+# Splitting a canonical form is deterministic, so a piece decomposes the same way wherever it appears,
+# but a shared subgraph that the decompositions cut through is not found.
+
+def get_graph(pattern):
+	while not isinstance(pattern,GraphContainer):
+		pattern = pattern.parent
+	return pattern
+
+def iter_reactants(model,prefix=()):
+	# yields (path,reactant,pattern), with paths as in iter_rules
+	if isinstance(model,RuleBasedModel):
+		for rule in model.rules:
+			for r,p in rule.reactants.items():
+				yield prefix + (rule.name,), r, p
+	else:
+		for m in model.models:
+			yield from iter_reactants(m,prefix + (m.name,))
+
+class SubpatternNode:
+
+	def __init__(self,form,group):
+		self.form = form
+		self.group = group
+		self.children = []
+		self.parents = set()
+		self.uses = set()
+
+	@property
+	def size(self):
+		return len(self.form.edges)
+
+class SubpatternDAG:
+
+	def __init__(self):
+		self.nodes = dict()
+		# (path,reactant): (mapping,form) where mapping takes canonical names to variables of the pattern
+		self.reactants = dict()
+
+	def add_reactant(self,path,reactant,pattern):
+		mapping, form, group = cached_canonical_label(get_graph(pattern))
+		self.reactants[path,reactant] = (mapping,form)
+		stack = [self.get_node(form,group)]
+		while stack:
+			node = stack.pop()
+			if (path,reactant) not in node.uses:
+				node.uses.add((path,reactant))
+				stack.extend(self.nodes[f] for _,f in node.children)
+		return self
+
+	def get_node(self,form,group):
+		if form not in self.nodes:
+			node = self.nodes[form] = SubpatternNode(form,group)
+			if len(form.edges) > 1:
+				for m,L,G in partition_canonical_form(form,group):
+					self.get_node(L,G).parents.add(form)
+					node.children.append((m,L))
+		return self.nodes[form]
+
+	def shared(self,min_uses=2):
+		# pieces used by at least min_uses reactants, largest first
+		nodes = [x for x in self.nodes.values() if len(x.uses) >= min_uses]
+		return sorted(nodes,key=lambda x: (-x.size,len(x.form.names)))
+
+	def maximal_shared(self,min_uses=2):
+		# shared pieces that are not a half of a piece used by the same reactants
+		return [x for x in self.shared(min_uses) if not any(self.nodes[f].uses == x.uses for f in x.parents)]
+
+	def iter_topological(self):
+		# pieces, children before parents
+		done = set()
+		def visit(form):
+			if form not in done:
+				done.add(form)
+				for _,f in self.nodes[form].children:
+					yield from visit(f)
+				yield self.nodes[form]
+		for form in list(self.nodes):
+			yield from visit(form)
+
+def find_common_subpatterns(model):
+	dag = SubpatternDAG()
+	for path,r,p in iter_reactants(model):
+		dag.add_reactant(path,r,p)
+	return dag
@@ -0,0 +1,169 @@
+from .simulator import SimulationState
+from ..schema.attributes import BooleanAttribute, FloatAttribute, IntegerAttribute, PositiveIntegerAttribute, StringAttribute, LongStringAttribute, IdAttribute
+from collections import defaultdict
+import numpy as np
+import importlib, json
+
+# Columnar checkpoints of a SimulationState, stored as a numpy .npz archive
+# Nodes are grouped by class. Each class k stores
+#	k/ids: node ids (utf-8 bytes and lengths)
+#	k/attr/<name>: one column per literal attribute, with k/mask/<name> marking non-None values
+#	k/edge/<name>: a (2,n) array of node indices for each related attribute
+# Node indices are positions in the concatenation of classes in the order of the header.
+# Each edge is stored once, from the endpoint with the smaller index.
+# The order of nodes in the state dict is stored as a permutation of node indices,
+# since it determines the order in which matches are found.
+#
+# Restoring creates each node once, then sets literal columns and wires edges
+# directly on both endpoints without validation, in a single pass per attribute.
+
+numeric_dtypes = [
+	(BooleanAttribute,np.bool_),
+	(PositiveIntegerAttribute,np.int64),
+	(IntegerAttribute,np.int64),
+	(FloatAttribute,np.float64),
+	]
+
+string_attributes = (StringAttribute,LongStringAttribute,IdAttribute)
+
+def class_path(_class):
+	return f'{_class.__module__}:{_class.__qualname__}'
+
+def resolve_class(path):
+	module, _, qualname = path.partition(':')
+	x = importlib.import_module(module)
+	for name in qualname.split('.'):
+		x = getattr(x,name)
+	return x
+
+def encode_strings(strings):
+	encoded = [s.encode() for s in strings]
+	lengths = np.fromiter((len(s) for s in encoded),dtype=np.int64,count=len(encoded))
+	return np.frombuffer(b''.join(encoded),dtype=np.uint8), lengths
+
+def decode_strings(data,lengths):
+	buf, ends = data.tobytes(), np.cumsum(lengths)
+	return [buf[e-n:e].decode() for e,n in zip(ends.tolist(),lengths.tolist())]
+
+def literal_attributes(_class):
+	return [a for a,x in _class.Meta.local_attributes.items() if not x.is_related and a != 'id']
+
+def related_attributes(_class):
+	return [a for a,x in _class.Meta.local_attributes.items() if x.is_related]
+
+def encode_column(attr,values):
+	# returns arrays {suffix:array} for a literal attribute column
+	mask = np.fromiter((v is not None for v in values),dtype=np.bool_,count=len(values))
+	arrays = dict() if mask.all() else {'mask':mask}
+	for _type,dtype in numeric_dtypes:
+		if isinstance(attr,_type):
+			arrays['attr'] = np.array([v if v is not None else 0 for v in values],dtype=dtype)
+			return arrays
+	if isinstance(attr,string_attributes):
+		strings = [v if v is not None else '' for v in values]
+	else:
+		strings = [attr.serialize(v) if v is not None else '' for v in values]
+	arrays['attr'], arrays['len'] = encode_strings(strings)
+	return arrays
+
+def decode_column(attr,arrays):
+	if 'len' in arrays:
+		values = decode_strings(arrays['attr'],arrays['len'])
+		if not isinstance(attr,string_attributes):
+			values = [attr.deserialize(v)[0] for v in values]
+	else:
+		values = arrays['attr'].tolist()
+	if 'mask' in arrays:
+		values = [v if m else None for v,m in zip(values,arrays['mask'].tolist())]
+	return values
+
+def checkpoint(sim,file,metadata=None,compress=False):
+	# file is a path or a writable binary file object
+	byclass = defaultdict(list)
+	for node in sim.state.values():
+		byclass[node.__class__].append(node)
+	classes = sorted(byclass,key=class_path)
+	index, n = dict(), 0
+	for _class in classes:
+		for node in byclass[_class]:
+			index[node.id] = n
+			n += 1
+	itype = np.int32 if n < 2**31 else np.int64
+
+	arrays = dict()
+	for k,_class in enumerate(classes):
+		nodes = byclass[_class]
+		arrays[f'{k}/ids'], arrays[f'{k}/ids_len'] = encode_strings([x.id for x in nodes])
+		for a in literal_attributes(_class):
+			attr = _class.Meta.local_attributes[a].attr
+			for suffix,array in encode_column(attr,[getattr(x,a) for x in nodes]).items():
+				arrays[f'{k}/{suffix}/{a}'] = array
+		for a in related_attributes(_class):
+			edges = []
+			for node in nodes:
+				i = index[node.id]
+				for target in node.listget(a):
+					j = index[target.id]
+					# the other endpoint stores the edge if it has the smaller index
+					if i < j or (i == j and a <= _class.Meta.local_attributes[a].related_name):
+						edges.append((i,j))
+			if edges:
+				arrays[f'{k}/edge/{a}'] = np.array(edges,dtype=itype).T
+
+	header = dict(
+		classes = [class_path(c) for c in classes],
+		counts = [len(byclass[c]) for c in classes],
+		metadata = metadata or dict(),
+		)
+	arrays['header'] = np.array(json.dumps(header))
+	arrays['order'] = np.fromiter((index[idx] for idx in sim.state),dtype=itype,count=n)
+	save = np.savez_compressed if compress else np.savez
+	save(file,**arrays)
+	return file
+
+def restore(file):
+	# returns the restored SimulationState and the metadata stored with it
+	with np.load(file) as archive:
+		arrays = dict(archive.items())
+	header = json.loads(str(arrays['header']))
+	classes = [resolve_class(c) for c in header['classes']]
+
+	nodes, offsets = [], []
+	for k,_class in enumerate(classes):
+		offsets.append(len(nodes))
+		ids = decode_strings(arrays[f'{k}/ids'],arrays[f'{k}/ids_len'])
+		created = [_class(idx) for idx in ids]
+		for a in literal_attributes(_class):
+			if f'{k}/attr/{a}' not in arrays:
+				continue
+			attr = _class.Meta.local_attributes[a].attr
+			column = {s:arrays[f'{k}/{s}/{a}'] for s in ['attr','mask','len'] if f'{k}/{s}/{a}' in arrays}
+			for node,v in zip(created,decode_column(attr,column)):
+				if v is not None:
+					node.__setattr__(a,v,propagate=False)
+		nodes.extend(created)
+
+	for k,_class in enumerate(classes):
+		for a in related_attributes(_class):
+			if f'{k}/edge/{a}' not in arrays:
+				continue
+			sources, targets = arrays[f'{k}/edge/{a}'].tolist()
+			wire_edges(nodes,_class,a,sources,targets)
+
+	state = SimulationState([nodes[i] for i in arrays['order'].tolist()])
+	return state, header['metadata']
+
+def wire_edges(nodes,_class,attr,sources,targets):
+	# sets both endpoints of each edge without propagation or validation
+	x = _class.Meta.local_attributes[attr]
+	for i,j in zip(sources,targets):
+		source, target = nodes[i], nodes[j]
+		y = target.__class__.Meta.local_attributes[x.related_name]
+		set_endpoint(source,attr,x.is_related_to_many,target)
+		set_endpoint(target,x.related_name,y.is_related_to_many,source)
+
+def set_endpoint(node,attr,to_many,value):
+	if to_many:
+		list.append(getattr(node,attr),value)
+	else:
+		node.__setattr__(attr,value,propagate=False)
@@ -0,0 +1,175 @@
+from .ssa import DirectMethodSimulator
+from ..utils.random import idgen, stream_seeds
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import math, os
+
+# Ensembles of replicate trajectories
+# Trajectory k draws its simulator seed and its id generator seed from stream (seed,k),
+# so each trajectory is the same no matter which worker runs it.
+# Each worker builds the model once and simulates many trajectories,
+# rebuilding the initial state for each one.
+# Results are streamed back in trajectory order into an EnsembleSummary,
+# which holds running means, variances and quantile estimates instead of the trajectories,
+# so summaries do not depend on the number of workers either.
+#
+# build_model, build_state and observables are sent to workers and must be picklable,
+# e.g., module-level functions or functools.partial objects wrapping them.
+
+class P2Quantile:
+	# streaming quantile estimator (Jain & Chlamtac, Commun ACM 1985)
+	# five markers track the minimum, p/2, p, (1+p)/2 quantiles and the maximum
+	# marker heights are adjusted with piecewise-parabolic interpolation
+
+	def __init__(self,p):
+		self.p = p
+		self.heights = []
+		self.positions = [1,2,3,4,5]
+		self.desired = [1,1+2*p,1+4*p,3+2*p,5]
+		self.increments = [0,p/2,p,(1+p)/2,1]
+
+	def add(self,x):
+		q, n = self.heights, self.positions
+		if len(q) < 5:
+			q.append(x)
+			q.sort()
+			return self
+		if x < q[0]:
+			q[0], k = x, 0
+		elif x >= q[4]:
+			q[4], k = x, 3
+		else:
+			k = next(i for i in range(4) if q[i] <= x < q[i+1])
+		for i in range(k+1,5):
+			n[i] += 1
+		for i in range(5):
+			self.desired[i] += self.increments[i]
+		for i in range(1,4):
+			d = self.desired[i] - n[i]
+			if (d >= 1 and n[i+1]-n[i] > 1) or (d <= -1 and n[i-1]-n[i] < -1):
+				d = int(math.copysign(1,d))
+				h = self.parabolic(i,d)
+				if not q[i-1] < h < q[i+1]:
+					h = self.linear(i,d)
+				q[i] = h
+				n[i] += d
+		return self
+
+	def parabolic(self,i,d):
+		q, n = self.heights, self.positions
+		return q[i] + d/(n[i+1]-n[i-1])*(
+			(n[i]-n[i-1]+d)*(q[i+1]-q[i])/(n[i+1]-n[i]) +
+			(n[i+1]-n[i]-d)*(q[i]-q[i-1])/(n[i]-n[i-1])
+			)
+
+	def linear(self,i,d):
+		q, n = self.heights, self.positions
+		return q[i] + d*(q[i+d]-q[i])/(n[i+d]-n[i])
+
+	def value(self):
+		if len(self.heights) < 5:
+			# exact for small samples
+			return float(np.quantile(self.heights,self.p)) if self.heights else math.nan
+		return self.heights[2]
+
+class EnsembleSummary:
+	# per-time-point statistics of observables over trajectories
+	# arrays are indexed [time,observable]
+
+	def __init__(self,times,observables,quantiles=()):
+		self.times = list(times)
+		self.observables = list(observables)
+		shape = (len(self.times),len(self.observables))
+		self.ntrajectories = 0
+		self.mean = np.zeros(shape)
+		self.m2 = np.zeros(shape)
+		self.estimators = {q:[[P2Quantile(q) for _ in self.observables] for _ in self.times] for q in quantiles}
+
+	def add(self,values):
+		# Welford's update
+		values = np.asarray(values,dtype=float)
+		self.ntrajectories += 1
+		delta = values - self.mean
+		self.mean += delta/self.ntrajectories
+		self.m2 += delta*(values - self.mean)
+		for rows in self.estimators.values():
+			for i,row in enumerate(rows):
+				for j,estimator in enumerate(row):
+					estimator.add(values[i,j])
+		return self
+
+	@property
+	def variance(self):
+		if self.ntrajectories < 2:
+			return np.full(self.mean.shape,math.nan)
+		return self.m2/(self.ntrajectories-1)
+
+	@property
+	def std(self):
+		return np.sqrt(self.variance)
+
+	def quantile(self,q):
+		err = 'Quantile {0} is not tracked by this summary.'
+		assert q in self.estimators, err.format(q)
+		return np.array([[e.value() for e in row] for row in self.estimators[q]])
+
+	def get(self,observable,statistic='mean'):
+		# time series of a statistic of one observable
+		j = self.observables.index(observable)
+		values = self.quantile(statistic) if isinstance(statistic,float) else getattr(self,statistic)
+		return values[:,j]
+
+class Ensemble:
+
+	def __init__(self,build_model,build_state,observables,times,simulator=DirectMethodSimulator,parameters=None,seed=0,quantiles=(0.05,0.5,0.95)):
+		times = list(times)
+		err = 'Sampling times must be nondecreasing.'
+		assert all(t1 <= t2 for t1,t2 in zip(times,times[1:])), err
+		self.build_model = build_model
+		self.build_state = build_state
+		self.observables = observables
+		self.times = times
+		self.simulator = simulator
+		self.parameters = parameters
+		self.seed = seed
+		self.quantiles = quantiles
+
+	def simulate(self,model,k):
+		# observables of trajectory k at each sampling time, as an array [time,observable]
+		sim_seed, id_seed = stream_seeds(self.seed,(k,),2)
+		idgen.seed(id_seed)
+		ssa = self.simulator(model,self.build_state(),self.parameters,seed=sim_seed)
+		values = np.empty((len(self.times),len(self.observables)))
+		for i,t in enumerate(self.times):
+			# a terminated trajectory keeps its final values
+			if not ssa.terminated:
+				ssa.run(end_time=t)
+			values[i] = [f(ssa.state) for f in self.observables.values()]
+		return values
+
+	def summarize(self,results):
+		summary = EnsembleSummary(self.times,self.observables,self.quantiles)
+		for values in results:
+			summary.add(values)
+		return summary
+
+	def run(self,ntrajectories,max_workers=None,chunksize=None):
+		# max_workers=0 simulates in the current process
+		if max_workers == 0:
+			model = self.build_model()
+			return self.summarize(self.simulate(model,k) for k in range(ntrajectories))
+		if chunksize is None:
+			nworkers = max_workers or os.cpu_count() or 1
+			chunksize = max(1,ntrajectories//(4*nworkers))
+		with ProcessPoolExecutor(max_workers,initializer=initialize_worker,initargs=(self,)) as executor:
+			return self.summarize(executor.map(simulate_in_worker,range(ntrajectories),chunksize=chunksize))
+
+####### Worker processes
+_worker = dict()
+
+def initialize_worker(ensemble):
+	_worker['ensemble'] = ensemble
+	_worker['model'] = ensemble.build_model()
+
+def simulate_in_worker(k):
+	return _worker['ensemble'].simulate(_worker['model'],k)
@@ -0,0 +1,172 @@
+from ..schema.base import BaseClass
+from functools import lru_cache
+
+# An index of the nodes of a SimulationState by class and by label
+# Each node is filed under its class and every ancestor class derived from BaseClass,
+# and under the labels tested by Entity.has_label, i.e., Entity.get_classnames.
+# Each entry is a NodeSet, which supports O(1) add, remove, count and random sampling
+# and iterates over nodes in the order they were added, like the state dict.
+#
+# Optional attribute indexes file the instances of a class into buckets by
+#	the value of a literal attribute, e.g., `x.ph == False`
+#	the degree of a related attribute, e.g., `len(x.bond) == 0`
+# Nodes are rebucketed when SimulationState executes or rolls back an action that touches them.
+
+@lru_cache(maxsize=None)
+def ancestors(_class):
+	return tuple(c for c in _class.__mro__ if issubclass(c,BaseClass))
+
+@lru_cache(maxsize=None)
+def labels(_class):
+	return tuple(_class.get_classnames()) if hasattr(_class,'get_classnames') else ()
+
+class NodeSet:
+
+	def __init__(self):
+		self.nodes = dict()
+		# ids in a list, for sampling, with the position of each id
+		self.keys = []
+		self.positions = dict()
+
+	def add(self,node):
+		if node.id not in self.nodes:
+			self.positions[node.id] = len(self.keys)
+			self.keys.append(node.id)
+		self.nodes[node.id] = node
+		return self
+
+	def remove(self,node):
+		# swap with the last key to keep removal O(1)
+		del self.nodes[node.id]
+		i, last = self.positions.pop(node.id), self.keys.pop()
+		if last != node.id:
+			self.keys[i] = last
+			self.positions[last] = i
+		return self
+
+	def count(self):
+		return len(self.keys)
+
+	def sample(self,n,rng):
+		return [self.nodes[k] for k in rng.sample(self.keys,n)]
+
+	def __contains__(self,node):
+		return node.id in self.nodes
+
+	def __len__(self):
+		return len(self.keys)
+
+	def __iter__(self):
+		return iter(self.nodes.values())
+
+empty = NodeSet()
+
+class AttributeIndex:
+
+	def __init__(self,_class,attr):
+		self._class = _class
+		self.attr = attr
+		self.related = _class.Meta.local_attributes[attr].is_related
+		self.buckets = dict()
+		self.keys = dict()
+
+	def key(self,node):
+		return len(node.listget(self.attr)) if self.related else node.get(self.attr)
+
+	def add(self,node):
+		key = self.keys[node.id] = self.key(node)
+		if key not in self.buckets:
+			self.buckets[key] = NodeSet()
+		self.buckets[key].add(node)
+		return self
+
+	def remove(self,node):
+		key = self.keys.pop(node.id)
+		self.buckets[key].remove(node)
+		if not self.buckets[key]:
+			del self.buckets[key]
+		return self
+
+	def update(self,node):
+		if self.keys[node.id] != self.key(node):
+			self.remove(node).add(node)
+		return self
+
+	def get(self,key):
+		return self.buckets.get(key,empty)
+
+class NodeIndex:
+
+	def __init__(self,nodes=()):
+		self.classes = dict()
+		self.labels = dict()
+		# attribute indexes by (class,attr) and by class
+		self.attributes = dict()
+		self.attributes_by_class = dict()
+		for node in nodes:
+			self.add(node)
+
+	def add(self,node):
+		for d,keys in [(self.classes,ancestors(node.__class__)),(self.labels,labels(node.__class__))]:
+			for key in keys:
+				if key not in d:
+					d[key] = NodeSet()
+				d[key].add(node)
+		for x in self.get_attribute_indexes(node.__class__):
+			x.add(node)
+		return self
+
+	def remove(self,node):
+		for c in ancestors(node.__class__):
+			self.classes[c].remove(node)
+		for label in labels(node.__class__):
+			self.labels[label].remove(node)
+		for x in self.get_attribute_indexes(node.__class__):
+			x.remove(node)
+		return self
+
+	def touch(self,node):
+		# rebuckets a node whose attributes may have changed
+		for x in self.get_attribute_indexes(node.__class__):
+			x.update(node)
+		return self
+
+	####### Attribute indexes
+	def add_attribute_index(self,_class,attr):
+		err = '`{0}` is not an attribute of {1}.'
+		assert attr in _class.Meta.local_attributes, err.format(attr,_class.__name__)
+		if (_class,attr) not in self.attributes:
+			x = self.attributes[_class,attr] = AttributeIndex(_class,attr)
+			for node in self.get(_class):
+				x.add(node)
+			self.attributes_by_class = dict()
+		return self.attributes[_class,attr]
+
+	def get_attribute_indexes(self,_class):
+		# attribute indexes on _class and its ancestors
+		if _class not in self.attributes_by_class:
+			self.attributes_by_class[_class] = [x for (c,a),x in self.attributes.items() if issubclass(_class,c)]
+		return self.attributes_by_class[_class]
+
+	def get_bucket(self,_class,attr,related,key):
+		# the smallest bucket of an index on _class or an ancestor of _class containing all instances of _class
+		# with the given value or degree of attr, or None if there is no such index
+		buckets = [x.get(key) for x in self.get_attribute_indexes(_class) if x.attr == attr and x.related == related]
+		return min(buckets,key=len) if buckets else None
+
+	def get(self,_class):
+		# nodes that are instances of _class
+		return self.classes.get(_class,empty)
+
+	def get_label(self,label):
+		# nodes x with x.has_label(label)
+		return self.labels.get(label,empty)
+
+	def count(self,_class):
+		return self.get(_class).count()
+
+	def count_label(self,label):
+		return self.get_label(label).count()
+
+	def sample(self,_class,n,rng):
+		return self.get(_class).sample(n,rng)
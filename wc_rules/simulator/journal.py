@@ -0,0 +1,93 @@
+from ..schema.actions import AddNode, RemoveNode, SetAttr, AddEdge, RemoveEdge
+import numpy as np
+
+# A journal of primary actions executed on a SimulationState, for rolling them back
+# Entries are stored in preallocated arrays instead of as action instances:
+#	kinds[i]: the kind of action
+#	codes[i]: up to four interned references (node ids, attribute names, classes)
+#		AddNode, RemoveNode:	idx, _class
+#		SetAttr:				idx, attr
+#		AddEdge, RemoveEdge:	source_idx, source_attr, target_idx, target_attr
+#	values[i], old_values[i]: node attrs for node actions, value and old_value for SetAttr
+# Arrays grow by doubling, so capacity tracks the largest transaction rather than the run.
+# Interned references are cleared with the journal.
+
+kinds = [AddNode,RemoveNode,SetAttr,AddEdge,RemoveEdge]
+kind_codes = {k:i for i,k in enumerate(kinds)}
+
+class ActionJournal:
+
+	def __init__(self,capacity=64):
+		self.kinds = np.empty(capacity,dtype=np.int8)
+		self.codes = np.empty((capacity,4),dtype=np.int32)
+		self.values = [None]*capacity
+		self.old_values = [None]*capacity
+		self.size = 0
+		self.references = []
+		self.reference_codes = dict()
+
+	def __len__(self):
+		return self.size
+
+	@property
+	def capacity(self):
+		return len(self.kinds)
+
+	def intern(self,x):
+		code = self.reference_codes.get(x)
+		if code is None:
+			code = self.reference_codes[x] = len(self.references)
+			self.references.append(x)
+		return code
+
+	def grow(self):
+		n = self.capacity
+		self.kinds = np.concatenate([self.kinds,np.empty(n,dtype=np.int8)])
+		self.codes = np.concatenate([self.codes,np.empty((n,4),dtype=np.int32)])
+		self.values.extend([None]*n)
+		self.old_values.extend([None]*n)
+		return self
+
+	def append(self,action):
+		if self.size == self.capacity:
+			self.grow()
+		i, kind = self.size, kind_codes[action.__class__]
+		self.kinds[i] = kind
+		if kind <= 1:
+			self.codes[i,:2] = self.intern(action.idx), self.intern(action._class)
+			self.values[i] = action.attrs
+		elif kind == 2:
+			self.codes[i,:2] = self.intern(action.idx), self.intern(action.attr)
+			self.values[i], self.old_values[i] = action.value, action.old_value
+		else:
+			self.codes[i] = [self.intern(x) for x in [action.source_idx,action.source_attr,action.target_idx,action.target_attr]]
+		self.size += 1
+		return self
+
+	def action(self,i):
+		# reconstructs the i-th action
+		kind = self.kinds[i]
+		refs = [self.references[c] for c in self.codes[i,:2 if kind <= 2 else 4].tolist()]
+		if kind <= 1:
+			return kinds[kind](_class=refs[1],idx=refs[0],attrs=self.values[i])
+		if kind == 2:
+			return SetAttr(idx=refs[0],attr=refs[1],value=self.values[i],old_value=self.old_values[i])
+		return kinds[kind](source_idx=refs[0],source_attr=refs[1],target_idx=refs[2],target_attr=refs[3])
+
+	def actions(self,start=0):
+		return [self.action(i) for i in range(start,self.size)]
+
+	def pop(self):
+		# removes and returns the last action
+		self.size -= 1
+		action = self.action(self.size)
+		self.values[self.size] = self.old_values[self.size] = None
+		return action
+
+	def clear(self):
+		for i in range(self.size):
+			self.values[i] = self.old_values[i] = None
+		self.size = 0
+		self.references.clear()
+		self.reference_codes.clear()
+		return self
@@ -0,0 +1,64 @@
+from .ssa import SimulationRule
+from .rssa import CandidatePool, split_touched
+from ..matcher.matcher import get_helper_matches
+
+# Rules whose matches are maintained locally from the action stream of a SimulationState
+# A LocalRule subscribes to the state and collects the ids of nodes touched by each primary action.
+# When the rule is updated, each reactant pattern rematches only around the touched nodes:
+#	the touched ids are widened to the nodes that constraints of the pattern read (PatternMatcher.neighborhood)
+#	(such rules depend on every class, see SimulationRule.classes, so they are updated after every firing)
+#	matches containing those nodes are revalidated
+#	new matches are searched for from seeds at those nodes, which visit at most diameter hops
+#	added edges are searched for only from the pattern's occurrences of their type (see CandidatePool.touch)
+# so the cost of an update depends on the neighborhood of the firing, not on the size of the state.
+# Patterns with helpers can change without their nodes being touched, and are rematched in full.
+# Matches are held in CandidatePools and validated before counting, so propensities are exact.
+
+class LocalRule(SimulationRule):
+
+	# pools hold every embedding, so matches are not reduced to orbit representatives
+	symmetry_breaking = False
+
+	def __init__(self,name,rule,parameters):
+		super().__init__(name,rule,parameters)
+		self.sim = None
+		self.touched = set()
+		self.added = []
+
+	def notify(self,action):
+		ids, added = split_touched([action])
+		self.touched.update(ids)
+		self.added.extend(added)
+
+	def close(self):
+		if self.sim is not None:
+			self.sim.unsubscribe(self.notify)
+			self.sim = None
+		return self
+
+	def bind(self,sim):
+		self.close()
+		self.sim = sim
+		sim.subscribe(self.notify)
+		self.touched, self.added = set(), []
+		self.matches = dict()
+		for group in self.groups:
+			pool = CandidatePool(self.reactants[group[0]],sim,self.parameters)
+			for r in group:
+				self.matches[r] = pool
+		return self
+
+	def update(self,sim):
+		if sim is not self.sim:
+			self.bind(sim)
+		elif self.touched or self.added:
+			(ids,self.touched), (added,self.added) = (self.touched,set()), (self.added,[])
+			for group in self.groups:
+				pool = self.matches[group[0]]
+				if pool.matcher.helpers:
+					pool.reset()
+				else:
+					pool.touch(ids,added)
+		self.helper_matches = get_helper_matches(self.helpers,sim,self.parameters)
+		self.propensity = self.compute_propensity()
+		return self
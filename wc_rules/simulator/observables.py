@@ -0,0 +1,116 @@
+from .recorder import Observable
+from .rssa import CandidatePool
+from .ssa import touched_ids
+from ..matcher.matcher import PatternMatcher
+
+# Observables maintained incrementally from the action stream of a SimulationState
+# An ObservableRegistry subscribes to the state and collects the ids of nodes
+# touched by each primary action executed or rolled back.
+# Touched ids are handed to registered observables the next time any of them is read,
+# so the cost of a read is proportional to what changed since the previous read.
+#
+# LivePatternCount keeps the matches of a pattern in a CandidatePool:
+# matches containing touched nodes are revalidated, new matches are searched for from touched nodes.
+# This assumes a match can only change when one of its nodes is touched,
+# which does not hold for patterns with helpers; those are recounted when anything is touched.
+# LiveAttributeSum keeps the contribution of each node and adjusts the sum for touched nodes.
+#
+# Live observables can be passed to a Recorder like any other observable.
+
+class ObservableRegistry:
+
+	def __init__(self,sim,observables=()):
+		self.sim = sim
+		self.observables = []
+		self.touched = set()
+		sim.subscribe(self.notify)
+		for x in observables:
+			self.register(x)
+
+	def register(self,observable):
+		observable.attach(self)
+		self.observables.append(observable)
+		return observable
+
+	def notify(self,action):
+		self.touched.update(touched_ids([action]))
+
+	def refresh(self):
+		if self.touched:
+			ids, self.touched = self.touched, set()
+			for x in self.observables:
+				x.update(ids)
+		return self
+
+	def values(self):
+		self.refresh()
+		return {c:v for x in self.observables for c,v in zip(x.columns,x.value())}
+
+	def close(self):
+		self.sim.unsubscribe(self.notify)
+		return self
+
+class LiveObservable(Observable):
+	# subclasses implement reset(), update(ids) and value()
+
+	registry = None
+
+	def attach(self,registry):
+		err = 'Observable `{0}` is already registered.'
+		assert self.registry is None, err.format(self.name)
+		self.registry = registry
+		self.sim = registry.sim
+		return self.reset()
+
+	def __call__(self,sim):
+		err = 'Observable `{0}` is registered with another simulation state.'
+		assert self.registry is not None and sim is self.sim, err.format(self.name)
+		self.registry.refresh()
+		return self.value()
+
+class LivePatternCount(LiveObservable):
+
+	def __init__(self,name,pattern,params=dict()):
+		super().__init__(name)
+		self.matcher = PatternMatcher(pattern)
+		self.params = params
+		self.local = not self.matcher.helpers
+
+	def reset(self):
+		self.pool = CandidatePool(self.matcher,self.sim,self.params)
+		return self
+
+	def update(self,ids):
+		if self.local:
+			self.pool.touch(ids)
+		else:
+			self.pool.reset()
+		return self
+
+	def value(self):
+		return [self.pool.count()]
+
+class LiveAttributeSum(LiveObservable):
+
+	def __init__(self,name,_class,attr):
+		super().__init__(name)
+		self._class = _class
+		self.attr = attr
+
+	def reset(self):
+		# contributions of instances of _class, keyed by id
+		self.contributions = {x.id:getattr(x,self.attr) or 0 for x in self.sim.get_nodes(self._class)}
+		self.total = sum(self.contributions.values())
+		return self
+
+	def update(self,ids):
+		for idx in ids:
+			self.total -= self.contributions.pop(idx,0)
+			node = self.sim.state.get(idx)
+			if isinstance(node,self._class):
+				self.contributions[idx] = getattr(node,self.attr) or 0
+				self.total += self.contributions[idx]
+		return self
+
+	def value(self):
+		return [self.total]
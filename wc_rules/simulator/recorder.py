@@ -0,0 +1,162 @@
+from ..matcher.matcher import PatternMatcher
+import numpy as np
+import json, os
+
+# Recording observables at fixed intervals of simulated time
+# An observable maps a simulation state to one or more named columns.
+# A Recorder samples all observables at times t0, t0+dt, t0+2dt, ...
+# into a preallocated buffer of buffer_size rows.
+# Full buffers are appended to a directory as numbered .npy chunks,
+# each a (rows,columns) float64 array stored column-major,
+# so memory use does not grow with the length of the run
+# and the output does not grow with the number of events between samples.
+# The directory also holds columns.json listing the column names.
+
+class Observable:
+	# subclasses set self.columns and implement __call__(sim) returning a list of values
+	def __init__(self,name):
+		self.name = name
+		self.columns = [name]
+
+class PatternCount(Observable):
+	# number of matches of a pattern
+
+	def __init__(self,name,pattern,params=dict()):
+		super().__init__(name)
+		self.matcher = PatternMatcher(pattern)
+		self.params = params
+
+	def __call__(self,sim):
+		return [self.matcher.count(sim,self.params)]
+
+class AttributeSum(Observable):
+	# sum of a literal attribute over instances of a class, with None counted as 0
+
+	def __init__(self,name,_class,attr):
+		super().__init__(name)
+		self._class = _class
+		self.attr = attr
+
+	def __call__(self,sim):
+		return [sum(getattr(x,self.attr) or 0 for x in sim.get_nodes(self._class))]
+
+class ComplexSizeHistogram(Observable):
+	# number of connected components (complexes) of each size
+	# size is the number of nodes of _class in a component
+	# sizes 1..max_size-1 have their own columns, the last column counts sizes >= max_size
+	# components without nodes of _class are ignored
+
+	def __init__(self,name,max_size,_class=object):
+		super().__init__(name)
+		self.max_size = max_size
+		self._class = _class
+		self.columns = [f'{name}[{i}]' for i in range(1,max_size)] + [f'{name}[{max_size}+]']
+
+	def __call__(self,sim):
+		counts = [0]*self.max_size
+		for size in complex_sizes(sim,self._class):
+			if size > 0:
+				counts[min(size,self.max_size)-1] += 1
+		return counts
+
+def complex_sizes(sim,_class=object):
+	visited = set()
+	for node in sim.state.values():
+		if node.id in visited:
+			continue
+		visited.add(node.id)
+		stack, size = [node], 0
+		while stack:
+			x = stack.pop()
+			size += isinstance(x,_class)
+			for y in x.listget_all_related():
+				if y.id not in visited:
+					visited.add(y.id)
+					stack.append(y)
+		yield size
+
+class Recorder:
+
+	def __init__(self,path,observables,interval,buffer_size=1024):
+		err = 'Recording interval must be positive.'
+		assert interval > 0, err
+		self.path = path
+		self.observables = observables
+		self.interval = interval
+		self.columns = ['time'] + [c for x in observables for c in x.columns]
+		err = 'Duplicate observable columns: {0}.'
+		duplicates = sorted(set(c for c in self.columns if self.columns.count(c) > 1))
+		assert not duplicates, err.format(duplicates)
+		self.buffer = np.empty((buffer_size,len(self.columns)))
+		self.nrows = 0
+		self.nsamples = 0
+		self.start = None
+		os.makedirs(path,exist_ok=True)
+		header = os.path.join(path,'columns.json')
+		if os.path.exists(header):
+			with open(header) as f:
+				err = 'Recording at `{0}` has different columns.'
+				assert json.load(f) == self.columns, err.format(path)
+		else:
+			with open(header,'w') as f:
+				json.dump(self.columns,f)
+		# appending to an existing recording continues its chunk numbering
+		self.nchunks = len(list_chunks(path))
+
+	def sample(self,sim,time):
+		row = [time]
+		for x in self.observables:
+			row.extend(x(sim))
+		self.buffer[self.nrows] = row
+		self.nrows += 1
+		self.nsamples += 1
+		if self.nrows == len(self.buffer):
+			self.flush()
+		return self
+
+	def flush(self):
+		if self.nrows > 0:
+			chunk = np.asfortranarray(self.buffer[:self.nrows])
+			np.save(os.path.join(self.path,f'{self.nchunks:08d}.npy'),chunk)
+			self.nchunks += 1
+			self.nrows = 0
+		return self
+
+	def next_time(self):
+		return self.start + self.nsamples*self.interval
+
+	def run(self,ssa,end_time):
+		# samples a simulator at sampling times up to and including end_time
+		# the first call starts sampling at the current simulation time,
+		# later calls continue where the previous one stopped
+		# sampling stops early if the simulation terminates
+		if self.start is None:
+			self.start = ssa.time
+		while self.next_time() <= end_time:
+			t = self.next_time()
+			if t > ssa.time:
+				ssa.run(end_time=t)
+			if ssa.terminated:
+				break
+			self.sample(ssa.state,t)
+		return self.flush()
+
+	def close(self):
+		return self.flush()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		self.close()
+
+def list_chunks(path):
+	return sorted(f for f in os.listdir(path) if f.endswith('.npy'))
+
+def load_recording(path):
+	# returns {column: array} over all chunks
+	with open(os.path.join(path,'columns.json')) as f:
+		columns = json.load(f)
+	chunks = [np.load(os.path.join(path,f)) for f in list_chunks(path)]
+	data = np.concatenate(chunks) if chunks else np.empty((0,len(columns)))
+	return {c:data[:,i] for i,c in enumerate(columns)}
@@ -0,0 +1,288 @@
+from .ssa import SimulationRule, StochasticSimulator, touched_ids, touched_classes
+from ..matcher.matcher import get_helper_matches
+from ..matcher.edges import EdgeIndex, reads_attribute
+from ..schema.actions import AddEdge
+from collections import defaultdict
+import math
+
+# Rejection-based SSA (Thanh et al., J Chem Phys 2014) adapted to network-free rules.
+# In the species-based RSSA, propensity bounds come from fluctuation intervals on species counts.
+# Here, match counts of reactant patterns play the role of species counts.
+#
+# Each reactant pattern keeps a CandidatePool: a superset of its valid matches.
+#	After a firing, candidates that contain touched nodes are marked dirty
+#	and new matches are searched for only from the touched nodes.
+#	An added edge that constraints do not read cannot invalidate candidates, and new matches
+#	must contain it, so they are searched for only from the pattern's occurrences of its type
+#	(see matcher/edges.py); patterns without an edge of that type are not searched at all.
+#	len(candidates) is an upper bound on the match count,
+#	len(candidates) - len(dirty) is a lower bound.
+# Each pattern holds a fluctuation interval [lo,hi] around its last exact count.
+# Rule propensity bounds are computed by evaluating the rate law at lo and hi,
+# assuming rate laws are nondecreasing in match counts.
+# A rule is rebounded (dirty candidates validated, interval reset) only when
+# its candidate bounds leave the interval.
+#
+# Selection proceeds by
+#	choosing a rule with probability proportional to its upper bound
+#	accepting it if a random number falls below the lower bound,
+#	otherwise computing the exact propensity (validating dirty candidates) and comparing;
+#	a rejected rule is rebounded if it cannot fire or its counts have left their intervals.
+# Time advances on every trial, accepted or rejected.
+
+class Count:
+	# stands in for a match set when evaluating a rate law at a given count
+	def __init__(self,n):
+		self.n = n
+
+	def count(self):
+		return self.n
+
+def split_touched(journal):
+	# ids of nodes touched by actions other than AddEdge, and the AddEdge actions
+	added = [x for x in journal if isinstance(x,AddEdge)]
+	return touched_ids([x for x in journal if not isinstance(x,AddEdge)]), added
+
+class CandidatePool:
+
+	def __init__(self,matcher,sim,params):
+		self.matcher = matcher
+		self.sim = sim
+		self.params = params
+		self.edges = EdgeIndex([matcher])
+		self.reset()
+
+	def reset(self):
+		self.keys = []
+		self.positions = dict()
+		self.matches = dict()
+		self.bynode = defaultdict(set)
+		self.dirty = set()
+		for match in self.matcher.iter_matches(self.sim,self.params):
+			self.add(match)
+		return self
+
+	def key(self,match):
+		return tuple(match[v].id for v in self.matcher.variables)
+
+	def add(self,match):
+		key = self.key(match)
+		if key in self.matches:
+			self.dirty.discard(key)
+			return self
+		self.positions[key] = len(self.keys)
+		self.keys.append(key)
+		self.matches[key] = match
+		for idx in key:
+			self.bynode[idx].add(key)
+		return self
+
+	def remove(self,key):
+		# swap with the last key to keep sampling O(1)
+		i, last = self.positions.pop(key), self.keys.pop()
+		if last != key:
+			self.keys[i] = last
+			self.positions[last] = i
+		del self.matches[key]
+		for idx in key:
+			self.bynode[idx].discard(key)
+			if not self.bynode[idx]:
+				del self.bynode[idx]
+		self.dirty.discard(key)
+		return self
+
+	def validate(self,key):
+		# returns whether the candidate is a valid match, removing it if not
+		match = self.matches[key]
+		seed = {v:match[v] for v in self.matcher.variables}
+		valid = all(self.sim.state.get(x.id) is x for x in seed.values())
+		valid = valid and any(True for _ in self.matcher.iter_matches(self.sim,self.params,seed=seed))
+		if valid:
+			self.dirty.discard(key)
+		else:
+			self.remove(key)
+		return valid
+
+	def validate_all(self):
+		for key in list(self.dirty):
+			self.validate(key)
+		return self
+
+	def is_seedable(self,action):
+		# whether an AddEdge can be handled from the occurrences of its edge:
+		# the edge still exists and constraints do not read it
+		source, target = self.sim.state.get(action.source_idx), self.sim.state.get(action.target_idx)
+		if source is None or target is None or target not in source.listget(action.source_attr):
+			return False
+		return not reads_attribute(self.matcher,action.source_attr) and not reads_attribute(self.matcher,action.target_attr)
+
+	def touch(self,ids,added=()):
+		# ids: nodes touched by actions, added: AddEdge actions
+		ids, seeded = set(ids), []
+		for action in added:
+			if self.is_seedable(action):
+				seeded.append(action)
+			else:
+				ids.update([action.source_idx,action.target_idx])
+		ids = self.matcher.neighborhood(self.sim,ids)
+		for idx in ids:
+			self.dirty.update(self.bynode.get(idx,[]))
+		for match in self.matcher.iter_local_matches(self.sim,ids,self.params):
+			self.add(match)
+		for action in seeded:
+			for _,match in self.edges.iter_new_matches(self.sim,action,self.params):
+				self.add(match)
+		return self
+
+	def upper(self):
+		return len(self.keys)
+
+	def lower(self):
+		return len(self.keys) - len(self.dirty)
+
+	def count(self):
+		return self.validate_all().upper()
+
+	def sample(self,n,rng):
+		# uniform over valid matches, distinct candidates
+		# dirty candidates are validated lazily when drawn
+		chosen = []
+		while len(chosen) < n:
+			key = self.keys[rng.randrange(len(self.keys))]
+			if key in chosen or (key in self.dirty and not self.validate(key)):
+				continue
+			chosen.append(key)
+		return [self.matches[key] for key in chosen]
+
+class RejectionRule(SimulationRule):
+
+	delta = 0.1
+	min_slack = 1
+
+	def __init__(self,name,rule,parameters):
+		super().__init__(name,rule,parameters)
+		# patterns with helpers can change without their matched nodes being touched
+		# rate laws with helpers can change without the reactant counts changing
+		# such rules are kept exact
+		self.local = not any(m.helpers for m in self.reactants.values())
+		self.exact = not self.local or any(h in self.rate_law.keywords for h in self.helpers)
+		self.intervals = dict()
+		self.lower = self.upper = 0.0
+
+	def update(self,sim):
+		self.sim = sim
+		self.matches = dict()
+		for group in self.groups:
+			pool = CandidatePool(self.reactants[group[0]],sim,self.parameters)
+			for r in group:
+				self.matches[r] = pool
+		self.update_helpers()
+		self.propensity = self.compute_propensity()
+		return self.rebound()
+
+	def update_helpers(self):
+		self.helper_matches = get_helper_matches(self.helpers,self.sim,self.parameters)
+		return self
+
+	def pools(self):
+		return [(group,self.matches[group[0]]) for group in self.groups]
+
+	def rebound(self):
+		# patterns without matches get an empty interval so that
+		# rules that cannot fire have a zero upper bound
+		lo, hi = dict(), dict()
+		for group,pool in self.pools():
+			n = pool.count()
+			s = 0 if self.exact or n==0 else max(self.min_slack,int(self.delta*n))
+			self.intervals[group[0]] = (max(0,n-s),n+s)
+			for r in group:
+				lo[r], hi[r] = Count(max(0,n-s)), Count(n+s)
+		self.lower, self.upper = self.evaluate(lo), self.evaluate(hi)
+		return self
+
+	def touch(self,ids,added=()):
+		for group,pool in self.pools():
+			if self.local:
+				pool.touch(ids,added)
+			else:
+				pool.reset()
+		if self.exact:
+			self.update_helpers()
+		return self
+
+	def is_outside_interval(self):
+		if self.exact:
+			return True
+		for group,pool in self.pools():
+			lo, hi = self.intervals[group[0]]
+			if pool.upper() > hi or pool.lower() < lo:
+				return True
+		return False
+
+class RejectionSimulator(StochasticSimulator):
+	# exact propensities in self.propensities are only computed on demand
+
+	rule_class = RejectionRule
+
+	def initialize(self):
+		self.lower = [rule.lower for rule in self.rules]
+		self.upper = [rule.upper for rule in self.rules]
+		self.total = math.fsum(self.upper)
+		self.ntrials = 0
+		self.nrebounds = 0
+
+	def rebound(self,i):
+		rule = self.rules[i].rebound()
+		self.total += rule.upper - self.upper[i]
+		self.lower[i], self.upper[i] = rule.lower, rule.upper
+		self.nrebounds += 1
+		return self
+
+	def update(self,i,journal):
+		(ids,added), classes = split_touched(journal), touched_classes(journal,self.state)
+		for j,rule in enumerate(self.rules):
+			if any(rule.depends_on(c) for c in classes):
+				if rule.touch(ids,added).is_outside_interval():
+					self.rebound(j)
+		if self.total < 0:
+			self.total = math.fsum(self.upper)
+		return self
+
+	def select(self):
+		r, cumsum = self.rng.random()*self.total, 0.0
+		for i,p in enumerate(self.upper):
+			cumsum += p
+			if r < cumsum and p > 0:
+				return i
+		return max(i for i,p in enumerate(self.upper) if p > 0)
+
+	def accept(self,i):
+		u = self.rng.random()*self.upper[i]
+		if u < self.lower[i]:
+			return True
+		self.propensities[i] = self.rules[i].compute_propensity()
+		if u < self.propensities[i]:
+			return True
+		# pools are validated now; a rejected rule that cannot fire, or whose counts left their intervals,
+		# is rebounded, so that stale upper bounds do not keep being selected
+		if self.propensities[i] == 0 or self.rules[i].is_outside_interval():
+			self.rebound(i)
+		return False
+
+	def run(self,end_time=math.inf,max_events=math.inf):
+		nevents = 0
+		while self.total > 0 and nevents < max_events:
+			dt = self.rng.expovariate(self.total)
+			if self.time + dt > end_time:
+				break
+			self.time += dt
+			self.ntrials += 1
+			i = self.select()
+			if not self.accept(i):
+				continue
+			nevents += 1
+			if self.fire(i):
+				return self
+		if nevents < max_events and end_time < math.inf:
+			self.time = end_time
+		return self
@@ -0,0 +1,203 @@
+from .ssa import StochasticSimulator
+from ..expressions.executable import ActionCaller
+from ..matcher.matcher import attribute_chain
+import math
+
+# Gibson & Bruck, J Phys Chem A 2000
+# Each rule holds a putative firing time in an indexed priority queue.
+# After a firing, only rules that depend on the fired rule are updated.
+# Dependencies are computed statically:
+#	a rule reads (class,attr) pairs from its patterns, constraints and helpers
+#	a rule writes (class,attr) pairs through the actions in its action strings
+#	rule j depends on rule i if a write of i overlaps a read of j
+# attr None is the existence of a node, attr '*' is any attribute
+# An attribute chain in a constraint, e.g. `s.bond.active`, reads each attribute on the class it reaches:
+# (LigSite,'bond') and then (Site,'active'), with Site the related class of LigSite.bond.
+
+class IndexedPriorityQueue:
+	# binary min-heap of indices keyed on times
+	# pos[i] is the location of index i in the heap
+
+	def __init__(self,times):
+		self.times = list(times)
+		self.heap = sorted(range(len(self.times)),key=lambda i: self.times[i])
+		self.pos = [0]*len(self.times)
+		for k,i in enumerate(self.heap):
+			self.pos[i] = k
+
+	def __len__(self):
+		return len(self.heap)
+
+	def top(self):
+		i = self.heap[0]
+		return i, self.times[i]
+
+	def update(self,i,time):
+		old, self.times[i] = self.times[i], time
+		if time < old:
+			self.sift_up(self.pos[i])
+		else:
+			self.sift_down(self.pos[i])
+		return self
+
+	def swap(self,k1,k2):
+		h = self.heap
+		h[k1], h[k2] = h[k2], h[k1]
+		self.pos[h[k1]], self.pos[h[k2]] = k1, k2
+
+	def sift_up(self,k):
+		while k > 0:
+			parent = (k-1)//2
+			if self.times[self.heap[parent]] <= self.times[self.heap[k]]:
+				break
+			self.swap(k,parent)
+			k = parent
+
+	def sift_down(self,k):
+		n = len(self.heap)
+		while True:
+			child = 2*k+1
+			if child >= n:
+				break
+			if child+1 < n and self.times[self.heap[child+1]] < self.times[self.heap[child]]:
+				child += 1
+			if self.times[self.heap[k]] <= self.times[self.heap[child]]:
+				break
+			self.swap(k,child)
+			k = child
+
+####### Static dependencies
+EVERYTHING = frozenset([(object,'*')])
+
+literal_action_prefixes = 'set remove setTrue setFalse flip increment decrement'.split()
+
+def chain_reads(_class,attrs):
+	# (class,attr) pairs read by an attribute chain from an instance of _class
+	reads = set()
+	for attr in attrs:
+		x = _class.Meta.local_attributes.get(attr)
+		if x is None:
+			# methods can read anything about the node
+			reads.add((_class,'*'))
+			break
+		reads.add((_class,attr))
+		if not x.is_related:
+			break
+		_class = x.related_class
+	return reads
+
+def pattern_reads(matcher):
+	namespace, reads = matcher.graph.namespace, set()
+	for var,node in matcher.graph.iter_nodes():
+		_class = node.__class__
+		reads.add((_class,None))
+		reads.update((_class,attr) for attr,_ in node.iter_literal_attrs())
+		reads.update((_class,attr) for attr,_ in node.iter_edges())
+	for c in matcher.constraints:
+		for m in attribute_chain.finditer(c.code):
+			if m.group(1) in namespace:
+				reads.update(chain_reads(namespace[m.group(1)],m.group(2).split('.')[1:]))
+		for call in c.deps.function_calls:
+			# computations on nodes, e.g. x.has_label(...), can read anything
+			if len(call)>1 and call[0] in namespace:
+				reads.add((namespace[call[0]],'*'))
+	for m in matcher.helpers.values():
+		reads.update(pattern_reads(m))
+	return reads
+
+def rule_reads(srule):
+	reads = set()
+	for m in [*srule.reactants.values(),*srule.helpers.values()]:
+		reads.update(pattern_reads(m))
+	return reads
+
+def edge_writes(_class,attr):
+	x = _class.Meta.local_attributes[attr]
+	return {(_class,attr),(x.related_class,x.related_name)}
+
+def method_writes(_class,method):
+	attrs = _class.Meta.local_attributes
+	related = [a for a in attrs if attrs[a].is_related]
+	if method == 'remove_all_edges':
+		return set.union(set(),*[edge_writes(_class,a) for a in related])
+	if method == 'remove':
+		return set.union({(_class,None)},*[edge_writes(_class,a) for a in related])
+	prefix, _, attr = method.partition('_')
+	if attr in related and prefix in ['add','remove']:
+		return edge_writes(_class,attr)
+	if attr in attrs and prefix in literal_action_prefixes:
+		return {(_class,attr)}
+	return EVERYTHING
+
+def rule_writes(srule):
+	# calls are (reactant,variable,method) for actions on pattern nodes
+	# builtins such as rollback() and terminate() write nothing
+	# anything else is not resolvable statically and writes everything
+	namespaces = {r:m.graph.namespace for r,m in srule.reactants.items()}
+	writes = set()
+	for x in srule.actions:
+		if not isinstance(x,ActionCaller):
+			continue
+		for call in x.deps.function_calls:
+			if len(call)==1 and call[0] in x.builtins:
+				continue
+			if len(call)==3 and call[1] in namespaces.get(call[0],{}):
+				writes.update(method_writes(namespaces[call[0]][call[1]],call[2]))
+			else:
+				return set(EVERYTHING)
+	return writes
+
+def overlaps(write,read):
+	(c1,a1), (c2,a2) = write, read
+	if not (issubclass(c1,c2) or issubclass(c2,c1)):
+		return False
+	return a1 in [None,'*'] or a2 == '*' or a1 == a2
+
+class RuleDependencyGraph:
+
+	def __init__(self,rules):
+		self.reads = [rule_reads(r) for r in rules]
+		self.writes = [rule_writes(r) for r in rules]
+		n = len(rules)
+		self.dependents = [[j for j in range(n) if i==j or self.depends(j,i)] for i in range(n)]
+
+	def depends(self,j,i):
+		return any(overlaps(w,r) for w in self.writes[i] for r in self.reads[j])
+
+class NextReactionSimulator(StochasticSimulator):
+
+	def initialize(self):
+		self.graph = RuleDependencyGraph(self.rules)
+		self.queue = IndexedPriorityQueue([self.draw(p) for p in self.propensities])
+
+	def draw(self,propensity):
+		if propensity > 0:
+			return self.time + self.rng.expovariate(propensity)
+		return math.inf
+
+	def update(self,i,journal):
+		# the fired rule draws a new time
+		# other dependents rescale their remaining waiting time
+		for j in self.graph.dependents[i]:
+			old, new = self.update_rule(j)
+			t = self.queue.times[j]
+			if j != i and old > 0 and new > 0 and t < math.inf:
+				t = self.time + (old/new)*(t-self.time)
+			elif j == i or old != new:
+				t = self.draw(new)
+			self.queue.update(j,t)
+		return self
+
+	def run(self,end_time=math.inf,max_events=math.inf):
+		nevents = 0
+		while len(self.queue) > 0 and nevents < max_events:
+			i, t = self.queue.top()
+			if t == math.inf or t > end_time:
+				break
+			self.time = t
+			nevents += 1
+			if self.fire(i):
+				return self
+		if nevents < max_events and end_time < math.inf:
+			self.time = end_time
+		return self
@@ -1,24 +1,104 @@
-from collections import deque 
+from .journal import ActionJournal
+from .index import NodeIndex, ancestors
+from ..matcher.helpers import HelperCache
+from ..schema.base import BaseClass
+from ..schema.actions import SetAttr, EdgeAction
+from collections import deque, Counter
 
 class SimulationState:
 	def __init__(self,nodes=[]):
 		self.state = {x.id:x for x in nodes}
-		# for both stacks, use LIFO semantics using appendleft and popleft
+		# nodes by class and ancestor class, see index.py
+		self.index = NodeIndex(self.state.values())
+		# action stack uses LIFO semantics using appendleft and popleft
 		self.action_stack = deque()
-		self.rollback_stack = deque()
+		# primary actions executed inside open transactions, for rollback
+		# marks[k] is the journal position at which the k-th open transaction began
+		self.journal = ActionJournal()
+		self.marks = []
+		# callables notified of each primary action executed or rolled back
+		self.listeners = []
+		# number of changes to instances of each class, by primary actions or update() and remove()
+		# versions[object] counts all changes
+		self.versions = Counter()
+		# helper match sets shared by rules, see matcher/helpers.py
+		self.helper_cache = HelperCache(self)
+		# Rete network of the patterns matched on this state, see matcher/rete.py
+		self.rete = None
+
+	def subscribe(self,listener):
+		self.listeners.append(listener)
+		return self
+
+	def unsubscribe(self,listener):
+		self.listeners.remove(listener)
+		return self
+
+	def notify(self,action):
+		for listener in self.listeners:
+			listener(action)
+		return self
 
 	def resolve(self,idx):
 		return self.state[idx]
 
 	def update(self,node):
+		if node.id in self.state:
+			self.index.remove(self.state[node.id])
 		self.state[node.id] = node
-		return self
+		self.index.add(node)
+		return self.bump(node.__class__)
 
 	def remove(self,node):
 		del self.state[node.id]
+		self.index.remove(node)
+		self.bump(node.__class__)
 		del node
 		return self
 
+	def get_nodes(self,_class):
+		# instances of _class, without scanning other nodes if _class is indexed
+		if issubclass(_class,BaseClass):
+			return self.index.get(_class)
+		return [x for x in self.state.values() if isinstance(x,_class)]
+
+	def count_nodes(self,_class):
+		return len(self.get_nodes(_class))
+
+	def add_attribute_index(self,_class,attr):
+		# buckets instances of _class by the value (literal) or degree (related) of attr
+		return self.index.add_attribute_index(_class,attr)
+
+	def reindex(self,action):
+		# node actions are reindexed by update() and remove()
+		if not self.index.attributes:
+			return self
+		if isinstance(action,SetAttr):
+			self.index.touch(self.state[action.idx])
+		elif isinstance(action,EdgeAction):
+			self.index.touch(self.state[action.source_idx])
+			self.index.touch(self.state[action.target_idx])
+		return self
+
+	def stamp(self,action):
+		# node actions are counted by update() and remove()
+		if isinstance(action,SetAttr):
+			self.bump(self.state[action.idx].__class__)
+		elif isinstance(action,EdgeAction):
+			classes = set([self.state[action.source_idx].__class__,self.state[action.target_idx].__class__])
+			for c in classes:
+				self.bump(c)
+		return self
+
+	def bump(self,_class):
+		self.versions[object] += 1
+		for c in ancestors(_class):
+			self.versions[c] += 1
+		return self
+
+	def get_version(self,classes):
+		return tuple(self.versions[c] for c in classes)
+
 	def get_contents(self,ignore_id=True,ignore_None=True,use_id_for_related=True,sort_for_printing=True):
 		d = {x.id:x.get_attrdict(ignore_id=ignore_id,ignore_None=ignore_None,use_id_for_related=use_id_for_related) for k,x in self.state.items()}
 		if sort_for_printing:
@@ -45,14 +125,49 @@ class SimulationState:
 			if hasattr(action,'expand'):
 				self.push_to_stack(action.expand())
 			else:
-				self.rollback_stack.appendleft(action.rollback(self))
 				action.execute(self)
+				self.reindex(action).stamp(action)
+				if self.marks:
+					self.journal.append(action)
+				self.notify(action)
+		return self
+
+	####### Transactions
+	# actions simulated outside a transaction are not journaled and cannot be rolled back
+	def begin(self):
+		# opens a transaction and returns its mark
+		self.marks.append(len(self.journal))
+		return len(self.marks)-1
+
+	def get_journal(self,mark=None):
+		# actions journaled since the transaction with the given mark (default innermost) began
+		mark = len(self.marks)-1 if mark is None else mark
+		return self.journal.actions(self.marks[mark])
+
+	def commit(self):
+		# closes the innermost transaction
+		# its actions are discarded unless an enclosing transaction is open
+		err = 'No open transaction to commit.'
+		assert self.marks, err
+		self.marks.pop()
+		if not self.marks:
+			self.journal.clear()
 		return self
 
-	def rollback(self):
-		while self.rollback_stack:
-			action = self.rollback_stack.popleft()
-			action.execute(self)
+	def rollback(self,mark=None):
+		# rolls back the transaction with the given mark (default innermost)
+		# along with any transactions nested in it, and closes them
+		err = 'No open transaction to roll back.'
+		assert self.marks, err
+		mark = len(self.marks)-1 if mark is None else mark
+		while len(self.journal) > self.marks[mark]:
+			action = self.journal.pop()
+			action.rollback(self)
+			self.reindex(action).stamp(action)
+			self.notify(action)
+		del self.marks[mark:]
+		if not self.marks:
+			self.journal.clear()
 		return self
 
 
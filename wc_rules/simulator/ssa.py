@@ -0,0 +1,220 @@
+from ..matcher.matcher import PatternMatcher, MatchSet, get_helper_matches
+from ..matcher.helpers import get_classes
+from ..expressions.executable import ActionCaller, Constraint, Computation, RateLaw, initialize_from_string
+from ..schema.actions import NodeAction, SetAttr, EdgeAction, RollbackAction, TerminateAction
+from ..utils.collections import sort_by_value
+from types import SimpleNamespace
+from collections import deque
+import math, random
+
+def flatten_actions(x):
+	# action callers return actions or arbitrarily nested lists of actions
+	actions, stack = [], deque([x])
+	while stack:
+		x = stack.popleft()
+		if isinstance(x,list):
+			stack.extendleft(reversed(x))
+		else:
+			actions.append(x)
+	return actions
+
+def touched_ids(journal):
+	# ids of nodes modified by primary actions in a journal
+	ids = set()
+	for x in journal:
+		if isinstance(x,(NodeAction,SetAttr)):
+			ids.add(x.idx)
+		elif isinstance(x,EdgeAction):
+			ids.update([x.source_idx,x.target_idx])
+	return ids
+
+def touched_classes(journal,sim):
+	# classes of nodes modified by primary actions in a journal
+	# nodes removed during the firing are resolved from their RemoveNode actions
+	removed = {x.idx:x._class for x in journal if isinstance(x,NodeAction)}
+	def get_class(idx):
+		return sim.state[idx].__class__ if idx in sim.state else removed[idx]
+
+	classes = set()
+	for x in journal:
+		if isinstance(x,NodeAction):
+			classes.add(x._class)
+		elif isinstance(x,SetAttr):
+			classes.add(get_class(x.idx))
+		elif isinstance(x,EdgeAction):
+			classes.update([get_class(x.source_idx),get_class(x.target_idx)])
+	return classes
+
+class SimulationRule:
+	# a rule bound to its parameter values
+	# holds the current matches of its reactants and its propensity
+	# with symmetry breaking, reactant matches are enumerated once per orbit of the pattern's automorphisms
+
+	symmetry_breaking = False
+
+	def __init__(self,name,rule,parameters):
+		self.name = name
+		self.rule = rule
+		self.parameters = parameters
+		self.reactants = {r:PatternMatcher(p,self.symmetry_breaking) for r,p in rule.reactants.items()}
+		self.helpers = {h:PatternMatcher(p) for h,p in rule.helpers.items()}
+		# reactants sharing a pattern must be bound to distinct matches
+		self.groups = sort_by_value(rule.reactants)
+		self.rate_law = initialize_from_string(rule.get_rate_law(),(RateLaw,))
+		self.actions = [initialize_from_string(s,(Constraint,Computation,ActionCaller)) for s in rule.actions]
+		# constraints that read beyond a pattern, e.g. `s.bond.active`, make the rule depend on every class
+		self.classes = tuple(set.union(set(),*[set(get_classes(m)) for m in [*self.reactants.values(),*self.helpers.values()]]))
+		self.matches = dict()
+		self.helper_matches = dict()
+		self.propensity = 0.0
+
+	def depends_on(self,_class):
+		return issubclass(_class,self.classes)
+
+	def update(self,sim):
+		self.matches = dict()
+		for group in self.groups:
+			matches = MatchSet(self.reactants[group[0]],sim,self.parameters)
+			for r in group:
+				self.matches[r] = matches
+		self.helper_matches = get_helper_matches(self.helpers,sim,self.parameters)
+		self.propensity = self.compute_propensity()
+		return self
+
+	def compute_propensity(self):
+		return self.evaluate(self.matches)
+
+	def evaluate(self,matches):
+		# matches maps reactants to objects with a count() method
+		# a rule without enough matches to bind its reactants cannot fire
+		if any(matches[g[0]].count() < len(g) for g in self.groups):
+			return 0.0
+		v = float(self.rate_law.exec(matches,self.helper_matches,self.parameters))
+		err = 'Rule `{0}` has negative propensity {1}.'
+		assert v >= 0, err.format(self.name,v)
+		return v
+
+	def sample_reactants(self,rng):
+		d = dict()
+		for group in self.groups:
+			for r,match in zip(group,self.matches[group[0]].sample(len(group),rng)):
+				d[r] = SimpleNamespace(**match)
+		return d
+
+	def fire(self,sim,rng):
+		# executes actions on sampled reactants
+		# returns the journal of executed primary actions and whether to terminate
+		# actions are applied immediately so later actions see an updated state
+		namespace = dict(**self.parameters,**self.helper_matches,**self.sample_reactants(rng))
+		mark = sim.begin()
+		terminate = False
+		for x in self.actions:
+			if isinstance(x,Computation):
+				namespace[x.deps.declared_variable] = x.exec(namespace)
+				continue
+			if isinstance(x,Constraint):
+				actions = [] if x.exec(namespace) else [RollbackAction()]
+			else:
+				actions = flatten_actions(x.exec(namespace,{}))
+			if any(isinstance(a,RollbackAction) for a in actions):
+				journal = sim.get_journal(mark)
+				sim.rollback(mark)
+				return journal, False
+			terminate = terminate or any(isinstance(a,TerminateAction) for a in actions)
+			sim.push_to_stack([a for a in actions if not isinstance(a,TerminateAction)]).simulate()
+		journal = sim.get_journal(mark)
+		sim.commit()
+		return journal, terminate
+
+class StochasticSimulator:
+	# binds the rules of a model to parameters and a simulation state
+	# subclasses decide which rule fires next and which rules are updated after a firing
+
+	rule_class = SimulationRule
+
+	def __init__(self,model,state,parameters=None,seed=0,rule_class=None):
+		if rule_class is not None:
+			self.rule_class = rule_class
+		if parameters is None:
+			parameters = model.collect_parameters()
+		model.verify(parameters)
+		self.state = state
+		self.rng = random.Random(seed)
+		self.rules = [self.rule_class('.'.join(path),rule,params) for path,rule,params in model.iter_rules(parameters)]
+		self.time = 0.0
+		self.nevents = 0
+		self.terminated = False
+		for rule in self.rules:
+			rule.update(self.state)
+		self.propensities = [rule.propensity for rule in self.rules]
+		self.initialize()
+
+	def initialize(self):
+		pass
+
+	def update_rule(self,i):
+		# returns old and new propensities of rule i
+		old, new = self.propensities[i], self.rules[i].update(self.state).propensity
+		self.propensities[i] = new
+		return old, new
+
+	def update(self,i,journal):
+		pass
+
+	def fire(self,i):
+		journal, terminate = self.rules[i].fire(self.state,self.rng)
+		self.nevents += 1
+		self.terminated = terminate
+		self.update(i,journal)
+		return terminate
+
+class DirectMethodSimulator(StochasticSimulator):
+	# Gillespie's direct method
+	# propensities are kept in a list along with their running total
+	# after a firing, only rules that depend on the classes of touched nodes are updated
+	# the total is resummed periodically to avoid drift
+
+	resum_interval = 10000
+
+	def initialize(self):
+		self.dependents = dict()
+		self.total = math.fsum(self.propensities)
+
+	def get_dependents(self,_class):
+		if _class not in self.dependents:
+			self.dependents[_class] = [i for i,rule in enumerate(self.rules) if rule.depends_on(_class)]
+		return self.dependents[_class]
+
+	def update(self,i,journal):
+		idxs = set()
+		for _class in touched_classes(journal,self.state):
+			idxs.update(self.get_dependents(_class))
+		for j in sorted(idxs):
+			old, new = self.update_rule(j)
+			self.total += new - old
+		if self.nevents % self.resum_interval == 0 or self.total < 0:
+			self.total = math.fsum(self.propensities)
+		return self
+
+	def select(self):
+		r, cumsum = self.rng.random()*self.total, 0.0
+		for i,p in enumerate(self.propensities):
+			cumsum += p
+			if r < cumsum and p > 0:
+				return i
+		# roundoff: return the last rule with nonzero propensity
+		return max(i for i,p in enumerate(self.propensities) if p > 0)
+
+	def run(self,end_time=math.inf,max_events=math.inf):
+		nevents = 0
+		while self.total > 0 and nevents < max_events:
+			dt = self.rng.expovariate(self.total)
+			if self.time + dt > end_time:
+				break
+			self.time += dt
+			nevents += 1
+			if self.fire(self.select()):
+				return self
+		if nevents < max_events and end_time < math.inf:
+			self.time = end_time
+		return self
@@ -0,0 +1,217 @@
+from .ssa import DirectMethodSimulator, flatten_actions
+from .scheduler import RuleDependencyGraph
+from ..expressions.executable import ActionCaller
+from types import SimpleNamespace
+from collections import defaultdict
+import numpy as np
+import math
+
+# Tau-leaping with adaptive step selection (Cao, Gillespie & Petzold, J Chem Phys 2006)
+# Reactant patterns play the role of species; match counts play the role of species counts.
+#
+# A rule is critical if
+#	it is not leapable, i.e., its actions depend on the state left by earlier firings
+#	(constraints, computations, rollback/terminate, helpers), or
+#	it can fire fewer than n_critical more times before running out of reactant matches.
+# Critical rules are fired one at a time as in the direct method.
+#
+# The leap size tau bounds the expected relative change in the propensities of noncritical rules.
+# The change in a pattern count per firing is not known statically,
+# so it is bounded by the group size for rules that consume the pattern
+# and by 1 for every other rule that writes what the pattern reads.
+# This overestimates the mean and variance of count changes, giving conservative leaps.
+#
+# A leap samples a Poisson number of firings for each noncritical rule.
+# Firings are bound to matches whose nodes and neighbors are disjoint from those of other firings,
+# so their actions can be computed in advance and applied as a single batch.
+# Matches are drawn lazily in random order from random root candidates (PatternMatcher.sampling_root),
+# so a leap extends only as many candidates as its firings need;
+# patterns without such a root are listed and shuffled.
+# If not enough disjoint matches exist, the leap would drive match counts negative;
+# it is rejected and retried with half the step.
+# If all rules are critical or tau is only a few SSA steps long, a run of exact steps is taken instead.
+
+class TauLeapingSimulator(DirectMethodSimulator):
+
+	epsilon = 0.03
+	n_critical = 10
+	ssa_factor = 10
+	ssa_steps = 100
+
+	def initialize(self):
+		super().initialize()
+		self.nprng = np.random.default_rng(self.rng.getrandbits(64))
+		self.leapable = [is_leapable(rule) for rule in self.rules]
+		self.stoichiometry = estimate_stoichiometry(self.rules)
+		self.nleaps = 0
+		self.nrejections = 0
+
+	def group_counts(self,rule):
+		return [(group,rule.matches[group[0]].count()) for group in rule.groups]
+
+	def is_critical(self,i):
+		if not self.leapable[i]:
+			return True
+		rule = self.rules[i]
+		return any(n//len(g) < self.n_critical for g,n in self.group_counts(rule))
+
+	def select_tau(self,noncritical):
+		# tau from the CGP bound on the mean and variance of pattern count changes
+		# patterns are keyed by (rule,group) of the consuming rule
+		tau = math.inf
+		for i in noncritical:
+			for group,n in self.group_counts(self.rules[i]):
+				mu = sigma2 = 0.0
+				for j,nu in self.stoichiometry[(i,group[0])].items():
+					if j in noncritical:
+						mu += nu*self.propensities[j]
+						sigma2 += nu*nu*self.propensities[j]
+				bound = max(self.epsilon*n/len(group),1)
+				if mu > 0:
+					tau = min(tau,bound/mu,bound*bound/sigma2)
+		return tau
+
+	def run(self,end_time=math.inf,max_events=math.inf):
+		nevents = 0
+		while self.total > 0 and nevents < max_events:
+			noncritical = {i for i,p in enumerate(self.propensities) if p > 0 and not self.is_critical(i)}
+			tau1 = self.select_tau(noncritical)
+			if not noncritical or tau1 < self.ssa_factor/self.total:
+				# exact steps until tau is worth recomputing
+				nsteps = min(self.ssa_steps,max_events-nevents)
+				before = self.nevents
+				stop = super().run(end_time,nsteps).nevents - before < nsteps or self.terminated
+				nevents += self.nevents - before
+				if stop:
+					return self
+				continue
+			nfired, terminate = self.leap(tau1,noncritical,end_time)
+			nevents += nfired
+			if terminate:
+				return self
+			if self.time >= end_time:
+				break
+		if nevents < max_events and end_time < math.inf:
+			self.time = end_time
+		return self
+
+	def leap(self,tau1,noncritical,end_time):
+		# returns the number of firings and whether a terminate action was hit
+		critical = [i for i,p in enumerate(self.propensities) if p > 0 and i not in noncritical]
+		critical_total = math.fsum(self.propensities[i] for i in critical)
+		tau2 = self.rng.expovariate(critical_total) if critical_total > 0 else math.inf
+		while True:
+			tau = min(tau1,tau2,end_time-self.time)
+			counts = {i:int(self.nprng.poisson(self.propensities[i]*tau)) for i in sorted(noncritical)}
+			firings = self.sample_firings(counts)
+			if firings is not None:
+				break
+			self.nrejections += 1
+			tau1 /= 2
+		self.time += tau
+		self.nleaps += 1
+		nfired = self.execute(firings)
+		# one critical firing at the end of the leap
+		# critical rules disabled by the leap are skipped
+		critical = [i for i in critical if self.propensities[i] > 0]
+		if tau == tau2 and critical:
+			return nfired + 1, self.fire(self.select_from(critical))
+		return nfired, False
+
+	def select_from(self,idxs):
+		r, cumsum = self.rng.random()*math.fsum(self.propensities[i] for i in idxs), 0.0
+		for i in idxs:
+			cumsum += self.propensities[i]
+			if r < cumsum:
+				return i
+		return idxs[-1]
+
+	def sample_firings(self,counts):
+		# returns (rule,reactants) pairs for the leap, or None if there are not enough disjoint matches
+		reserved, firings = set(), []
+		for i,k in counts.items():
+			if k == 0:
+				continue
+			rule = self.rules[i]
+			orders = {group[0]:iter_shuffled(rule.matches[group[0]],self.rng) for group in rule.groups}
+			for _ in range(k):
+				reactants = dict()
+				for group in rule.groups:
+					matches = take_disjoint(orders[group[0]],len(group),reserved)
+					if matches is None:
+						return None
+					reactants.update(zip(group,matches))
+				firings.append((i,reactants))
+		return firings
+
+	def execute(self,firings):
+		# computes the actions of all firings before applying any of them
+		actions = []
+		for i,reactants in firings:
+			rule = self.rules[i]
+			namespace = dict(**rule.parameters,**{r:SimpleNamespace(**m) for r,m in reactants.items()})
+			for x in rule.actions:
+				actions.extend(flatten_actions(x.exec(namespace,{})))
+		mark = self.state.begin()
+		self.state.push_to_stack(actions).simulate()
+		journal = self.state.get_journal(mark)
+		self.state.commit()
+		self.nevents += len(firings)
+		self.update(None,journal)
+		return len(firings)
+
+def is_leapable(srule):
+	if srule.helpers or any(m.helpers for m in srule.reactants.values()):
+		return False
+	for x in srule.actions:
+		if not isinstance(x,ActionCaller):
+			return False
+		if set(x.builtins) & {'rollback','terminate'}:
+			return False
+	return True
+
+def estimate_stoichiometry(rules):
+	# bounds on |change| in the match count of (rule i, group) per firing of rule j
+	graph = RuleDependencyGraph(rules)
+	nu = defaultdict(dict)
+	for i,rule in enumerate(rules):
+		for group in rule.groups:
+			for j in range(len(rules)):
+				if j == i:
+					nu[(i,group[0])][j] = len(group)
+				elif i in graph.dependents[j]:
+					nu[(i,group[0])][j] = 1
+	return nu
+
+def node_neighborhood(match):
+	# matches may also hold values assigned by computations
+	ids = set()
+	for node in match.values():
+		if hasattr(node,'listget_all_related'):
+			ids.add(node.id)
+			ids.update(x.id for x in node.listget_all_related())
+	return ids
+
+def shuffled(x,rng):
+	return rng.sample(x,len(x))
+
+def iter_shuffled(matches,rng):
+	# matches of a MatchSet in random order
+	matcher = matches.matcher
+	if matcher.sampling_root is None:
+		return iter(shuffled(matches.matches,rng))
+	return matcher.iter_random_matches(matches.sim,rng,matches.params)
+
+def take_disjoint(matches,n,reserved):
+	# next n matches from an iterator whose nodes and neighbors do not overlap reserved ids
+	# reserved ids are updated with those of the chosen matches
+	chosen = []
+	for match in matches:
+		ids = node_neighborhood(match)
+		if ids & reserved:
+			continue
+		reserved.update(ids)
+		chosen.append(match)
+		if len(chosen) == n:
+			return chosen
+	return None
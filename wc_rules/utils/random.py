@@ -1,4 +1,5 @@
 import uuid, random
+import numpy as np
 
 ######## random name generator
 # To modify this seed, load this module, then execute this_module.idgen.seed(<new_seed>)
@@ -7,3 +8,9 @@ idgen.seed(0)
 
 def generate_id():
     return str(uuid.UUID(int=idgen.getrandbits(128)))
+
+######## independent streams
+# n seeds for the stream identified by key, e.g., (trajectory index,)
+# seeds depend only on the base seed and key, not on the process that draws them
+def stream_seeds(seed,key,n=1):
+    return [int(x) for x in np.random.SeedSequence([seed,*key]).generate_state(n,dtype=np.uint64)]